@@ -13,12 +13,16 @@ setup(
     keywords = "video scraper scanner catalog subtitles transcode encode convert metadata",
     url = "https://git.ycnrg.org/projects/YXB/repos/yc_xbake",
 
-    packages = find_packages(),
+    packages = find_packages(exclude=['tests', 'tests.*']),
     scripts = [],
 
     install_requires = ['docutils', 'setproctitle', 'pymongo', 'redis', 'pymediainfo', 'enzyme',
                         'distance', 'requests', 'xmltodict', 'xattr', 'flask>=0.10.1', 'lxml',
                         'mutagen', 'arrow>=0.7.0'],
+    tests_require = ['fakeredis', 'mongomock'],
+    extras_require = {
+        'fingerprint': ['numpy']
+    },
 
     package_data = {
         '': [ '*.md' ],
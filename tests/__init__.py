@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+tests
+XBake test suite; run with `python -m unittest discover -s tests -t .`
+
+@author   Jacob Hipps <jacob@ycnrg.org>
+@repo     https://git.ycnrg.org/projects/YXB/repos/yc_xbake
+
+Copyright (c) 2013-2017 J. Hipps / Neo-Retro Group, Inc.
+https://ycnrg.org/
+
+"""
+
+from xbake import defaults
+from xbake.common.logthis import LL, configure_logging
+from xbake.common.rcfile import XConfig
+
+
+def get_config(overrides=None):
+    """return a read-only config built from the defaults, with @overrides; logging is set to critical only"""
+    tover = {'core': {'loglevel': LL.CRITICAL}}
+    tover.update(overrides or {})
+    xconfig = XConfig(defaults, frozen=True)._clone(tover)
+    configure_logging(xconfig)
+    return xconfig
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+tests.test_ascan
+Incremental audio scans: mkey store & album index
+
+@author   Jacob Hipps <jacob@ycnrg.org>
+@repo     https://git.ycnrg.org/projects/YXB/repos/yc_xbake
+
+Copyright (c) 2013-2017 J. Hipps / Neo-Retro Group, Inc.
+https://ycnrg.org/
+
+"""
+
+import shutil
+import tempfile
+import unittest
+
+import mongomock
+
+from xbake import ascan
+from xbake.common import db
+from xbake.common.mkstore import MKStore, MKS
+from xbake.mscan import out
+from tests import get_config
+
+
+def track(album, title, tracknum=1):
+    """return a minimal track record (as from ascan.scanfile()) on @album"""
+    return {'tags': {'album': album, 'album_artist': "Artist", 'year': "2017", 'disc': "1", 'title': title, 'tracknum': tracknum},
+            'subsong': {'index': 1, 'duration': None}, 'format': {'format': "FLAC", 'length': 200.0}, 'last_updated': 1}
+
+
+class TestMKStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp(prefix="xbake_test_")
+        self.mks = MKStore(self.tdir + "/mks.db")
+
+    def tearDown(self):
+        self.mks.close()
+        shutil.rmtree(self.tdir, ignore_errors=True)
+
+    def test_changed_record(self):
+        """a changed file is returned with its previous record"""
+        xrec = {self.tdir + "/a.flac": track("Old", "A")}
+        self.mks.put(self.tdir + "/a.flac", "mkey1", xrec)
+        self.assertEqual(self.mks.check(self.tdir + "/a.flac", "mkey1"), (MKS.UNCHANGED, self.tdir + "/a.flac", xrec))
+        self.assertEqual(self.mks.check(self.tdir + "/a.flac", "mkey2"), (MKS.CHANGED, self.tdir + "/a.flac", xrec))
+        self.assertEqual(self.mks.check(self.tdir + "/b.flac", "mkey3"), (MKS.NEW, None, None))
+
+
+class TestAlbumIndex(unittest.TestCase):
+
+    def test_retagged_track(self):
+        """a track moved to another album updates both the old and the new album"""
+        albums = ascan.AlbumIndex()
+        albums.add("/m/b.flac", track("Old", "B", 2), dirty=False)
+        albums.touch(track("Old", "A"))
+        albums.add("/m/a.flac", track("New", "A"))
+
+        arecs = dict((x['album'], x) for x in albums.records().values())
+        self.assertEqual(sorted(arecs), ["New", "Old"])
+        self.assertEqual([x['file'] for x in arecs['Old']['tracks']], ["/m/b.flac"])
+        self.assertEqual([x['file'] for x in arecs['New']['tracks']], ["/m/a.flac"])
+
+    def test_emptied_album(self):
+        """an album whose only track was moved is returned with no tracks"""
+        albums = ascan.AlbumIndex()
+        albums.touch(track("Old", "A"))
+        albums.add("/m/a.flac", track("New", "A"))
+
+        arecs = dict((x['album'], x) for x in albums.records().values())
+        self.assertEqual(arecs['Old']['tracks'], [])
+        self.assertEqual(arecs['Old']['track_count'], 0)
+
+
+class TestAlbumOutput(unittest.TestCase):
+
+    def setUp(self):
+        get_config()
+        self.saved = db.MongoClient
+        db.MongoClient = mongomock.MongoClient
+        self.uri = "mongodb://localhost/xbtest"
+        self.mdx = db.mongo(self.uri)
+
+    def tearDown(self):
+        db.close_all()
+        db.MongoClient = self.saved
+
+    def test_delete_empty(self):
+        """albums left with no tracks are deleted, and counted separately from upserted albums"""
+        albums = ascan.AlbumIndex()
+        albums.add("/m/a.flac", track("Old", "A"))
+        oldrec = albums.records().values()[0]
+        self.mdx.upsert_many("albums", [oldrec])
+
+        albums = ascan.AlbumIndex()
+        albums.touch(track("Old", "A"))
+        albums.add("/m/a.flac", track("New", "A"))
+        ostat = out.to_mongo({'scan': {'hostname': "host1", 'tstamp': 1}, 'series': {}, 'files': {}, 'albums': albums.records()}, self.uri)
+
+        self.assertEqual(ostat['stats']['albums']['upserted'], 1)
+        self.assertEqual(ostat['stats']['albums']['deleted'], 1)
+        self.assertEqual([x['album'] for x in self.mdx.xcur['albums'].find()], ["New"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+tests.test_fsutil
+xattr calls made by a scan, counted with xattr_stats() on tmpfs
+
+@author   Jacob Hipps <jacob@ycnrg.org>
+@repo     https://git.ycnrg.org/projects/YXB/repos/yc_xbake
+
+Copyright (c) 2013-2017 J. Hipps / Neo-Retro Group, Inc.
+https://ycnrg.org/
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import xattr
+
+from xbake.common import fsutil
+from xbake.mscan import mscan
+from tests import get_config
+
+# tmpfs supports user xattrs (Linux 6.6+), so no disk-backed filesystem is needed
+SHM_DIR = '/dev/shm'
+
+
+def shm_xattrs():
+    """return True if user xattrs can be set on files in SHM_DIR"""
+    if not os.path.isdir(SHM_DIR):
+        return False
+    try:
+        with tempfile.NamedTemporaryFile(dir=SHM_DIR) as f:
+            xattr.setxattr(f.name, 'user.xbake.test', "1")
+    except (IOError, OSError):
+        return False
+    return True
+
+
+@unittest.skipUnless(shm_xattrs(), "user xattrs are not supported on %s" % (SHM_DIR))
+class TestScanXattrs(unittest.TestCase):
+
+    def setUp(self):
+        get_config()
+        self.tdir = tempfile.mkdtemp(prefix="xbake_test_", dir=SHM_DIR)
+        self.files = []
+        for tsub in ("Show", "Show/Season 1", "Show/Season 2"):
+            os.makedirs(os.path.join(self.tdir, tsub))
+            for i in range(3):
+                tpath = os.path.join(self.tdir, tsub, "episode%d.mkv" % (i))
+                with open(tpath, 'w') as f:
+                    f.write("\x1a\x45\xdf\xa3")
+                xattr.setxattr(tpath, 'user.checksum.md5', "md5-%d" % (i))
+                xattr.setxattr(tpath, 'user.checksum.crc32', "CRC%d" % (i))
+                self.files.append(tpath)
+        xattr.setxattr(os.path.join(self.tdir, "Show"), 'user.media.seriesname', "Show")
+        fsutil.xattr_reset()
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir, ignore_errors=True)
+        fsutil.xattr_reset()
+
+    def walk(self, ovindex):
+        """resolve overrides for each directory & read each file's xattrs, as a scan does"""
+        ovrs = {}
+        for tdir, dlist, flist in os.walk(self.tdir):  # pylint: disable=unused-variable
+            ovrs[tdir] = ovindex.resolve(tdir, flist)
+            for tfile in flist:
+                mscan.parse_xattr_overrides(os.path.join(tdir, tfile))
+        return ovrs
+
+    def test_one_list_per_path(self):
+        """each directory & file is listed once, and attributes are only fetched where present"""
+        ovrs = self.walk(mscan.OverrideIndex())
+        xstats = fsutil.xattr_stats()
+        self.assertEqual(xstats['list'], len(ovrs) + len(self.files))
+        self.assertEqual(xstats['get'], 1 + 2 * len(self.files))
+        self.assertEqual(xstats['errors'], 0)
+        self.assertEqual(ovrs[os.path.join(self.tdir, "Show/Season 2")]['series_name'], "Show")
+
+    def test_directory_cache(self):
+        """directories resolved again in the same scan are served from the cache"""
+        ovrs = self.walk(mscan.OverrideIndex())
+        tlist = fsutil.xattr_stats()['list']
+        self.walk(mscan.OverrideIndex())
+        xstats = fsutil.xattr_stats()
+        self.assertEqual(xstats['cached'], len(ovrs))
+        self.assertEqual(xstats['list'] - tlist, len(self.files))
+
+    def test_unchanged_writes(self):
+        """only keys that differ from the values just read are written"""
+        tfile = self.files[0]
+        mscan.parse_xattr_overrides(tfile)
+        mscan.save_checksums(tfile, {'md5': "md5-0", 'crc32': "CRC0", 'ed2k': "ed2k-0"})
+        xstats = fsutil.xattr_stats()
+        self.assertEqual(xstats['set'], 1)
+        self.assertEqual(xstats['unchanged'], 2)
+        self.assertEqual(xattr.getxattr(tfile, 'user.checksum.ed2k'), "ed2k-0")
+
+        # values written are remembered too, so saving them again writes nothing
+        mscan.save_checksums(tfile, {'md5': "md5-0", 'crc32': "CRC0", 'ed2k': "ed2k-0"})
+        xstats = fsutil.xattr_stats()
+        self.assertEqual(xstats['set'], 1)
+        self.assertEqual(xstats['unchanged'], 5)
+        self.assertEqual(xstats['list'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
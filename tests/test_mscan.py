@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+tests.test_mscan
+Directory override resolution
+
+@author   Jacob Hipps <jacob@ycnrg.org>
+@repo     https://git.ycnrg.org/projects/YXB/repos/yc_xbake
+
+Copyright (c) 2013-2017 J. Hipps / Neo-Retro Group, Inc.
+https://ycnrg.org/
+
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import xattr
+
+from xbake.common import fsutil
+from xbake.mscan import mscan
+from tests import get_config
+from tests.test_fsutil import SHM_DIR, shm_xattrs
+
+
+class TestOverrideIndex(unittest.TestCase):
+
+    def setUp(self):
+        get_config()
+        fsutil.xattr_reset()
+        self.tdir = os.path.realpath(tempfile.mkdtemp(prefix="xbake_test_", dir=SHM_DIR if os.path.isdir(SHM_DIR) else None))
+        self.season = os.path.join(self.tdir, "Show", "Season 1")
+        os.makedirs(self.season)
+        self.write_xbake("Show", {'series_name': "Show", 'tvdb_id': "1234"})
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir, ignore_errors=True)
+        fsutil.xattr_reset()
+
+    def write_xbake(self, tsub, xrides):
+        with open(os.path.join(self.tdir, tsub, '.xbake'), 'w') as f:
+            json.dump(xrides, f)
+
+    def test_from_root(self):
+        """a single directory gets the overrides of the directories above it, down from the root"""
+        self.write_xbake("Show/Season 1", {'season': 1})
+        ovrx = mscan.OverrideIndex().resolve_path(self.season, self.tdir)
+        self.assertEqual(ovrx, {'series_name': "Show", 'tvdb_id': "1234", 'season': 1})
+
+    def test_no_root(self):
+        """without a root, or outside of it, only the directory's own overrides are used"""
+        self.write_xbake("Show/Season 1", {'season': 1})
+        self.assertEqual(mscan.OverrideIndex().resolve_path(self.season), {'season': 1})
+        self.assertEqual(mscan.OverrideIndex().resolve_path(self.season, self.tdir + "/Other"), {'season': 1})
+
+    def test_mtimes(self):
+        """walked directories without overrides are not stat'd; the .xbake mtime is kept for those with one"""
+        ovindex = mscan.OverrideIndex()
+        tstats = []
+        saved = os.stat
+
+        def counting_stat(tpath):
+            tstats.append(tpath)
+            return saved(tpath)
+
+        twalk = [(tdir, flist) for tdir, dlist, flist in os.walk(self.tdir)]  # pylint: disable=unused-variable
+        os.stat = counting_stat
+        try:
+            for tdir, flist in twalk:
+                ovindex.resolve(tdir, flist)
+        finally:
+            os.stat = saved
+        tshow = os.path.join(self.tdir, "Show")
+        self.assertEqual(set(tstats), set([tshow + '/.xbake']))
+        self.assertEqual(ovindex.dirs[tshow][0], os.stat(tshow + '/.xbake').st_mtime)
+        self.assertIsNone(ovindex.dirs[self.season][0])
+        self.assertIsNone(ovindex.dirs[self.tdir][0])
+
+    @unittest.skipUnless(shm_xattrs(), "user xattrs are not supported on %s" % (SHM_DIR))
+    def test_ignored_parent(self):
+        """a directory below an ignored directory is ignored, too"""
+        xattr.setxattr(os.path.join(self.tdir, "Show"), 'user.xbake.ignore', "1")
+        self.assertIsNone(mscan.OverrideIndex().resolve_path(self.season, self.tdir))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+tests.test_queue
+Queue runner job transitions
+
+@author   Jacob Hipps <jacob@ycnrg.org>
+@repo     https://git.ycnrg.org/projects/YXB/repos/yc_xbake
+
+Copyright (c) 2013-2017 J. Hipps / Neo-Retro Group, Inc.
+https://ycnrg.org/
+
+"""
+
+import json
+import unittest
+
+import fakeredis
+
+from xbake.common import db
+from xbake.srv import queue
+from tests import get_config
+
+
+class CountingPipeline(fakeredis.FakePipeline):
+    """pipeline that records the commands sent with each EXEC"""
+    def execute(self, raise_on_error=True):
+        self.owner.execs.append((self.transaction, [x[0] for x in self.commands]))
+        return fakeredis.FakePipeline.execute(self, raise_on_error)
+
+class CountingRedis(fakeredis.FakeStrictRedis):
+    """fake Redis client that counts pipeline executions"""
+    def __init__(self, *args, **kwargs):
+        fakeredis.FakeStrictRedis.__init__(self, *args, **kwargs)
+        self.execs = []
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return CountingPipeline(self, transaction)
+
+
+class TestRunJob(unittest.TestCase):
+
+    def setUp(self):
+        self.rcon = CountingRedis(decode_responses=True)
+        self.rcon.flushall()
+        self.rdx = db.redis(prefix="xbtest", silence=True)
+        self.rdx.rcon = self.rcon
+        queue.rdx = self.rdx
+        queue.config = get_config()
+        queue.runner_id = "test:1"
+        queue.leaser = queue.LeaseKeeper(self.rdx, 60)
+
+    def push_job(self, jid):
+        qiraw = json.dumps({'id': jid, 'uid': "uid%d" % (jid), 'fid': "f%d" % (jid), 'opts': {}})
+        self.rdx.lpush('queue_test', qiraw)
+        return self.rdx.brpoplpush('queue_test', 'work_test', 1)
+
+    def test_single_exec(self):
+        """follow-up job, job status, ack, and lease release are sent in one EXEC"""
+        qiraw = self.push_job(1)
+        seen = {}
+
+        def handler(jdata):
+            queue.enqueue('next', jdata['id'], jdata['fid'], jdata['opts'], silent=True)
+            # nothing is committed until the handler returns
+            seen['next'] = self.rdx.llen('queue_next')
+            seen['lease'] = self.rdx.get(queue.lease_key('test', "uid1"))
+            return 0
+
+        self.assertEqual(queue.run_job('test', qiraw, handler=handler), 0)
+        self.assertEqual(seen, {'next': 0, 'lease': "test:1"})
+
+        self.assertEqual(len(self.rcon.execs), 1)
+        ttrans, tcmds = self.rcon.execs[0]
+        self.assertTrue(ttrans)
+        self.assertEqual(sorted(tcmds), sorted(['lpush', 'hset', 'lrem', 'delete']))
+
+        self.assertEqual(self.rdx.llen('work_test'), 0)
+        self.assertEqual(self.rdx.llen('queue_next'), 1)
+        self.assertFalse(self.rdx.exists(queue.lease_key('test', "uid1")))
+        self.assertEqual(json.loads(self.rdx.hget('jobstatus', 1))['status'], "ok")
+
+    def test_failed_handler(self):
+        """a job whose handler raises is still acknowledged in one EXEC, and marked as failed"""
+        qiraw = self.push_job(2)
+
+        def handler(jdata):
+            raise RuntimeError("boom")
+
+        self.assertEqual(queue.run_job('test', qiraw, handler=handler), -1)
+        self.assertEqual(len(self.rcon.execs), 1)
+        self.assertEqual(self.rdx.llen('work_test'), 0)
+        self.assertFalse(self.rdx.exists(queue.lease_key('test', "uid2")))
+        self.assertEqual(json.loads(self.rdx.hget('jobstatus', 2))['status'], "failed")
+
+    def test_bad_json(self):
+        """an unparseable item is removed from the work queue"""
+        self.rdx.lpush('work_test', "{not json")
+        self.assertEqual(queue.run_job('test', "{not json", handler=lambda x: 0), None)
+        self.assertEqual(len(self.rcon.execs), 1)
+        self.assertEqual(self.rdx.llen('work_test'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+tests.test_xcode
+Per-job transcode state
+
+@author   Jacob Hipps <jacob@ycnrg.org>
+@repo     https://git.ycnrg.org/projects/YXB/repos/yc_xbake
+
+Copyright (c) 2013-2017 J. Hipps / Neo-Retro Group, Inc.
+https://ycnrg.org/
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import timedelta
+
+from xbake.xcode import xcode, ffmpeg
+from xbake.srv import queue
+from tests import get_config
+
+
+def mkv_info():
+    """return Matroska info (as from xcode.getMatroska()) for a file with 5.1 AC3 audio and ASS subs"""
+    return {
+             'info': {'duration': timedelta(seconds=1420)},
+             'chapters': [],
+             'audio_tracks': [{'number': 2, 'codec_id': 'A_AC3', 'name': "Surround", 'channels': 6, 'language': "jpn", 'default': True}],
+             'subtitle_tracks': [{'number': 3, 'codec_id': 'S_TEXT/ASS', 'name': "Subs", 'language': "eng", 'default': True}]
+           }
+
+
+class TestTranscodeJob(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp(prefix="xbake_test_")
+        self.infile = self.tdir + "/episode.mkv"
+        with open(self.infile, 'w') as f:
+            f.write("\x1a\x45\xdf\xa3")
+        self.runs = []
+        self.saved = (xcode.getMatroska, ffmpeg.run)
+        xcode.getMatroska = lambda vfile: mkv_info()
+        ffmpeg.run = lambda optlist, supout=False, stats=None: self.runs.append(list(optlist))
+
+    def tearDown(self):
+        xcode.getMatroska, ffmpeg.run = self.saved
+        shutil.rmtree(self.tdir, ignore_errors=True)
+
+    def test_back_to_back(self):
+        """two transcodes in one process build identical ffmpeg command lines"""
+        xconfig = get_config({'xcode': {'scale': "1280:720", 'threads': 2}})
+        for i in range(2):
+            xcode.transcode(xcode.TranscodeJob(xconfig), self.infile, self.tdir + "/out.mp4")
+        self.assertEqual(len(self.runs), 2)
+        self.assertEqual(self.runs[0], self.runs[1])
+        self.assertEqual(self.runs[0].count('-c:a:1'), 1)
+        self.assertEqual(self.runs[0].count('-ac'), 1)
+
+    def test_job_config(self):
+        """options from a job's own config are not carried over to the next job"""
+        xcode.transcode(xcode.TranscodeJob(get_config({'xcode': {'anamorphic': True}})), self.infile, self.tdir + "/out.mp4")
+        xcode.transcode(xcode.TranscodeJob(get_config()), self.infile, self.tdir + "/out.mp4")
+        self.assertIn('-aspect', self.runs[0])
+        self.assertNotIn('-aspect', self.runs[1])
+
+
+class FakeMongo(object):
+    """stand-in for db.mongo; @onfind is called on each lookup"""
+    def __init__(self, onfind):
+        self.onfind = onfind
+
+    def findOne(self, collection, query):
+        self.onfind()
+        return {'location': {'node1': {'fpath': {'file': "episode.mkv"}}},
+                'mediainfo': {'video': [{'width': 1920, 'height': 1080, 'display_aspect_ratio': "16:9"}], 'menu': []}}
+
+    def update_set(self, collection, monid, setter):
+        return None
+
+
+class TestJobConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (queue.jobconf, queue.mdx, xcode.run)
+        self.confs = []
+        xcode.run = self.confs.append
+
+    def tearDown(self):
+        queue.jobconf, queue.mdx, xcode.run = self.saved
+
+    def test_reload_during_job(self):
+        """a config reload while cb_xcode runs does not affect that job"""
+        gen1 = get_config({'xcode': {'crf': 20, 'cache_dir': None}})
+        gen2 = get_config({'xcode': {'crf': 30}})
+        queue.jobconf = (gen1, {}, {'720p': {'height': "720", 'crf': "22"}})
+
+        def reload_config():
+            queue.jobconf = (gen2, {}, {'720p': {'height': "480", 'crf': "28"}})
+
+        queue.mdx = FakeMongo(reload_config)
+        queue.cb_xcode({'id': 1, 'fid': "f1", 'opts': {'profile': "720p", 'realpath': "/x/episode.mkv", 'basefile': "episode",
+                                                      'location': "node1", 'no_subs': True, 'vscap': -1}})
+        self.assertEqual(len(self.confs), 1)
+        self.assertEqual(self.confs[0].xcode['crf'], 22)
+        self.assertEqual(self.confs[0].xcode['scale'], "1280:720")
+        self.assertEqual(self.confs[0].core['loglevel'], gen1.core['loglevel'])
+
+
+if __name__ == '__main__':
+    unittest.main()
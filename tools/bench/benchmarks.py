@@ -0,0 +1,668 @@
+#!/usr/bin/env python
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+tools/bench/benchmarks.py
+XBake benchmarks; run with tools/bench/run.py
+
+Each benchmark only uses the API of the tree it is run against. Use `run.py --ref=REV`
+to run the same benchmark against an earlier revision (from git) for comparison
+
+@author   Jacob Hipps <jacob@ycnrg.org>
+@repo     https://git.ycnrg.org/projects/YXB/repos/yc_xbake
+
+Copyright (c) 2013-2017 J. Hipps / Neo-Retro Group, Inc.
+https://ycnrg.org/
+
+"""
+
+from __future__ import print_function
+
+import json
+import time
+
+from xbake.common.logthis import *
+
+
+def show_results(title, rows, unit):
+    """
+    print a list of (label, value) result @rows
+    """
+    print("")
+    print("** %s" % (title))
+    for tlabel, tval in rows:
+        print("   {:32} {:>14.2f} {}".format(tlabel, tval, unit))
+    print("")
+
+
+
+##############################################################################
+## Queue runner
+
+def _noop_job(jdata):
+    """queue handler that only passes the job along to the next queue"""
+    from xbake.srv import queue
+    queue.enqueue('bench_next', jdata['id'], jdata['fid'], jdata['opts'], silent=True)
+    return 0
+
+def bench_queue(xconfig, count):
+    """
+    Throughput of empty no-op jobs through queue.run_job()
+    """
+    from xbake.common import db
+    from xbake.srv import queue
+
+    jcount = (count or 10000)
+    rdx = db.redis({'host': xconfig.redis['host'], 'port': xconfig.redis['port'], 'db': xconfig.redis['db']},
+                   prefix=xconfig.redis['prefix'] + "_bench", silence=True)
+    queue.rdx = rdx
+    queue.config = xconfig
+    queue.runner_id = "bench:0"
+    queue.leaser = queue.LeaseKeeper(rdx, int(xconfig.srv['lease_ttl']))
+
+    def qclear():
+        for tq in ('queue_bench', 'work_bench', 'queue_bench_next', 'jobstatus'):
+            rdx.delete(tq)
+
+    qclear()
+    rdx.makepipe(transaction=False)
+    for jid in range(jcount):
+        rdx.lpush('queue_bench', json.dumps({'id': jid, 'fid': None, 'opts': {}}), usepipe=True)
+    rdx.execpipe()
+
+    t_start = time.time()
+    for jid in range(jcount):
+        queue.run_job('bench', rdx.brpoplpush('queue_bench', 'work_bench', 1), handler=_noop_job)
+    t_total = time.time() - t_start
+
+    if rdx.llen('queue_bench_next') != jcount:
+        logthis("Job count mismatch in output queue:", suffix=rdx.llen('queue_bench_next'), loglevel=LL.WARNING)
+    results = [("run_job", float(jcount) / t_total)]
+
+    qclear()
+    show_results("Queue runner throughput (%d no-op jobs)" % (jcount), results, "jobs/s")
+    return dict(results)
+
+
+##############################################################################
+## Segmented encode
+
+def bench_segments(xconfig, count):
+    """
+    Wall-clock time of a single-process encode vs. a segmented encode of a generated
+    test clip (length in seconds set by --count), using the current xcode options
+    """
+    import multiprocessing
+    import shutil
+    import tempfile
+    from datetime import timedelta
+    from xbake.xcode import ffmpeg, xcode
+
+    clen = (count or 120)
+    nsegs = int(xconfig.xcode['segments'] or 0) or max(2, multiprocessing.cpu_count())
+    ffmpeg.bpath.ffpath = ffmpeg.locate('ffmpeg')
+
+    tdir = tempfile.mkdtemp(prefix="xbake_bench_")
+    try:
+        srcfile = tdir + "/source.mkv"
+        logthis("Generating %ds test clip:" % (clen), suffix=srcfile, loglevel=LL.INFO)
+        ffmpeg.run(['-y', '-f', 'lavfi', '-i', "testsrc2=size=1280x720:rate=24000/1001", '-f', 'lavfi', '-i', "sine=frequency=440",
+                    '-t', str(clen), '-c:v', 'libx264', '-preset:v', 'ultrafast', '-c:a', 'flac', srcfile], True)
+
+        vencopts = ['-c:v', 'libx264', '-crf', str(xconfig.xcode['crf']), '-preset:v', xconfig.xcode['libx264_preset']]
+        aencopts = ['-c:a', 'aac', '-b:a', '%dk' % int(xconfig.xcode['abr'])]
+
+        t_start = time.time()
+        ffmpeg.run(['-y', '-i', srcfile] + vencopts + aencopts + ['-movflags', '+faststart', tdir + "/single.mp4"], True)
+        t_single = time.time() - t_start
+
+        bounds = xcode.segment_bounds({'info': {'duration': timedelta(seconds=clen)}, 'chapters': []}, nsegs)
+        xencode = xcode.encode_segments(srcfile, tdir + "/segmented.mp4", bounds, [], False, vencopts, aencopts,
+                                        int(xconfig.xcode['segment_procs']), True)
+        t_seg = xencode['total_time']
+    finally:
+        shutil.rmtree(tdir, ignore_errors=True)
+
+    results = [('single process', t_single), ('segmented (%d segments)' % (nsegs), t_seg)]
+    show_results("Encode wall-clock time (%ds clip, preset %s)" % (clen, xconfig.xcode['libx264_preset']), results, "s")
+    print("   speedup: %.2fx\n" % (t_single / t_seg))
+    return dict(results + [('speedup', t_single / t_seg)])
+
+
+##############################################################################
+## Multi-rendition encode
+
+def bench_renditions(xconfig, count):
+    """
+    Wall-clock time to produce 1080p, 720p, and 480p renditions of a generated test clip
+    (length in seconds set by --count), as three separate encodes vs. a single decode
+    with a split filter graph
+    """
+    import shutil
+    import tempfile
+    from xbake.xcode import ffmpeg, xcode
+
+    clen = (count or 60)
+    ffmpeg.bpath.ffpath = ffmpeg.locate('ffmpeg')
+    preset = xconfig.xcode['libx264_preset']
+
+    tdir = tempfile.mkdtemp(prefix="xbake_bench_")
+    try:
+        srcfile = tdir + "/source.mkv"
+        logthis("Generating %ds test clip:" % (clen), suffix=srcfile, loglevel=LL.INFO)
+        ffmpeg.run(['-y', '-f', 'lavfi', '-i', "testsrc2=size=1920x1080:rate=24000/1001", '-f', 'lavfi', '-i', "sine=frequency=440",
+                    '-t', str(clen), '-c:v', 'libx264', '-preset:v', 'ultrafast', '-c:a', 'aac', srcfile], True)
+
+        renditions = [{'name': "1080p", 'scale': None, 'crf': 24, 'abr': 192},
+                      {'name': "720p", 'scale': "1280:720", 'crf': 24, 'abr': 192},
+                      {'name': "480p", 'scale': "854:480", 'crf': 20, 'abr': 128}]
+        for trend in renditions:
+            trend['outfile'] = tdir + "/%s.mp4" % (trend['name'])
+
+        t_start = time.time()
+        for trend in renditions:
+            ffmpeg.run(['-y', '-i', srcfile] + (['-vf', "scale=" + trend['scale']] if trend['scale'] else []) +
+                       ['-c:v', 'libx264', '-crf', str(trend['crf']), '-preset:v', preset, '-c:a', 'copy',
+                        '-movflags', '+faststart', trend['outfile']], True)
+        t_separate = time.time() - t_start
+
+        t_start = time.time()
+        ffmpeg.run(xcode.build_renditions(srcfile, renditions, [], preset, 1, acopy=True), True)
+        t_single = time.time() - t_start
+    finally:
+        shutil.rmtree(tdir, ignore_errors=True)
+
+    results = [('separate encodes', t_separate), ('single decode', t_single)]
+    show_results("Wall-clock time for 3 renditions (%ds clip, preset %s)" % (clen, preset), results, "s")
+    print("   speedup: %.2fx\n" % (t_separate / t_single))
+    return dict(results + [('speedup', t_separate / t_single)])
+
+
+##############################################################################
+## CLI startup
+
+def bench_startup(xconfig, count):
+    """
+    Wall-clock time to start the CLI and run --help, --set, and --scan -S on a tiny file
+    (mean of --count runs), along with the time to import every subsystem, as the
+    CLI did before modules were loaded per mode
+    """
+    import os
+    import sys
+    import shutil
+    import tempfile
+    import subprocess
+
+    rcount = (count or 5)
+    tdir = tempfile.mkdtemp(prefix="xbake_bench_")
+    try:
+        tfile = tdir + "/tiny.mkv"
+        with open(tfile, 'w') as f:
+            f.write("\x1a\x45\xdf\xa3")
+
+        clirun = [sys.executable, '-c', "from xbake.cli import _main; _main()"]
+        tests = [
+                  ('import all subsystems', [sys.executable, '-c', "import xbake.xcode.xcode, xbake.xcode.ssonly, xbake.mscan.mscan, "
+                                                                    "xbake.mscan.scrapers, xbake.srv.daemon, xbake.ascan"]),
+                  ('--help', clirun + ['--help']),
+                  ('--set', clirun + ['--set', '--series', "Bench", tfile]),
+                  ('--scan -S', clirun + ['--scan', '-S', '-X', tfile])
+                ]
+
+        results = []
+        with open(os.devnull, 'w') as fnull:
+            for tlabel, tcmd in tests:
+                t_start = time.time()
+                for i in range(rcount):
+                    subprocess.call(tcmd, stdout=fnull, stderr=fnull, cwd=tdir)
+                results.append((tlabel, (time.time() - t_start) * 1000.0 / rcount))
+    finally:
+        shutil.rmtree(tdir, ignore_errors=True)
+
+    show_results("CLI startup wall-clock time (mean of %d runs)" % (rcount), results, "ms")
+    return dict(results)
+
+
+##############################################################################
+## Config access
+
+def clone_with(xconfig, xover):
+    """
+    return a clone of @xconfig with overrides @xover ({section: {key: value}}); trees where
+    _clone() takes no overrides have them set on the copy instead
+    """
+    try:
+        return xconfig._clone(xover)
+    except TypeError:
+        tnew = xconfig._clone()
+        for tsec in xover:
+            for tkey in xover[tsec]:
+                tnew[tsec][tkey] = xover[tsec][tkey]
+        return tnew
+
+def bench_config(xconfig, count):
+    """
+    Time for 1M config value lookups (eg. config.scan['tempdir']) and 10k per-job clones
+    with overrides (as in cb_xcode)
+    """
+    acount = (count or 1000000)
+    ccount = max(acount // 100, 1)
+    xover = {'run': {'infile': "/tmp/in.mkv", 'outfile': "/tmp/out.mp4", 'bake': True},
+             'vid': {'vername': "720p"}, 'xcode': {'crf': 24, 'abr': 192, 'scale': "1280:720"}}
+
+    t_start = time.time()
+    for i in xrange(acount):
+        xconfig.scan['tempdir']
+    results = [("%d lookups" % (acount), time.time() - t_start)]
+
+    t_start = time.time()
+    for i in xrange(ccount):
+        clone_with(xconfig, xover)
+    results.append(("%d clones" % (ccount), time.time() - t_start))
+
+    show_results("Config access time", results, "s")
+    return dict(results)
+
+
+##############################################################################
+## Media info
+
+def bench_mediainfo(xconfig, count):
+    """
+    Files per second parsed by util.mediainfo() from --count small generated WAV files,
+    with pymediainfo vs. the native libmediainfo engine
+    """
+    import os
+    import wave
+    import shutil
+    import tempfile
+    from xbake.mscan import util, milib
+
+    fcount = (count or 5000)
+    tdir = tempfile.mkdtemp(prefix="xbake_bench_")
+    try:
+        flist = []
+        for i in xrange(fcount):
+            tfile = "%s/%05d.wav" % (tdir, i)
+            tw = wave.open(tfile, 'wb')
+            tw.setparams((1 + (i % 2), 2, 8000, 0, 'NONE', 'not compressed'))
+            tw.writeframes("\x00\x00" * 800 * (1 + (i % 2)))
+            tw.close()
+            flist.append(tfile)
+
+        results = []
+        for tengine in ('pymediainfo', 'native'):
+            if tengine == 'native' and not milib.load():
+                logthis("libmediainfo not available; skipping engine:", suffix=tengine, loglevel=LL.WARNING)
+                continue
+            elif tengine == 'pymediainfo':
+                try:
+                    import pymediainfo  # pylint: disable=unused-variable
+                except ImportError:
+                    logthis("pymediainfo not installed; skipping engine:", suffix=tengine, loglevel=LL.WARNING)
+                    continue
+            tconf = xconfig._clone({'scan': {'mediainfo_engine': "pymediainfo" if tengine == 'pymediainfo' else "auto"}})
+            t_start = time.time()
+            for tfile in flist:
+                util.mediainfo(tfile, tconf)
+            results.append(("%s (%d files)" % (tengine, fcount), fcount / (time.time() - t_start)))
+    finally:
+        shutil.rmtree(tdir, ignore_errors=True)
+
+    show_results("Media info throughput", results, "files/s")
+    return dict(results)
+
+def _mi_dump(i):
+    """return a synthetic mediainfo track dump (as from pymediainfo's to_data()['tracks']) for an episode"""
+    xtra = dict([("other_%02d" % (x), "Lorem ipsum %d" % (x)) for x in range(40)])
+    tracks = [
+               dict(xtra, track_type='General', unique_id=189340893447298723498 + i, format="Matroska", duration=1420523 + i,
+                    overall_bit_rate=2543011, encoded_date="UTC 2017-03-04 12:34:56", writing_application="mkvmerge v9.8.0",
+                    writing_library="libebml v1.3.4 + libmatroska v1.4.5", title="Episode %d" % (i)),
+               dict(xtra, track_type='Video', id=1, format="AVC", format_profile="High@L4", codec_id="V_MPEG4/ISO/AVC",
+                    duration="00:23:40.523000000", width=1920, height=1080, display_aspect_ratio="16:9", frame_rate="23.976",
+                    color_space="YUV", chroma_subsampling="4:2:0", bit_depth=8, scan_type="Progressive",
+                    encoding_settings="cabac=1 / ref=4 / deblock=1:1:1", default="Yes", forced="No"),
+             ]
+    for tlang in ("ja", "en"):
+        tracks.append(dict(xtra, track_type='Audio', id=len(tracks), format="AAC", codec_id="A_AAC", duration=1420523,
+                           channel_s=2, sampling_rate=48000, language=tlang.upper(), title="Stereo", default="Yes", forced="No"))
+        tracks.append(dict(xtra, track_type='Text', id=len(tracks), format="ASS", codec_id="S_TEXT/ASS", language=tlang.upper(),
+                           title="Subtitles", default="No", forced="No"))
+    tracks.append(dict([("00_%02d_%02d%03d" % (x * 2, x % 60, x), "en:Chapter %d" % (x + 1)) for x in range(12)], track_type='Menu'))
+    return tracks
+
+class _DumpInfo(object):
+    """stand-in for pymediainfo.MediaInfo, which returns a given track dump instead of running mediainfo"""
+    dump = None
+
+    @classmethod
+    def parse(cls, fname):
+        return cls()
+
+    def to_data(self):
+        return {'tracks': self.dump}
+
+def bench_milut(xconfig, count):
+    """
+    Time to parse --count synthetic mediainfo track dumps with util.mediainfo(); pymediainfo
+    is replaced with a stand-in that returns the dump, so that only parsing is timed
+    """
+    import sys
+    import types
+
+    tmod = types.ModuleType('pymediainfo')
+    tmod.MediaInfo = _DumpInfo
+    sys.modules['pymediainfo'] = tmod
+    from xbake.mscan import util
+    util.MediaInfo = _DumpInfo
+
+    dcount = (count or 20000)
+    corpus = [_mi_dump(i) for i in xrange(min(dcount, 100))]
+    tconf = clone_with(xconfig, {'scan': {'mediainfo_engine': "pymediainfo", 'workaround_mediainfo_bugs': False}})
+
+    t_start = time.time()
+    for i in xrange(dcount):
+        _DumpInfo.dump = corpus[i % len(corpus)]
+        util.mediainfo("bench.mkv", tconf, bool(i % 2))
+    results = [("%d dumps" % (dcount), time.time() - t_start)]
+
+    show_results("Mediainfo track dump parse time", results, "s")
+    return dict(results)
+
+def bench_aprobe(xconfig, count):
+    """
+    Files per second scanned by ascan.scanfile() from a library of --count generated
+    FLAC & MP3 files, probing with mediainfo vs. Mutagen alone
+    """
+    import shutil
+    import tempfile
+    from xbake import ascan
+    from xbake.xcode import ffmpeg
+
+    fcount = (count or 1000)
+    ffmpeg.bpath.ffpath = ffmpeg.locate('ffmpeg')
+
+    tdir = tempfile.mkdtemp(prefix="xbake_bench_")
+    try:
+        logthis("Generating %d audio files in" % (fcount), suffix=tdir, loglevel=LL.INFO)
+        tsrc = []
+        for tcodec, text in (('flac', "flac"), ('libmp3lame', "mp3")):
+            tfile = tdir + "/source." + text
+            ffmpeg.run(['-y', '-f', 'lavfi', '-i', "sine=frequency=440", '-t', "2", '-c:a', tcodec,
+                        '-metadata', "title=Bench", '-metadata', "artist=XBake", '-metadata', "album=Bench", tfile], True)
+            tsrc.append((tfile, text))
+
+        flist = []
+        for i in xrange(fcount):
+            tfile, text = tsrc[i % len(tsrc)]
+            flist.append(u"%s/%05d.%s" % (tdir, i, text))
+            shutil.copyfile(tfile, flist[-1])
+
+        results = []
+        for tprobe in ('mediainfo', 'mutagen'):
+            ascan.config = xconfig._clone({'scan': {'audio_probe': "mediainfo" if tprobe == 'mediainfo' else "auto"}})
+            t_start = time.time()
+            for tfile in flist:
+                ascan.scanfile(tfile)
+            results.append(("%s (%d files)" % (tprobe, fcount), fcount / (time.time() - t_start)))
+    finally:
+        shutil.rmtree(tdir, ignore_errors=True)
+
+    show_results("Audio scan throughput", results, "files/s")
+    return dict(results)
+
+##############################################################################
+## CUE sheets
+
+def _cue_disc(i):
+    """return (CUE sheet text, master track record) for synthetic disc image @i"""
+    ctext = u'REM GENRE "Soundtrack"\nREM DATE 2017\nPERFORMER "Artist %d"\nTITLE "Album %d"\nFILE "Disc %d.flac" WAVE\n' % (i, i, i)
+    for t in range(1, 13):
+        ctext += u'  TRACK %02d AUDIO\n    TITLE "Track %d"\n    PERFORMER "Artist %d"\n    INDEX 01 %02d:00:00\n' % (t, t, i, (t - 1) * 4)
+    master = {
+               'dpath': {'base': "Album %d" % (i), 'parent': "Artist %d" % (i), 'full': "/music/Artist %d/Album %d" % (i, i)},
+               'fpath': {'real': "/music/Artist %d/Album %d/Disc %d.flac" % (i, i, i), 'base': "Disc %d" % (i), 'file': "Disc %d.flac" % (i), 'ext': "flac"},
+               'stat': {'ino': 1000 + i, 'size': 300000000, 'mtime': 1500000000.0, 'uid': 1000, 'gid': 1000, 'perms': "0644"},
+               'owner': {'user': "music", 'group': "music"},
+               'mkey_id': "%032x" % (i),
+               'status': "new",
+               'subsong': {'index': 1, 'start_time': 0.0, 'duration': None, 'cue': None},
+               'tags': {'artist': "Artist %d" % (i), 'album': "Album %d" % (i), 'title': None, 'year': "2017", 'timestamp': 1483228800,
+                        'genre': "Soundtrack", 'tracknum': None, 'trackstr': None, 'disc': "1", 'album_artist': "Artist %d" % (i)},
+               'alltags': dict([("TAG%02d" % (x), u"Value %d" % (x) * 8) for x in range(40)]),
+               'format': {'format': "FLAC", 'probe': "mutagen", 'mime': "audio/flac", 'channels': 2, 'sampling_rate': 44100,
+                          'bitrate': 900000, 'bit_depth': 16, 'length': 2880.0, 'encoding_settings': None, 'writing_library': "libFLAC 1.3.2"},
+               'last_updated': 1500000000
+             }
+    return (ctext, master)
+
+def _cue_run(dcount, resq):
+    """
+    parse CUE sheets & clone subsongs for @dcount discs, keeping all subsongs;
+    puts (time, RSS growth in KiB) on @resq, or the exception if it failed
+    """
+    import codecs
+    import shutil
+    import tempfile
+    try:
+        from xbake import ascan
+    except Exception as e:
+        resq.put(e)
+        return
+
+    def get_rss():
+        with open('/proc/self/status') as f:
+            for tline in f:
+                if tline.startswith('VmRSS:'):
+                    return int(tline.split()[1])
+        return 0
+
+    tdir = tempfile.mkdtemp(prefix="xbake_bench_")
+    try:
+        discs = []
+        for i in xrange(dcount):
+            ctext, master = _cue_disc(i)
+            cpath = "%s/%05d.cue" % (tdir, i)
+            with codecs.open(cpath, 'w', 'utf-8') as f:
+                f.write(ctext)
+            discs.append((cpath, master))
+
+        rss_start = get_rss()
+        t_start = time.time()
+        subsongs = []
+        for cpath, master in discs:
+            cue = ascan.parse_cue_file(cpath)
+            for ssindex, ssdata in sorted(cue['tracks'].items()):
+                subsongs.append(ascan.clone_master_track(master, ssdata, ssindex, 240.0))
+        resq.put((time.time() - t_start, get_rss() - rss_start))
+    except Exception as e:
+        resq.put(e)
+    finally:
+        shutil.rmtree(tdir, ignore_errors=True)
+
+def bench_cue(xconfig, count):
+    """
+    Time and memory (RSS growth) to parse CUE sheets with ascan.parse_cue_file() and build
+    subsong records for --count synthetic 12-track disc images
+    Run in a separate process, so that memory use can be measured
+    """
+    import multiprocessing
+
+    dcount = (count or 1000)
+    resq = multiprocessing.Queue()
+    tproc = multiprocessing.Process(target=_cue_run, args=(dcount, resq))
+    tproc.start()
+    tres = resq.get()
+    tproc.join()
+    if isinstance(tres, Exception):
+        raise tres
+    ttime, tmem = tres
+    results = [("time (%d discs)" % (dcount), ttime), ("memory (%d discs)" % (dcount), tmem / 1024.0)]
+
+    print("")
+    print("** CUE sheet parsing & subsong records")
+    for tlabel, tval in results:
+        print("   {:32} {:>14.2f} {}".format(tlabel, tval, "MiB" if 'memory' in tlabel else "s"))
+    print("")
+    return dict(results)
+
+##############################################################################
+## Acoustic fingerprints
+
+def _afp_tones(seed, seconds=10.0):
+    """return (seeded) melody of random tones, as a list of float samples at afprint.FP_RATE"""
+    import math
+    import random
+    from xbake import afprint
+
+    trand = random.Random(seed)
+    samples = []
+    while len(samples) < seconds * afprint.FP_RATE:
+        tfreqs = [afprint.FP_NOTES[trand.randrange(len(afprint.FP_NOTES))] for x in range(trand.choice((1, 2, 3)))]
+        for n in range(int(trand.uniform(0.25, 0.75) * afprint.FP_RATE)):
+            samples.append(sum([math.sin(2.0 * math.pi * f * n / afprint.FP_RATE) for f in tfreqs]) * 8000.0 / len(tfreqs))
+    return samples
+
+def bench_afprint(xconfig, count):
+    """
+    Fingerprint --count generated tracks (random melodies, 10 seconds each); half of them
+    are duplicates of the others, with a different gain, added noise, and a start offset of up to
+    one frame. Then find duplicates with a pairwise comparison of every track vs. the LSH index
+    used by afprint.find_duplicates(), and report how many duplicates each one found
+    """
+    import array
+    import random
+    from xbake import afprint
+
+    tcount = (count or 200) // 2
+    trand = random.Random(1)
+    tracks = {}
+    for i in range(tcount):
+        tmelody = _afp_tones(i)
+        tracks['orig%04d' % (i)] = array.array('h', [int(x) for x in tmelody])
+        tgain = trand.uniform(0.5, 1.5)
+        tshift = trand.randrange(afprint.FP_FRAME)
+        tracks['dupe%04d' % (i)] = array.array('h', [max(-32768, min(32767, int(x * tgain + trand.gauss(0, 800))))
+                                                     for x in tmelody[tshift:]])
+
+    t_start = time.time()
+    fprints = dict([(k, afprint.fingerprint_samples(v)) for k, v in tracks.items()])
+    t_fprint = time.time() - t_start
+
+    # pairwise comparison
+    t_start = time.time()
+    codes = dict([(k, afprint.unpack(v)) for k, v in fprints.items()])
+    tkeys = sorted(codes)
+    brute = set()
+    for i, ka in enumerate(tkeys):
+        for kb in tkeys[i + 1:]:
+            if afprint.similarity(codes[ka], codes[kb]) >= afprint.FP_THRESHOLD:
+                brute.add((ka, kb))
+    t_brute = time.time() - t_start
+
+    t_start = time.time()
+    dupes = afprint.find_duplicates(fprints)
+    t_lsh = time.time() - t_start
+
+    expected = set([('dupe%04d' % (i), 'orig%04d' % (i)) for i in range(tcount)])
+    found = set([(x[0], x[1]) for x in dupes if len(x) == 2])
+    results = [
+                ("fingerprint (%d tracks)" % (len(tracks)), t_fprint),
+                ("pairwise: time", t_brute),
+                ("pairwise: duplicates found", len(brute & expected)),
+                ("pairwise: false matches", len(brute - expected)),
+                ("lsh: time", t_lsh),
+                ("lsh: duplicates found", len(found & expected)),
+                ("lsh: false matches", sum([len(x) for x in dupes]) - 2 * len(found & expected))
+              ]
+
+    print("")
+    print("** Acoustic fingerprints & duplicate detection (numpy: %s)" % ("yes" if afprint.numpy is not None else "no"))
+    for tlabel, tval in results:
+        if 'time' in tlabel or 'fingerprint' in tlabel:
+            print("   {:32} {:>14.2f} s".format(tlabel, tval))
+        else:
+            print("   {:32} {:>11d} of {}".format(tlabel, tval, tcount))
+    print("")
+    return dict(results)
+
+
+##############################################################################
+## Tag normalization
+
+def _tag_samples():
+    """return dict of tag format => tags of a typical ripped track (ID3, FLAC Vorbis comment, MP4)"""
+    import mutagen.id3
+    import mutagen.flac
+    import mutagen.mp4
+
+    tid3 = mutagen.id3.ID3()
+    for tframe, tval in (('TPE1', u"Artist"), ('TALB', u"Album"), ('TIT2', u"Title"), ('TCON', u"Soundtrack"),
+                         ('TRCK', u"03/12"), ('TPOS', u"1/2"), ('TDRC', u"2017-03-01"), ('TCOM', u"Composer"),
+                         ('TPUB', u"Label"), ('TSSE', u"LAME 3.99.5"), ('TENC', u"Encoder")):
+        tid3.add(getattr(mutagen.id3, tframe)(encoding=3, text=[tval]))
+    for tdesc in (u"ALBUM ARTIST", u"CATALOGNUMBER", u"BARCODE", u"MusicBrainz Album Id", u"MusicBrainz Artist Id",
+                  u"MusicBrainz Release Group Id", u"REPLAYGAIN_TRACK_GAIN", u"REPLAYGAIN_ALBUM_GAIN"):
+        tid3.add(mutagen.id3.TXXX(encoding=3, desc=tdesc, text=[u"Value of " + tdesc]))
+    tid3.add(mutagen.id3.COMM(encoding=3, lang='eng', desc=u"", text=[u"Comment"]))
+    tid3.add(mutagen.id3.APIC(encoding=3, mime='image/jpeg', type=3, desc=u"", data='\xff\xd8' * 4096))
+
+    tvc = mutagen.flac.VCFLACDict()
+    for tkey, tval in (('TITLE', u"Title"), ('ARTIST', u"Artist"), ('ALBUM', u"Album"), ('ALBUMARTIST', u"Artist"),
+                       ('GENRE', u"Soundtrack"), ('DATE', u"2017-03-01"), ('TRACKNUMBER', u"3"), ('TRACKTOTAL', u"12"),
+                       ('DISCNUMBER', u"1"), ('DISCTOTAL', u"2"), ('COMPOSER', u"Composer"), ('LABEL', u"Label"),
+                       ('CATALOGNUMBER', u"CAT-001"), ('BARCODE', u"0123456789012"), ('ISRC', u"JPXX01700001"),
+                       ('MUSICBRAINZ_ALBUMID', u"id"), ('MUSICBRAINZ_ARTISTID', u"id"), ('MUSICBRAINZ_TRACKID', u"id"),
+                       ('REPLAYGAIN_TRACK_GAIN', u"-6.00 dB"), ('REPLAYGAIN_ALBUM_GAIN', u"-6.00 dB"), ('COMMENT', u"Comment")):
+        tvc.append((tkey, tval))
+
+    tmp4 = mutagen.mp4.MP4Tags()
+    for tkey, tval in (('\xa9nam', u"Title"), ('\xa9ART', u"Artist"), ('\xa9alb', u"Album"), ('aART', u"Artist"),
+                       ('\xa9gen', u"Soundtrack"), ('\xa9day', u"2017-03-01"), ('\xa9wrt', u"Composer"), ('\xa9too', u"iTunes"),
+                       ('\xa9cmt', u"Comment"), ('cprt', u"Label")):
+        tmp4[tkey] = [tval]
+    tmp4['trkn'] = [(3, 12)]
+    tmp4['disk'] = [(1, 2)]
+    tmp4['covr'] = [mutagen.mp4.MP4Cover('\xff\xd8' * 4096)]
+    for tname in ("iTunNORM", "iTunSMPB", "CATALOGNUMBER", "BARCODE", "MusicBrainz Album Id"):
+        tmp4['----:com.apple.iTunes:' + tname] = [mutagen.mp4.MP4FreeForm("Value of " + tname)]
+
+    return {'id3': tid3, 'flac': tvc, 'mp4': tmp4}
+
+def bench_tags(xconfig, count):
+    """
+    Time to extract tags & alltags with ascan.normalize_tags() for --count tracks of each tag
+    format (ID3, FLAC, MP4); tags are built in memory, so that only tag extraction is timed
+    Trees without normalize_tags() are covered by the 'aprobe' benchmark only
+    """
+    from xbake import ascan
+
+    tcount = (count or 5000)
+    samples = _tag_samples()
+
+    results = []
+    for tfmt in ('id3', 'flac', 'mp4'):
+        t_start = time.time()
+        for i in xrange(tcount):
+            ascan.normalize_tags(samples[tfmt])
+        results.append(("%s: per track" % (tfmt), (time.time() - t_start) * 1000000.0 / tcount))
+
+    show_results("Tag extraction time (%d tracks per format)" % (tcount), results, "us")
+    return dict(results)
+
+# name => (function, description)
+benchmarks = {
+    'queue': (bench_queue, "Queue runner throughput of no-op jobs (requires Redis)"),
+    'segments': (bench_segments, "Single-process vs. segmented encode of a test clip (requires ffmpeg)"),
+    'renditions': (bench_renditions, "Three renditions as separate encodes vs. a single decode (requires ffmpeg)"),
+    'mediainfo': (bench_mediainfo, "util.mediainfo() throughput on small audio files, pymediainfo vs. libmediainfo"),
+    'milut': (bench_milut, "Mediainfo track dump parsing"),
+    'aprobe': (bench_aprobe, "ascan throughput on generated FLAC/MP3 files, mediainfo vs. Mutagen probing (requires ffmpeg)"),
+    'cue': (bench_cue, "CUE sheet parsing & subsong records for a disc image library"),
+    'tags': (bench_tags, "Tag extraction for ID3, FLAC, and MP4 tags"),
+    'afprint': (bench_afprint, "Acoustic fingerprinting of generated tones, and duplicate detection pairwise vs. LSH index"),
+    'config': (bench_config, "Config value lookups & per-job clones"),
+    'startup': (bench_startup, "CLI startup time for --help, --set, and --scan on a tiny file")
+}
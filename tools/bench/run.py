@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+tools/bench/run.py
+Run an XBake benchmark against this source tree, and optionally against
+an earlier git revision for comparison
+
+Usage: run.py NAME [-n COUNT] [-c CONFIG] [--ref=REV]
+
+@author   Jacob Hipps <jacob@ycnrg.org>
+@repo     https://git.ycnrg.org/projects/YXB/repos/yc_xbake
+
+Copyright (c) 2013-2017 J. Hipps / Neo-Retro Group, Inc.
+https://ycnrg.org/
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import shutil
+import tarfile
+import optparse
+import tempfile
+import subprocess
+from io import BytesIO
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_ROOT = os.path.dirname(os.path.dirname(BENCH_DIR))
+
+# exit status when the benchmark needs something the tree does not have
+RC_UNSUPPORTED = 3
+
+
+def parse_cli():
+    """parse command-line options"""
+    oparser = optparse.OptionParser(usage="%prog NAME [options]\n\nUse 'help' as NAME to list available benchmarks")
+    oparser.add_option('-n', '--count', action="store", dest="count", type="int", default=0, metavar="NUM",
+                       help="Number of iterations/items to use (default depends on benchmark)")
+    oparser.add_option('-c', '--config', action="store", dest="config", default=None, metavar="FILE",
+                       help="Load extra config file")
+    oparser.add_option('-r', '--ref', action="store", dest="ref", default=None, metavar="REV",
+                       help="Also run the benchmark against git revision REV, and compare the results")
+    oparser.add_option('-L', '--loglevel', action="store", dest="loglevel", type="int", default=None, metavar="LEVEL",
+                       help="Log level (as for xbake -L)")
+    oparser.add_option('--tree', action="store", dest="tree", default=REPO_ROOT, help=optparse.SUPPRESS_HELP)
+    oparser.add_option('--json', action="store", dest="json", default=None, help=optparse.SUPPRESS_HELP)
+
+    options, args = oparser.parse_args(sys.argv[1:])
+    if len(args) != 1:
+        oparser.error("Exactly one benchmark NAME is required")
+    return (args[0].lower(), options)
+
+def run_tree(bname, options):
+    """
+    run benchmark @bname against the xbake package in options.tree
+    returns exit status; results are written to options.json, if set
+    """
+    tree = os.path.realpath(options.tree)
+    sys.path.insert(0, tree)
+    os.environ['PYTHONPATH'] = os.pathsep.join([tree] + [x for x in [os.environ.get('PYTHONPATH')] if x])
+
+    from xbake.common import rcfile
+    from xbake.common.logthis import configure_logging, loglevel
+    import benchmarks
+
+    if bname == "help":
+        print("** Available benchmarks:\n")
+        for tname in sorted(benchmarks.benchmarks):
+            print("{:16} {}".format(tname, benchmarks.benchmarks[tname][1]))
+        print("")
+        return 0
+
+    if bname not in benchmarks.benchmarks:
+        print("No benchmark named '%s'. Use 'help' to list available benchmarks." % (bname), file=sys.stderr)
+        return 2
+
+    cliopts = {}
+    if options.loglevel is not None:
+        cliopts['core.loglevel'] = options.loglevel
+        loglevel(options.loglevel)
+    xconfig = rcfile.loadConfig(options.config, cliopts)
+    configure_logging(xconfig)
+
+    print("** Running benchmark '%s' against %s" % (bname, tree))
+    try:
+        bres = benchmarks.benchmarks[bname][0](xconfig, options.count)
+    except (ImportError, AttributeError) as e:
+        print("Benchmark '%s' is not supported by this tree: %s" % (bname, e), file=sys.stderr)
+        return RC_UNSUPPORTED
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(bres, f)
+    return 0
+
+def export_rev(rev, tdir):
+    """export the xbake package at git revision @rev into @tdir"""
+    try:
+        tarraw = subprocess.check_output(['git', 'archive', '--format=tar', rev, 'xbake'], cwd=REPO_ROOT)
+    except (subprocess.CalledProcessError, OSError) as e:
+        print("Failed to export revision '%s' with git: %s" % (rev, e), file=sys.stderr)
+        return False
+    with tarfile.open(fileobj=BytesIO(tarraw), mode='r') as tarf:
+        tarf.extractall(tdir)
+    return True
+
+def run_child(bname, options, tree, jfile):
+    """run benchmark @bname against @tree in a new process; returns results, or None if it failed"""
+    targs = [sys.executable, os.path.join(BENCH_DIR, 'run.py'), bname, '-n', str(options.count), '--tree', tree, '--json', jfile]
+    if options.config:
+        targs += ['-c', options.config]
+    if options.loglevel is not None:
+        targs += ['-L', str(options.loglevel)]
+    if subprocess.call(targs) != 0:
+        return None
+    with open(jfile) as f:
+        return json.load(f)
+
+def compare(bname, options):
+    """run benchmark @bname against revision options.ref and this tree, then print both sets of results"""
+    tdir = tempfile.mkdtemp(prefix="xbake_bench_")
+    try:
+        if not export_rev(options.ref, tdir):
+            return 1
+        rres = run_child(bname, options, tdir, os.path.join(tdir, 'ref.json'))
+        cres = run_child(bname, options, REPO_ROOT, os.path.join(tdir, 'current.json'))
+    finally:
+        shutil.rmtree(tdir, ignore_errors=True)
+
+    if cres is None:
+        return 1
+
+    print("** Benchmark '%s': %s vs. working tree" % (bname, options.ref))
+    print("   {:32} {:>14} {:>14} {:>9}".format("", options.ref[:14], "current", "change"))
+    for tlabel in sorted(set(cres) | set(rres or {})):
+        rval = (rres or {}).get(tlabel)
+        cval = cres.get(tlabel)
+        if rval and cval is not None:
+            tchange = "{:+.1f}%".format((cval - rval) * 100.0 / rval)
+        else:
+            tchange = "-"
+        print("   {:32} {:>14} {:>14} {:>9}".format(tlabel, "-" if rval is None else "%.2f" % (rval),
+                                                     "-" if cval is None else "%.2f" % (cval), tchange))
+    print("")
+    return 0
+
+def _main():
+    """entry point"""
+    bname, options = parse_cli()
+    if options.ref and bname != "help":
+        sys.exit(compare(bname, options))
+    sys.exit(run_tree(bname, options))
+
+
+if __name__ == '__main__':
+    _main()
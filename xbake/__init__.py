@@ -36,7 +36,8 @@ defaults = {
                     'noupdate': False
                 },
                 'core': {
-                    'loglevel': LL.INFO
+                    'loglevel': LL.INFO,
+                    'toolcache': "~/.cache/xbake/toolcache.json"
                 },
                 'vid': {
                     'autoid': 1,
@@ -50,13 +51,17 @@ defaults = {
                     'nothumbs': False
                 },
                 'mongo': {
-                    'uri': "mongodb://localhost:27017/ycplay"
+                    'uri': "mongodb://localhost:27017/ycplay",
+                    'pool_size': 10,
+                    'timeout': 10
                 },
                 'redis': {
                     'host': "localhost",
                     'port': 6379,
                     'db': 6,
-                    'prefix': "xbake"
+                    'prefix': "xbake",
+                    'pool_size': 10,
+                    'timeout': 10
                 },
                 'xcode': {
                     'subtype': "ass",
@@ -68,12 +73,24 @@ defaults = {
                     'srt_style': "FontName=MyriadPro-Semibold,Outline=1,Shadow=1,FontSize=24",
                     'fontdir': "~/.fonts",
                     'fontsave': False,
+                    'fontcache': "~/.cache/xbake/fontcache",
                     'scale': None,
                     'flv': False,
                     'anamorphic': False,
                     'crf': 20,
                     'libx264_preset': "medium",
-                    'show_ffmpeg': True
+                    'show_ffmpeg': True,
+                    'segments': 0,
+                    'segment_procs': 0,
+                    'cache_dir': None,
+                    'cache_max_size': 0.0,
+                    'cache_max_age': 0,
+                    'renditions': None,
+                    'threads': 0,
+                    'tuning_file': "~/.cache/xbake/tuning.json",
+                    'tune_presets': "ultrafast,superfast,veryfast,faster,fast,medium,slow",
+                    'tune_length': 10,
+                    'tune_min_fps': 48.0
                 },
                 'scan': {
                     'scraper': "tvdb",
@@ -83,8 +100,16 @@ defaults = {
                     'output': None,
                     'follow_symlinks': True,
                     'workaround_mediainfo_bugs': True,
+                    'mediainfo_engine': "auto",
+                    'audio_probe': "auto",
+                    'mkey_store': None,
+                    'artwork_dir': None,
+                    'fingerprint': False,
+                    'fingerprint_length': 30,
+                    'audio_checksum': None,
                     'tempdir': "/tmp",
-                    'procs': 0
+                    'procs': 0,
+                    'root': None
                 },
                 'tvdb': {
                     'mirror': "http://thetvdb.com",
@@ -110,6 +135,11 @@ defaults = {
                     'xcode_outpath': '.',
                     'xcode_default_profile': None,
                     'xcode_scale_allowance': 10,
-                    'xcode_show_ffmpeg': False
+                    'xcode_show_ffmpeg': False,
+                    'lease_ttl': 60,
+                    'cluster': False,
+                    'node_id': None,
+                    'node_ttl': 30,
+                    'xcode_workers': 1
                 }
             }
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+xbake.afprint
+Acoustic fingerprinting & duplicate track detection
+
+@author   Jacob Hipps <jacob@ycnrg.org>
+@repo     https://git.ycnrg.org/projects/YXB/repos/yc_xbake
+
+Copyright (c) 2013-2017 J. Hipps / Neo-Retro Group, Inc.
+https://ycnrg.org/
+
+"""
+
+import math
+import array
+import subprocess
+from operator import mul
+from itertools import imap
+
+from xbake.common.logthis import *
+from xbake.xcode import ffmpeg
+
+# numpy is optional; without it, fingerprints are calculated (more slowly) in pure Python
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Sample rate & frame size (samples) of decoded audio
+FP_RATE = 3000
+FP_FRAME = 512
+
+# Note frequencies (C3 to B5); the energy of each note is summed into 12 pitch classes
+FP_NOTES = [130.8128 * 2.0 ** (x / 12.0) for x in range(36)]
+
+# Frames with a peak pitch class magnitude below this are silent
+FP_SILENCE = 50.0 * FP_FRAME
+
+# Max offset (in frames) between fingerprints when comparing
+FP_SHIFT = 2
+
+# LSH: number of consecutive frames per band, number of bands two tracks must share
+# to be compared, and max tracks per bucket (larger buckets are too common to be useful)
+FP_BAND = 2
+FP_MIN_BANDS = 8
+FP_MAX_BUCKET = 200
+
+# Minimum similarity for tracks to be considered duplicates
+FP_THRESHOLD = 0.85
+
+# DFT tables for each note; (cos, sin) lists, or a complex numpy array
+tables = None
+
+# set once the warning about fingerprinting without numpy has been logged
+numpy_warned = False
+
+
+def check_numpy():
+    """log a warning, once per process, if numpy is not installed (fingerprints are then much slower)"""
+    global numpy_warned
+    if numpy is None and not numpy_warned:
+        logthis("numpy is not installed; acoustic fingerprints will be calculated in pure Python, which is much slower "
+                "(install with `pip install numpy`)", loglevel=LL.WARNING)
+        numpy_warned = True
+
+def get_tables():
+    """return DFT tables (with a Hann window applied) for each note in FP_NOTES"""
+    global tables
+    if tables is None:
+        hann = [0.5 - 0.5 * math.cos(2.0 * math.pi * n / (FP_FRAME - 1)) for n in range(FP_FRAME)]
+        cw = [[hann[n] * math.cos(2.0 * math.pi * f * n / FP_RATE) for n in range(FP_FRAME)] for f in FP_NOTES]
+        sw = [[hann[n] * math.sin(2.0 * math.pi * f * n / FP_RATE) for n in range(FP_FRAME)] for f in FP_NOTES]
+        if numpy is not None:
+            tables = numpy.array(cw) - 1j * numpy.array(sw)
+        else:
+            tables = (cw, sw)
+    return tables
+
+def decode(fpath, offset=0.0, length=30.0):
+    """
+    decode @length seconds of audio from @fpath, starting at @offset, with ffmpeg
+    returns mono 16-bit samples at FP_RATE as an array, or None on failure
+    """
+    if not ffmpeg.bpath.ffpath:
+        ffmpeg.bpath.ffpath = ffmpeg.locate('ffmpeg', isFatal=False)
+        if not ffmpeg.bpath.ffpath:
+            return None
+    try:
+        raw = subprocess.check_output([ffmpeg.bpath.ffpath, '-v', 'error', '-ss', "%.3f" % (offset), '-t', "%.3f" % (length),
+                                       '-i', fpath, '-vn', '-ac', '1', '-ar', str(FP_RATE), '-f', 's16le', '-'])
+    except (subprocess.CalledProcessError, OSError) as e:
+        logthis("Failed to decode audio for fingerprint:", suffix=e, loglevel=LL.WARNING)
+        return None
+    samples = array.array('h')
+    samples.fromstring(raw[:len(raw) - (len(raw) % 2)])
+    return samples
+
+def get_chroma(samples):
+    """return list of 12-bin chroma vectors (one per frame) for @samples"""
+    nframes = len(samples) // FP_FRAME
+    if nframes < 1:
+        return []
+    ttab = get_tables()
+    if numpy is not None:
+        frames = numpy.asarray(samples[:nframes * FP_FRAME], dtype=float).reshape(nframes, FP_FRAME)
+        mags = numpy.abs(frames.dot(ttab.T))
+        return mags.reshape(nframes, 3, 12).sum(axis=1).tolist()
+
+    chroma = []
+    cw, sw = ttab
+    for i in range(nframes):
+        tframe = samples[i * FP_FRAME:(i + 1) * FP_FRAME]
+        mags = [math.hypot(sum(imap(mul, tframe, tc)), sum(imap(mul, tframe, ts))) for tc, ts in zip(cw, sw)]
+        chroma.append([mags[p] + mags[p + 12] + mags[p + 24] for p in range(12)])
+    return chroma
+
+def fingerprint_samples(samples):
+    """
+    calculate fingerprint of @samples (mono, FP_RATE)
+    Each frame is reduced to a 12-bit code; bit N is set if pitch class N is stronger than
+    the average of the frame. Returns codes as a hex string (3 characters per frame)
+    """
+    codes = []
+    for tch in get_chroma(samples):
+        if max(tch) < FP_SILENCE:
+            codes.append(0)
+            continue
+        tavg = sum(tch) / 12.0
+        codes.append(sum([1 << p for p in range(12) if tch[p] > tavg]))
+    return ''.join(['%03x' % (x) for x in codes])
+
+def fingerprint(fpath, offset=0.0, length=30.0):
+    """
+    calculate fingerprint of @length seconds of audio from @fpath, starting at @offset
+    returns None if the audio could not be decoded
+    """
+    check_numpy()
+    samples = decode(fpath, offset, length)
+    if samples is None:
+        return None
+    return fingerprint_samples(samples)
+
+def unpack(fp):
+    """return list of frame codes from fingerprint string @fp"""
+    return [int(fp[i:i + 3], 16) for i in range(0, len(fp) - 2, 3)]
+
+def similarity(acodes, bcodes):
+    """
+    return similarity (0.0 - 1.0) of frame codes @acodes and @bcodes; the proportion of
+    matching bits, at the best offset of up to FP_SHIFT frames
+    """
+    best = 0.0
+    for tshift in range(-FP_SHIFT, FP_SHIFT + 1):
+        pairs = zip(acodes[max(tshift, 0):], bcodes[max(-tshift, 0):])
+        if len(pairs) < FP_BAND:
+            continue
+        bits = sum([bin(x ^ y).count('1') for x, y in pairs])
+        best = max(best, 1.0 - float(bits) / (12 * len(pairs)))
+    return best
+
+def find_duplicates(fprints, threshold=FP_THRESHOLD):
+    """
+    find groups of duplicate tracks in @fprints (track key => fingerprint)
+    Tracks are indexed by every run of FP_BAND frame codes (LSH); only tracks sharing at
+    least FP_MIN_BANDS runs are compared, and those at least @threshold similar are merged
+    into groups (union-find). Returns a list of groups (sorted lists of track keys)
+    """
+    codes = dict([(k, unpack(v)) for k, v in fprints.items() if v])
+
+    buckets = {}
+    for tkey, tcodes in codes.items():
+        for tband in set([tuple(tcodes[i:i + FP_BAND]) for i in range(len(tcodes) - FP_BAND + 1)]):
+            if any(tband):
+                buckets.setdefault(tband, []).append(tkey)
+
+    candidates = {}
+    for tkeys in buckets.values():
+        if len(tkeys) < 2 or len(tkeys) > FP_MAX_BUCKET:
+            continue
+        tkeys.sort()
+        for i, ka in enumerate(tkeys):
+            for kb in tkeys[i + 1:]:
+                candidates[(ka, kb)] = candidates.get((ka, kb), 0) + 1
+
+    parent = {}
+    def find(x):
+        while parent.get(x, x) != x:
+            parent[x] = parent.get(parent[x], parent[x])
+            x = parent[x]
+        return x
+
+    for (ka, kb), tcount in candidates.items():
+        if tcount >= FP_MIN_BANDS and find(ka) != find(kb) and similarity(codes[ka], codes[kb]) >= threshold:
+            parent[find(ka)] = find(kb)
+
+    groups = {}
+    for tkey in codes:
+        groups.setdefault(find(tkey), []).append(tkey)
+    dupes = sorted([sorted(x) for x in groups.values() if len(x) > 1])
+    logthis("Found %d groups of duplicate tracks (%d tracks, %d candidate pairs)" % (len(dupes), len(codes), len(candidates)),
+            loglevel=LL.VERBOSE)
+    return dupes
@@ -16,6 +16,12 @@ https://ycnrg.org/
 
 import os
 import re
+import json
+import errno
+import base64
+import struct
+import bisect
+import hashlib
 import codecs
 import shlex
 import socket
@@ -25,20 +31,97 @@ import mimetypes
 from urlparse import urlparse
 
 import mutagen
+import mutagen.mp3
+import mutagen.flac
+import mutagen.mp4
+import mutagen.oggvorbis
+import mutagen.oggopus
+import mutagen.oggflac
+import mutagen._vorbis
+import mutagen.id3
+import mutagen.apev2
+import mutagen.asf
 import arrow
 from setproctitle import setproctitle
 
-from xbake import __version__, __date__
+from xbake import __version__, __date__, afprint
 from xbake.common.logthis import *
+from xbake.common.mkstore import MKStore, MKS
+from xbake.common import fsutil
 from xbake.mscan import util, out
-from xbake.mscan.mscan import (clean_overrides, check_overrides, parse_overrides,
-                               parse_xattr_overrides, filter_fname)
+from xbake.mscan.mscan import (clean_overrides, check_overrides, parse_xattr_overrides,
+                               filter_fname, OverrideIndex)
 
 # File extension filter
 fext = re.compile(r'\.(mp3|m4a|flac|ape|wma|aac|ogg|vob|wv|wav|wmf)', re.I)
 
+# Leading track number (eg. '03' in '03/12')
+re_tracknum = re.compile(r'^([0-9]+)')
+
+# Common tag date formats (YYYY, YYYY-MM, YYYY-MM-DD)
+re_tagdate = re.compile(r'^([0-9]{4})(?:-([0-9]{2})(?:-([0-9]{2}))?)?$')
+
+# CUE sheet tokenizer; quoted strings or bare words
+re_cuetok = re.compile(r'"([^"]*)"?|(\S+)', re.U)
+
+# Artwork file extensions, by MIME type
+artwork_ext = {'image/jpeg': ".jpg", 'image/jpg': ".jpg", 'image/png': ".png", 'image/gif': ".gif", 'image/bmp': ".bmp", 'image/webp': ".webp"}
+
+# Artwork already stored by this process (SHA1 hashes)
+artwork_seen = set()
+
+# Candidate tags for each normalized tag field, by tag format, in order of preference
+# Vorbis comment & APEv2 keys are case-insensitive, and are listed in lowercase
+TAGKEYS = {
+            'artist': {
+                        'id3': ('TPE1', 'TOPE'), 'vorbis': ('artist', 'author'), 'mp4': (u'\xa9ART',), 'asf': ('Author',),
+                        'generic': ('ARTIST', 'TPE1', 'TOPE', 'Author')
+                      },
+            'album': {
+                        'id3': ('TALB', 'TOAL'), 'vorbis': ('album',), 'mp4': (u'\xa9alb',), 'asf': ('WM/AlbumTitle',),
+                        'generic': ('ALBUM', 'TALB', 'TOAL', 'WM/AlbumTitle')
+                     },
+            'title': {
+                        'id3': ('TIT2', 'TIT3'), 'vorbis': ('title',), 'mp4': (u'\xa9nam',), 'asf': ('Title',),
+                        'generic': ('TITLE', 'TIT2', 'TIT3', 'Title')
+                     },
+            'genre': {
+                        'id3': ('TCON',), 'vorbis': ('genre',), 'mp4': (u'\xa9gen',), 'asf': ('WM/Genre',),
+                        'generic': ('GENRE', 'TCON', 'WM/Genre')
+                     },
+            'track': {
+                        'id3': ('TRCK',), 'vorbis': ('tracknumber', 'track'), 'mp4': ('trkn',), 'asf': ('WM/TrackNumber',),
+                        'generic': ('TRACKNUMBER', 'TRCK', 'WM/TrackNumber', 'Track')
+                     },
+            'disc': {
+                        'id3': ('TPOS',), 'vorbis': ('discnumber', 'disc'), 'mp4': ('disk',), 'asf': ('WM/PartOfSet',),
+                        'generic': ('DISCNUMBER', 'DISC', 'TPOS')
+                    },
+            'album_artist': {
+                        'id3': ('TXXX:ALBUM ARTIST', 'TXXX:ALBUM_ARTIST'), 'vorbis': ('albumartist',), 'mp4': ('aART',),
+                        'asf': ('WM/AlbumArtist',),
+                        'generic': ('ALBUMARTIST', 'TXXX:ALBUM ARTIST', 'TXXX:ALBUM_ARTIST', 'WM/AlbumArtist')
+                     },
+            'date': {
+                        'id3': ('TDRC', 'TDAT', 'TYER', 'TRDA'), 'vorbis': ('date', 'year'), 'mp4': (u'\xa9day',), 'asf': ('WM/Year',),
+                        'generic': ('TDRC', 'TDAT', 'TYER', 'TRDA', 'DATE', 'YEAR', 'WM/Year')
+                    }
+          }
+
 config = None
 
+# Incremental scan summary; file status => count
+summary = None
+
+# Album records built from scan results (AlbumIndex)
+albums = None
+
+# Acoustic fingerprints of scanned tracks; file or subsong key => fingerprint
+fprints = {}
+
+# Override index for the current scan (OverrideIndex)
+ovindex = None
+
 def run(xconfig):
     """
     Implements --ascan mode
@@ -57,7 +140,12 @@ def run(xconfig):
         elif not config.run['single'] and not os.path.isdir(config.run['infile']):
             failwith(ER.OPT_BAD, "file [%s] is not a directory; use --single mode if scanning only one file" % (config.run['infile']))
 
+    # Warn about slow fingerprinting here, before scanrunners are started, so that it is only logged once
+    if config.scan['fingerprint']:
+        afprint.check_numpy()
+
     # Examine and enumerate files
+    fsutil.xattr_reset()
     if config.run['single']:
         new_files, flist = scan_single(config.run['infile'], config.scan['mforce'])  # pylint: disable=unused-variable
     else:
@@ -73,22 +161,40 @@ def run(xconfig):
                 'duration': 0, # FIXME
                 'topmost': os.path.realpath(config.run['infile']),
                 'command': ' '.join(sys.argv),
-                'version': __version__
+                'version': __version__,
+                'xattr': fsutil.xattr_stats(),
+                'overrides': ovindex.stats()
             }
+    logthis("xattr calls:", suffix=hdata['xattr'], loglevel=LL.VERBOSE)
+    logthis("Override resolution: {dirs} directories ({overrides} with overrides) in {time:.3f}s".format(**hdata['overrides']), loglevel=LL.INFO)
 
     # Build main output structure
     odata = {
                 'scan': hdata,
-                'files': flist
+                'files': flist,
+                'albums': albums.records()
             }
+    logthis("Albums updated:", suffix=len(odata['albums']), loglevel=LL.INFO)
 
-    # Parse outfile
-    if not config.run['outfile']:
-        config.run['outfile'] = config.scan['output']
+    # Duplicate track report
+    if config.scan['fingerprint']:
+        odata['duplicates'] = afprint.find_duplicates(fprints)
+        logthis("Duplicate track groups:", suffix=len(odata['duplicates']), loglevel=LL.INFO)
+
+    # Incremental scan results
+    if summary is not None:
+        logthis("*** Incremental scan: {new} new, {changed} changed, {renamed} renamed, {unchanged} unchanged, {removed} removed".format(
+                **dict(summary, removed=len(summary['removed']))), loglevel=LL.INFO)
+        hdata['summary'] = dict(summary, removed=len(summary['removed']))
+        odata['removed'] = sorted(summary['removed'])
+        tstatus('summary', **hdata['summary'])
 
+    # Parse outfile
     # If no file defined, or '-', write to stdout
-    if not config.run['outfile'] or config.run['outfile'] == '-':
-        config.run['outfile'] = '/dev/stdout'
+    outfile = config.run['outfile'] or config.scan['output']
+    if not outfile or outfile == '-':
+        outfile = '/dev/stdout'
+    config = config._clone({'run': {'outfile': outfile}})
 
     # Parse URLs
     ofp = urlparse(config.run['outfile'])
@@ -133,19 +239,33 @@ def scan_single(infile, mforce=False):
     """
     Scan a single file
     """
+    global albums, ovindex
     ddex = {}
+    albums = AlbumIndex()
+    ovindex = OverrideIndex()
     new_files = 0
 
-    # Parse overrides for directory the file is in
+    # Resolve overrides from the scan root down to the directory the file is in
     tdir = os.path.dirname(os.path.realpath(infile))
-    ovrx = parse_xattr_overrides(tdir)
-    ovrx.update(parse_overrides(tdir))
+    tlist = os.listdir(tdir)
+    ovrx = ovindex.resolve_path(tdir, config.scan['root'], tlist)
+    if ovrx is None:
+        logthis("Skipping file, directory has 'ignore' flag set in xattribs:", suffix=tdir, loglevel=LL.INFO)
+        return (new_files, ddex)
+    if check_overrides(ovrx, os.path.basename(infile)):
+        logthis("Skipping file. Matched rule in override ignore list:", suffix=infile, loglevel=LL.INFO)
+        return (new_files, ddex)
     ovrx = clean_overrides(ovrx)
 
-    dasc = scanfile(infile, ovrx=ovrx, mforce=mforce)
+    cue = index_cues(tdir, tlist).get(os.path.basename(os.path.realpath(infile)))
+    dasc = scanfile(infile, ovrx=ovrx, mforce=mforce, cue=cue)
     if dasc:
         ddex[infile] = dasc
         new_files += 1
+        for tsong in (dasc if isinstance(dasc, list) else [dasc]):
+            tkey = "{}#!{}".format(infile, tsong['subsong']['index']) if isinstance(dasc, list) else infile
+            albums.add(tkey, tsong)
+            fprints[tkey] = tsong.get('fingerprint')
 
     return (new_files, ddex)
 
@@ -161,9 +281,22 @@ def get_scanlist(dpath, dreflinks=True):
 def scan_dir(dpath, dreflinks=True, mforce=False, procs=0, dryrun=False):
     """
     Scan a directory recursively; follows symlinks by default
+    If scan.mkey_store is set, unchanged files are skipped (unless @mforce is set),
+    and renamed files only have their path updated
     """
+    global summary, albums, ovindex
     ddex = {}
     new_files = 0
+    albums = AlbumIndex()
+    ovindex = OverrideIndex()
+
+    # Open mkey store for incremental scans
+    mks = None
+    if dryrun is False and config.scan['mkey_store']:
+        mks = MKStore(config.scan['mkey_store'])
+        summary = {MKS.NEW: 0, MKS.CHANGED: 0, MKS.RENAMED: 0, MKS.UNCHANGED: 0, MKS.REMOVED: []}
+    mkseen = set()
+    mkmoved = set()
 
     if dryrun is False:
         ## Set up workers and IPC
@@ -184,21 +317,19 @@ def scan_dir(dpath, dreflinks=True, mforce=False, procs=0, dryrun=False):
         # get base & parent dir names
         tdir_base = os.path.split(tdir)[1]  # pylint: disable=unused-variable
         tdir_parent = os.path.split(os.path.split(tdir)[0])[1]  # pylint: disable=unused-variable
-        ovrx = {}
 
-        # Get xattribs
-        ovrx = parse_xattr_overrides(tdir)
+        # Get overrides (xattribs & .xbake), inherited from the parent directory
+        ovrx = ovindex.resolve(tdir, flist)
 
-        # Check if ignore flag is set for this directory (xattribs only)
-        if ovrx.has_key('ignore'):
+        # Check if ignore flag is set for this directory (xattribs only); skip its subdirectories, too
+        if ovrx is None:
             logthis("Skipping directory, has 'ignore' flag set in xattribs:", suffix=tdir, loglevel=LL.INFO)
+            del dlist[:]
             continue
 
-        # Parse overrides for this directory
-        ovrx.update(parse_overrides(tdir))
-
         if dryrun is False:
             logthis("*** Scanning files in directory:", suffix=tdir, loglevel=LL.INFO)
+            cueidx = index_cues(tdir, flist)
 
         # enum files in this directory
         for xv in flist:
@@ -231,8 +362,40 @@ def scan_dir(dpath, dreflinks=True, mforce=False, procs=0, dryrun=False):
             if dryrun is True:
                 ddex[new_files] = os.path.realpath(tdir + '/' + xv)
                 new_files += 1
-            else:
-                mp_inq.put({'infile': xvreal, 'ovrx': ovrx_sub, 'mforce': mforce})
+                continue
+
+            # Check mkey store for unchanged & renamed files
+            xstatus = MKS.NEW
+            if mks is not None:
+                mkseen.add(xvreal)
+                xstatus, xopath, xrec = mks.check(xvreal, util.getmkey(util.dstat(xvreal)))
+                summary[xstatus] += 1
+                if xstatus == MKS.RENAMED:
+                    logthis("File renamed: %s =>" % (xopath), suffix=xvreal, loglevel=LL.INFO)
+                    xrec = relocate_record(xrec, xopath, xvreal)
+                    mks.move(xopath, xvreal, xrec)
+                    if not mforce:
+                        mkmoved.add(xvreal)
+                        ddex.update(xrec)
+                        new_files += len(xrec)
+                        for xkey, xdata in xrec.items():
+                            albums.add(xkey, xdata)
+                            fprints[xkey] = xdata.get('fingerprint')
+                        continue
+                elif xstatus == MKS.UNCHANGED and not mforce:
+                    # unchanged tracks are still needed to build complete records for updated albums
+                    logthis("File unchanged:", suffix=xvreal, loglevel=LL.VERBOSE)
+                    for xkey, xdata in xrec.items():
+                        albums.add(xkey, xdata, dirty=False)
+                        fprints[xkey] = xdata.get('fingerprint')
+                    continue
+
+                # the file is scanned again, and its tracks may now belong to another album;
+                # the album(s) they were in before must be updated, too
+                for xdata in (xrec or {}).values():
+                    albums.touch(xdata)
+
+            mp_inq.put({'infile': xvreal, 'ovrx': ovrx_sub, 'mforce': mforce, 'status': xstatus, 'cue': cueidx.get(xv)})
 
     ## Tend the workers
     if dryrun is False:
@@ -246,10 +409,13 @@ def scan_dir(dpath, dreflinks=True, mforce=False, procs=0, dryrun=False):
             # pull scan data off the outbound queue
             for tk in range(mp_outq.qsize()):  # pylint: disable=unused-variable
                 try:
-                    xfile, xdata = mp_outq.get(block=False)
+                    xfile, xrec = mp_outq.get(block=False)
                     logthis("got file from queue:", suffix=xfile, loglevel=LL.DEBUG)
-                    ddex[xfile] = xdata
-                    new_files += 1
+                    ddex.update(xrec)
+                    new_files += len(xrec)
+                    for xkey, xdata in xrec.items():
+                        albums.add(xkey, xdata)
+                        fprints[xkey] = xdata.get('fingerprint')
                 except:
                     pass
 
@@ -260,12 +426,134 @@ def scan_dir(dpath, dreflinks=True, mforce=False, procs=0, dryrun=False):
                     del(wlist[wk])
                     break
 
+    # Save results to the mkey store, grouped by file (a file may have many subsongs),
+    # and remove files that no longer exist
+    if mks is not None:
+        mkrecs = {}
+        for xkey, xdata in ddex.items():
+            if xdata['fpath']['real'] not in mkmoved:
+                mkrecs.setdefault(xdata['fpath']['real'], {})[xkey] = xdata
+        for xpath, xrec in mkrecs.items():
+            mks.put(xpath, xrec.values()[0]['mkey_id'], xrec)
+        summary[MKS.REMOVED] = mks.prune(os.path.realpath(unicode(dpath)), mkseen)
+        mks.close()
+
+        # albums that removed tracks belonged to must be updated
+        for xrec in summary[MKS.REMOVED].values():
+            for xdata in xrec.values():
+                albums.touch(xdata)
+
     return (new_files, ddex)
 
 
+class AlbumIndex(object):
+    """
+    Album records, built up from scan results as they arrive
+    Albums are keyed by (album_artist, album, year, disc); tracks are kept in track order
+    Only albums with at least one added (or touched) dirty track are returned by records()
+    """
+    def __init__(self):
+        self.albums = {}
+        self.order = {}
+        self.dirty = set()
+
+    @staticmethod
+    def get_key(tags):
+        """return album (key, ID) for track @tags, or (None, None) if it has no album tag"""
+        if not tags.get('album'):
+            return (None, None)
+        disc = unicode(tags.get('disc') or "").split('/')[0].strip() or None
+        akey = (tags.get('album_artist'), tags['album'], tags.get('year'), disc)
+        return (akey, hashlib.md5(json.dumps(akey)).hexdigest())
+
+    def get_album(self, akey, aid):
+        """return album record for album (key, ID) @akey, @aid; a new, empty record is created if needed"""
+        alb = self.albums.get(aid)
+        if alb is None:
+            alb = self.albums[aid] = {
+                                       '_id': aid,
+                                       'album_artist': akey[0],
+                                       'album': akey[1],
+                                       'year': akey[2],
+                                       'disc': akey[3],
+                                       'tracks': [],
+                                       'track_count': 0,
+                                       'duration': 0.0,
+                                       'formats': {},
+                                       'cover': None,
+                                       'last_updated': 0
+                                     }
+            self.order[aid] = []
+        return alb
+
+    def add(self, xkey, xdata, dirty=True):
+        """
+        add track @xdata (scanfile() output; file or subsong key @xkey) to its album
+        returns the album ID, or None if the track has no album tag
+        """
+        tags = xdata.get('tags') or {}
+        akey, aid = self.get_key(tags)
+        if aid is None:
+            return None
+
+        alb = self.get_album(akey, aid)
+
+        if xdata['subsong'].get('duration') is not None:
+            tdur = xdata['subsong']['duration']
+        else:
+            tdur = (xdata.get('format') or {}).get('length') or 0.0
+        tnum = tags.get('tracknum') if isinstance(tags.get('tracknum'), int) else 9999
+        tsort = (tnum, xdata['subsong']['index'], xkey)
+        tpos = bisect.bisect(self.order[aid], tsort)
+        self.order[aid].insert(tpos, tsort)
+        alb['tracks'].insert(tpos, {'file': xkey, 'tracknum': tags.get('tracknum'), 'title': tags.get('title'),
+                                    'artist': tags.get('artist'), 'duration': tdur})
+
+        tfmt = (xdata.get('format') or {}).get('format') or "Unknown"
+        alb['formats'][tfmt] = alb['formats'].get(tfmt, 0) + 1
+        alb['track_count'] += 1
+        alb['duration'] += tdur
+        alb['last_updated'] = max(alb['last_updated'], xdata.get('last_updated') or 0)
+        if alb['cover'] is None:
+            alb['cover'] = xdata.get('cover')
+        if dirty:
+            self.dirty.add(aid)
+        return aid
+
+    def touch(self, xdata):
+        """
+        mark the album of track @xdata as changed, eg. when the track has been removed, or moved
+        to another album; an album with no other tracks is returned by records() with no tracks
+        (and track_count 0), and is deleted when the output is MongoDB
+        """
+        akey, aid = self.get_key(xdata.get('tags') or {})
+        if aid is not None:
+            self.get_album(akey, aid)
+            self.dirty.add(aid)
+
+    def records(self):
+        """return dict of album ID => album record, for albums with changed tracks"""
+        return dict((aid, self.albums[aid]) for aid in self.dirty if aid in self.albums)
+
+def relocate_record(xrec, opath, npath):
+    """
+    update stored scan results @xrec (key => data) for a file renamed from @opath to @npath
+    """
+    tdir, xv = os.path.split(npath)
+    xvbase, xvext = os.path.splitext(xv)
+    nrec = {}
+    for tkey, tdata in xrec.items():
+        tdata['dpath'] = {'base': os.path.split(tdir)[1], 'parent': os.path.split(os.path.split(tdir)[0])[1], 'full': tdir}
+        tdata['fpath'] = {'real': npath, 'base': xvbase, 'file': xv, 'ext': xvext.replace('.', '')}
+        tdata['status'] = MKS.RENAMED
+        nrec[npath + tkey[len(opath):]] = tdata
+    return nrec
+
+
 def scanrunner(in_q, out_q):
     """
     Process queue runner
+    Results are put on @out_q as (file path, {track key: track data}), one item per file
     """
     hproc = multiprocessing.current_process()
     setproctitle("xbake: scanrunner")
@@ -281,17 +569,20 @@ def scanrunner(in_q, out_q):
         scandata = scanfile(**thisjob)
         if isinstance(scandata, dict):
             # Single file, Single song
-            out_q.put((thisjob['infile'], scandata))
+            out_q.put((thisjob['infile'], {thisjob['infile']: scandata}))
         elif isinstance(scandata, list):
             # Single file, Many subsongs (eg. cue sheet or FLAC w/ embedded cue)
-            for subsong in scandata:
-                ssid = "{}#!{}".format(thisjob['infile'], subsong['subsong']['index'])
-                out_q.put((ssid, subsong))
+            # All subsongs are sent as one item, so the fields they share with the master
+            # track are pickled once, and are still shared when unpickled
+            out_q.put((thisjob['infile'], dict([("{}#!{}".format(thisjob['infile'], x['subsong']['index']), x) for x in scandata])))
 
 
-def scanfile(infile, ovrx={}, mforce=False):
+def scanfile(infile, ovrx={}, mforce=False, status=MKS.NEW, cue=None):
     """
     Read audio file attributes, tags, and metadata for @infile
+    @status is the file status determined from the mkey store
+    @cue is (CUE file name, CUE data) from index_cues() if a CUE sheet in the same directory
+    applies to this file; otherwise a CUE sheet embedded in a FLAC file is used, if any
     """
     dasc = {}
 
@@ -326,39 +617,11 @@ def scanfile(infile, ovrx={}, mforce=False):
     # Modification key (MD5 of inode number + mtime + filesize)
     mkey_id = util.getmkey(dasc['stat'])
     dasc['mkey_id'] = mkey_id
-    dasc['status'] = 'new'
+    dasc['status'] = status
 
-    # Get mediainfo & build codec string
-    minfo = util.mediainfo(xvreal, config, format_lower=False)
-    try:
-        if minfo['audio'][0]['format'] == "mpeg audio":
-            if minfo['audio'][0]['format'].endswith('3'):
-                acodec = "MP3"
-            elif minfo['audio'][0]['format'].endswith('2'):
-                acodec = "MP2"
-            else:
-                acodec = "MPEG Audio"
-                if 'format_profile' in minfo['audio'][0]:
-                    acodec += " " + minfo['audio'][0]['format_profile']
-        else:
-            acodec = ""
-            if minfo['general']['format'] != minfo['audio'][0]['format']:
-                acodec = minfo['general']['format'] + " "
-            acodec += minfo['audio'][0]['format']
-            if 'format_profile' in minfo['audio'][0]:
-                acodec += " " + minfo['audio'][0]['format_profile']
-    except Exception as e:
-        logexc(e, "Failed to determine codec")
-        acodec = "Unknown"
-
-    try:
-        if 'bit_depth' in minfo['audio'][0]:
-            bitdepth = minfo['audio'][0]['bit_depth']
-        else:
-            bitdepth = 16
-    except Exception as e:
-        logexc(e, "Failed to determine bit depth; assuming default 16-bit")
-        bitdepth = 16
+    # Retrieve or calculate whole file and/or audio payload checksums
+    if config.scan['audio_checksum'] and not config.scan['nochecksum']:
+        dasc['checksum'] = get_checksums(xvreal, dasc['stat']['size'], mkey_id, fovr)
 
     # Open file with Mutagen
     try:
@@ -370,6 +633,15 @@ def scanfile(infile, ovrx={}, mforce=False):
         logexc(e, "Failed to parse tag data from file")
         return None
 
+    # Get codec string & bit depth; from Mutagen alone for formats it fully supports,
+    # otherwise from mediainfo
+    aprobe = None
+    if config.scan['audio_probe'] != 'mediainfo':
+        aprobe = probe_mutagen(mf)
+    if aprobe is None:
+        aprobe = probe_mediainfo(xvreal)
+    logthis("Probed audio format using", suffix=aprobe['probe'], loglevel=LL.DEBUG)
+
     # Determine MIME type
     try:
         amime = mf.mime[0]
@@ -395,36 +667,17 @@ def scanfile(infile, ovrx={}, mforce=False):
     # Check for tag data
     tags = mf.tags
     if tags:
-        tdate = parse_album_date(tags)
-        if tdate is not None:
-            tyear = tdate.format("YYYY")
-            tstamp = tdate.timestamp
-        else:
-            tyear = None
-            tstamp = None
-
-        dasc['tags'] = {
-                            'artist': get_best_tag(tags, ('ARTIST', 'TPE1', 'TOPE', 'Author')),
-                            'album': get_best_tag(tags, ('ALBUM', 'TALB', 'TOAL', 'WM/AlbumTitle')),
-                            'title': get_best_tag(tags, ('TITLE', 'TIT2', 'TIT3', 'Title')),
-                            'year': tyear,
-                            'timestamp': tstamp,
-                            'genre': get_best_tag(tags, ('GENRE', 'TCON', 'WM/Genre')),
-                            'tracknum': parse_tracknum(tags, forceInt=True),
-                            'trackstr': parse_tracknum(tags, forceInt=False),
-                            'disc': get_best_tag(tags, ('DISCNUMBER', 'DISC', 'TPOS')),
-                            'album_artist': get_best_tag(tags, ('ALBUMARTIST', 'TXXX:ALBUM ARTIST', 'TXXX:ALBUM_ARTIST', 'WM/AlbumArtist'))
-                       }
-        dasc['alltags'] = get_all_tags_once(tags)
+        dasc['tags'], dasc['alltags'] = normalize_tags(tags)
         dasc['format'] = {
-                            'format': acodec,
+                            'format': aprobe['format'],
+                            'probe': aprobe['probe'],
                             'mime': amime,
                             'channels': get_info_safe(mf.info, 'channels', 2),
                             'sampling_rate': get_info_safe(mf.info, 'sample_rate', 44100),
-                            'encoding_settings': minfo['audio'][0].get('encoding_settings'),
-                            'writing_library': minfo['audio'][0].get('writing_library'),
+                            'encoding_settings': aprobe['encoding_settings'],
+                            'writing_library': aprobe['writing_library'],
                             'bitrate': get_info_safe(mf.info, 'bitrate', 1411000),
-                            'bit_depth': bitdepth,
+                            'bit_depth': aprobe['bit_depth'],
                             'length': get_info_safe(mf.info, 'length')
                          }
 
@@ -437,49 +690,369 @@ def scanfile(infile, ovrx={}, mforce=False):
         dasc['format'] = {}
         logthis("** NO DATA **", loglevel=LL.WARNING)
 
+    # Extract embedded artwork
+    if config.scan['artwork_dir']:
+        dasc['artwork'] = extract_artwork(mf)
+    else:
+        dasc['artwork'] = []
+    dasc['cover'] = get_cover(dasc['artwork'])
+
     # Record last time this entry was updated (UTC)
     last_up = arrow.utcnow().timestamp
     logthis("last_updated =", suffix=last_up, loglevel=LL.DEBUG)
     dasc['last_updated'] = last_up
 
-    # Check for matching cue file...
+    # Check for matching or embedded cue sheet...
     subsongs = []
-    cuepath = dasc['dpath']['full'] + '/' + dasc['fpath']['base'] + '.cue'
-    if os.path.exists(cuepath):
-        cue = parse_cue_file(cuepath)
-        if cue:
-            # Set subsong CUE sheet source file
-            dasc['subsong']['cue'] = dasc['fpath']['base'] + '.cue'
-            dasc['subsong']['cue_realpath'] = cuepath
+    fplength = float(config.scan['fingerprint_length'])
+    if cue is None:
+        cue = get_embedded_cue(mf)
+        if cue is not None:
+            logthis("Using embedded CUE sheet for subsong indexing", loglevel=LL.VERBOSE)
+    else:
+        logthis("Using CUE sheet for subsong indexing", suffix=cue[0], loglevel=LL.VERBOSE)
 
-            logthis("Using CUE sheet for subsong indexing", suffix=dasc['fpath']['base'] + '.cue', loglevel=LL.VERBOSE)
+    if cue is not None:
+        # Set subsong CUE sheet source file
+        dasc['subsong']['cue'] = cue[0]
+        dasc['subsong']['cue_realpath'] = tdir + '/' + cue[0]
+        ctracks = cue[1]['tracks']
 
-            for ssindex, ssdata in cue['tracks'].items():
-                try:
-                    if cue['tracks'].get(ssindex + 1):
-                        ssduration = cue['tracks'][ssindex + 1]['index'][1][0] - cue['tracks'][ssindex]['index'][1][0]
-                    else:
-                        ssduration = dasc['format']['length'] - cue['tracks'][ssindex]['index'][1][0]
-                except Exception as e:
-                    logexc(e, "Failed to calculate subsong duration")
-                    ssduration = 0.0
-                tsubsong = clone_master_track(dasc, ssdata, ssindex, ssduration)
-                logthis(u"[SUBSONG] Title: {title} / Track: {tracknum} ({trackstr}) / Artist: {artist} / Album: {album} / AlbumArtist: {album_artist} / Year: {year}".format(**tsubsong['tags']), loglevel=LL.DEBUG)
-                subsongs.append(tsubsong)
+        for ssindex, ssdata in sorted(ctracks.items()):
+            if 1 not in ssdata['index']:
+                logthis("CUE sheet track has no INDEX 01; skipping:", suffix=ssindex, loglevel=LL.WARNING)
+                continue
+            try:
+                if ctracks.get(ssindex + 1):
+                    ssduration = ctracks[ssindex + 1]['index'][1][0] - ssdata['index'][1][0]
+                else:
+                    ssduration = dasc['format']['length'] - ssdata['index'][1][0]
+            except Exception as e:
+                logexc(e, "Failed to calculate subsong duration")
+                ssduration = 0.0
+            tsubsong = clone_master_track(dasc, ssdata, ssindex, ssduration)
+            if config.scan['fingerprint']:
+                tsubsong['fingerprint'] = afprint.fingerprint(xvreal, ssdata['index'][1][0], min(fplength, ssduration or fplength))
+            logthis(u"[SUBSONG] Title: {title} / Track: {tracknum} ({trackstr}) / Artist: {artist} / Album: {album} / AlbumArtist: {album_artist} / Year: {year}".format(**tsubsong['tags']), loglevel=LL.DEBUG)
+            subsongs.append(tsubsong)
 
     if len(subsongs) == 0:
+        # Acoustic fingerprint; subsongs are each fingerprinted from their own start time
+        if config.scan['fingerprint']:
+            dasc['fingerprint'] = afprint.fingerprint(xvreal, 0.0, fplength)
         logthis(u"Title: {title} / Track: {tracknum} ({trackstr}) / Artist: {artist} / Album: {album} / AlbumArtist: {album_artist} / Year: {year}".format(**dasc['tags']), loglevel=LL.DEBUG)
         return dasc
     else:
         return subsongs
 
+def probe_mediainfo(xvreal):
+    """
+    Get codec string, bit depth, and encoder info for @xvreal from mediainfo
+    """
+    minfo = util.mediainfo(xvreal, config, format_lower=False)
+    try:
+        if minfo['audio'][0]['format'] == "mpeg audio":
+            if minfo['audio'][0]['format'].endswith('3'):
+                acodec = "MP3"
+            elif minfo['audio'][0]['format'].endswith('2'):
+                acodec = "MP2"
+            else:
+                acodec = "MPEG Audio"
+                if 'format_profile' in minfo['audio'][0]:
+                    acodec += " " + minfo['audio'][0]['format_profile']
+        else:
+            acodec = ""
+            if minfo['general']['format'] != minfo['audio'][0]['format']:
+                acodec = minfo['general']['format'] + " "
+            acodec += minfo['audio'][0]['format']
+            if 'format_profile' in minfo['audio'][0]:
+                acodec += " " + minfo['audio'][0]['format_profile']
+    except Exception as e:
+        logexc(e, "Failed to determine codec")
+        acodec = "Unknown"
+
+    try:
+        if 'bit_depth' in minfo['audio'][0]:
+            bitdepth = minfo['audio'][0]['bit_depth']
+        else:
+            bitdepth = 16
+    except Exception as e:
+        logexc(e, "Failed to determine bit depth; assuming default 16-bit")
+        bitdepth = 16
+
+    try:
+        ainfo = minfo['audio'][0]
+    except IndexError:
+        ainfo = {}
+
+    return {
+             'probe': 'mediainfo',
+             'format': acodec,
+             'bit_depth': bitdepth,
+             'encoding_settings': ainfo.get('encoding_settings'),
+             'writing_library': ainfo.get('writing_library')
+           }
+
+def probe_mutagen(mf):
+    """
+    Get codec string (as it would be built from mediainfo), bit depth, and encoder info
+    from Mutagen file object @mf, for formats that Mutagen fully supports (MP3, FLAC, MP4, Ogg)
+    Returns None for any other format
+    """
+    ainfo = mf.info if mf is not None else None
+    vendor = getattr(mf.tags, 'vendor', None) if mf is not None else None
+    aprobe = {'probe': 'mutagen', 'bit_depth': 16, 'encoding_settings': None, 'writing_library': None}
+
+    if isinstance(mf, mutagen.mp3.MP3):
+        aprobe['format'] = "MPEG Audio Layer %d" % (ainfo.layer)
+        aprobe['writing_library'] = ainfo.encoder_info or None
+        aprobe['encoding_settings'] = ainfo.encoder_settings or None
+    elif isinstance(mf, mutagen.flac.FLAC):
+        aprobe['format'] = "FLAC"
+        aprobe['bit_depth'] = ainfo.bits_per_sample
+        aprobe['writing_library'] = vendor
+    elif isinstance(mf, mutagen.mp4.MP4):
+        aprobe['format'] = "MPEG-4 " + (ainfo.codec_description or ainfo.codec)
+        if ainfo.codec == 'alac':
+            aprobe['bit_depth'] = ainfo.bits_per_sample or 16
+    elif isinstance(mf, mutagen.oggvorbis.OggVorbis):
+        aprobe['format'] = "Ogg Vorbis"
+        aprobe['writing_library'] = vendor
+    elif isinstance(mf, mutagen.oggopus.OggOpus):
+        aprobe['format'] = "Ogg Opus"
+        aprobe['writing_library'] = vendor
+    elif isinstance(mf, mutagen.oggflac.OggFLAC):
+        aprobe['format'] = "Ogg FLAC"
+        aprobe['bit_depth'] = getattr(ainfo, 'bits_per_sample', 16)
+        aprobe['writing_library'] = vendor
+    else:
+        return None
+
+    return aprobe
+
+def get_pictures(mf):
+    """
+    return list of pictures embedded in Mutagen file object @mf, as tuples of
+    (image data, MIME type, picture type); picture types are as in ID3 APIC frames
+    and FLAC (3 = front cover)
+    """
+    pics = []
+    if isinstance(mf, mutagen.flac.FLAC):
+        pics += [(x.data, x.mime, x.type) for x in mf.pictures]
+    if isinstance(mf.tags, mutagen.id3.ID3):
+        pics += [(x.data, x.mime, x.type) for x in mf.tags.getall('APIC')]
+    elif isinstance(mf.tags, mutagen.mp4.MP4Tags):
+        for x in mf.tags.get('covr', []):
+            pics.append((str(x), "image/png" if x.imageformat == mutagen.mp4.MP4Cover.FORMAT_PNG else "image/jpeg", 3))
+    elif isinstance(mf.tags, mutagen._vorbis.VCommentDict):
+        for x in mf.tags.get('metadata_block_picture', []):
+            try:
+                tpic = mutagen.flac.Picture(base64.b64decode(x))
+            except Exception as e:
+                logexc(e, "Failed to decode METADATA_BLOCK_PICTURE")
+                continue
+            pics.append((tpic.data, tpic.mime, tpic.type))
+    return pics
+
+def store_artwork(data, mime):
+    """
+    store image @data in the content-addressed artwork directory (scan.artwork_dir),
+    unless an identical image is already stored; returns the SHA1 hash of the image
+    """
+    ahash = hashlib.sha1(data).hexdigest()
+    if ahash in artwork_seen:
+        return ahash
+
+    adir = os.path.realpath(os.path.expanduser(config.scan['artwork_dir'])) + '/' + ahash[:2]
+    apath = adir + '/' + ahash + artwork_ext.get((mime or "").lower(), ".bin")
+    if not os.path.exists(apath):
+        try:
+            try:
+                os.makedirs(adir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            with open(apath + ".%d.tmp" % (os.getpid()), 'wb') as f:
+                f.write(data)
+            os.rename(apath + ".%d.tmp" % (os.getpid()), apath)
+            logthis("Stored artwork:", suffix=apath, loglevel=LL.VERBOSE)
+        except (IOError, OSError) as e:
+            logexc(e, "Failed to store artwork %s" % (apath))
+            return ahash
+
+    artwork_seen.add(ahash)
+    return ahash
+
+def extract_artwork(mf):
+    """
+    store all pictures embedded in Mutagen file object @mf (see store_artwork())
+    returns list of artwork info (sha1, mime, type, size) for each unique picture
+    """
+    alist = []
+    for tdata, tmime, ttype in get_pictures(mf):
+        ahash = store_artwork(tdata, tmime)
+        if ahash not in [x['sha1'] for x in alist]:
+            alist.append({'sha1': ahash, 'mime': tmime, 'type': ttype, 'size': len(tdata)})
+    return alist
+
+def get_cover(alist):
+    """return SHA1 hash of the front cover from artwork list @alist, or the first picture if there is none"""
+    for tart in alist:
+        if tart['type'] == 3:
+            return tart['sha1']
+    return alist[0]['sha1'] if alist else None
+
+def get_checksums(xvreal, fsize, mkey_id, fovr):
+    """
+    return checksums of @xvreal, as set by scan.audio_checksum: 'file' (md5, crc32, ed2k of the
+    whole file), 'payload' (payload_md5; audio only, so it doesn't change when retagged), or 'both'
+    Checksums saved in xattribs (@fovr) are used if they were saved with the same mkey; otherwise
+    they are calculated with a single read of the file, and saved if scan.savechecksum is set
+    """
+    tmode = str(config.scan['audio_checksum']).lower()
+    tfile = tmode in ('file', 'both', 'true', '1')
+    tpayload = tmode in ('payload', 'both', 'true', '1')
+    tkeys = (['md5', 'crc32', 'ed2k'] if tfile else []) + (['payload_md5'] if tpayload else [])
+    if not tkeys:
+        logthis("Invalid scan.audio_checksum setting:", suffix=tmode, loglevel=LL.WARNING)
+        return None
+
+    if fovr.get('checksum_mkey') == mkey_id and all([fovr.get(x) for x in tkeys]):
+        logthis("Using checksum information from extended file attributes", loglevel=LL.VERBOSE)
+        return dict([(x, fovr[x]) for x in tkeys])
+
+    logthis("Calculating checksum...", loglevel=LL.VERBOSE)
+    rhx = util.get_librhash()
+    try:
+        if tpayload:
+            wout, pout = util.rhash_ranges(xvreal, [rhx.MD5], get_payload_ranges(xvreal, fsize),
+                                           whole=[rhx.MD5, rhx.CRC32, rhx.ED2K] if tfile else None)
+            chk = wout or {}
+            chk['payload_md5'] = pout['md5']
+        else:
+            chk = util.checksum(xvreal)
+    except Exception as e:
+        logexc(e, "Failed to calculate checksums")
+        return None
+    if 'crc32' in chk:
+        chk['crc32'] = chk['crc32'].upper()
+
+    if config.scan['savechecksum']:
+        xsave = dict([('checksum.' + x, chk[x]) for x in tkeys])
+        xsave['checksum.mkey'] = mkey_id
+        logthis("Setting checksum xattribs:", suffix=xsave, loglevel=LL.DEBUG)
+        fsutil.xattr_set(xvreal, xsave)
+    return chk
+
+def get_payload_ranges(fname, fsize):
+    """
+    return list of (start, end) byte ranges of the audio payload of @fname (of size @fsize)
+    Excludes leading ID3v2 tags & FLAC metadata blocks, trailing APEv2 & ID3v1 tags,
+    MP4 atoms other than mdat, and Ogg header pages & page headers
+    """
+    with open(fname, 'rb') as f:
+        thead = f.read(12)
+        if thead[4:8] == 'ftyp':
+            return get_mp4_ranges(f, fsize)
+        elif thead[:4] == 'OggS':
+            return get_ogg_ranges(f, fsize)
+
+        # ID3v2 tags (size is syncsafe, and excludes the header & footer)
+        start = 0
+        while True:
+            f.seek(start)
+            thdr = f.read(10)
+            if len(thdr) < 10 or thdr[:3] != 'ID3':
+                break
+            tsize = sum([(ord(thdr[6 + i]) & 0x7f) << (21 - 7 * i) for i in range(4)])
+            start += 10 + tsize + (10 if ord(thdr[5]) & 0x10 else 0)
+
+        # FLAC metadata blocks
+        f.seek(start)
+        if f.read(4) == 'fLaC':
+            start += 4
+            while True:
+                bhdr = f.read(4)
+                if len(bhdr) < 4:
+                    break
+                start += 4 + struct.unpack('>I', '\x00' + bhdr[1:])[0]
+                if ord(bhdr[0]) & 0x80:
+                    break
+                f.seek(start)
+
+        # ID3v1 & APEv2 tags, in either order
+        end = fsize
+        tlast = None
+        while end != tlast:
+            tlast = end
+            if end - start >= 128:
+                f.seek(end - 128)
+                if f.read(3) == 'TAG':
+                    end -= 128
+            # APEv2 size includes the footer, but not the header (if present)
+            if end - start >= 32:
+                f.seek(end - 32)
+                tfoot = f.read(32)
+                if tfoot[:8] == 'APETAGEX':
+                    tsize, tflags = struct.unpack('<I4xI', tfoot[12:24])
+                    end -= tsize + (32 if tflags & 0x80000000 else 0)
+
+    return [(start, end)] if end > start else []
+
+def get_mp4_ranges(f, fsize):
+    """return byte ranges of the contents of all top-level mdat atoms in MP4 file @f"""
+    ranges = []
+    tpos = 0
+    while tpos + 8 <= fsize:
+        f.seek(tpos)
+        ahdr = f.read(16)
+        asize, atype = struct.unpack('>I4s', ahdr[:8])
+        hlen = 8
+        if asize == 1 and len(ahdr) == 16:
+            asize = struct.unpack('>Q', ahdr[8:16])[0]
+            hlen = 16
+        elif asize == 0:
+            asize = fsize - tpos
+        if asize < hlen:
+            break
+        if atype == 'mdat':
+            ranges.append((tpos + hlen, min(tpos + asize, fsize)))
+        tpos += asize
+    return ranges
+
+def get_ogg_ranges(f, fsize):
+    """
+    return byte ranges of page bodies in Ogg file @f, starting from the first audio page
+    Header pages (including comments) have a granule position of 0 (or -1, if continued);
+    page headers are skipped, since pages are renumbered when the comment header changes size
+    """
+    ranges = []
+    tpos = 0
+    taudio = False
+    while tpos + 27 <= fsize:
+        f.seek(tpos)
+        phdr = f.read(27)
+        if phdr[:4] != 'OggS':
+            break
+        tgranule = struct.unpack('<q', phdr[6:14])[0]
+        tsegs = bytearray(f.read(ord(phdr[26])))
+        bstart = tpos + 27 + len(tsegs)
+        tpos = bstart + sum(tsegs)
+        if not taudio and tgranule not in (0, -1):
+            taudio = True
+        if taudio and tpos > bstart:
+            ranges.append((bstart, min(tpos, fsize)))
+    return ranges
+
 def clone_master_track(obj, stdata, stindex, stduration):
     """
-    ghetto-clone ('deep copy') an object using JSON
-    populate subtrack info from CUE sheet
+    clone master track @obj for a subsong, and populate subtrack info from CUE sheet
+    Only 'subsong' and 'tags' are copied; all other fields are shared with the master
+    track (and every other subsong) by reference, and must not be modified
     """
-    newsong = json.loads(json.dumps(obj))
+    newsong = dict(obj)
     newsong['subsong'] = {'index': stindex, 'start_time': stdata['index'][1][0], 'duration': stduration}
+    newsong['tags'] = dict(obj['tags'])
     newsong['tags']['artist'] = stdata.get('PERFORMER', newsong['tags'].get('artist'))
     newsong['tags']['title'] = stdata.get('TITLE', newsong['tags'].get('title'))
     newsong['tags']['tracknum'] = stindex
@@ -499,6 +1072,8 @@ def get_true_value(inval):
     """return the true value from any object that might be in the way"""
     if isinstance(inval, unicode) or isinstance(inval, int) or isinstance(inval, float):
         realval = inval
+    elif isinstance(inval, mutagen.mp4.MP4Cover):
+        realval = unicode(hashlib.sha1(inval).hexdigest())
     elif isinstance(inval, str) or isinstance(inval, bytes):
         realval = inval.decode('utf8', errors='ignore')
     elif isinstance(inval, mutagen.id3._specs.ID3TimeStamp):
@@ -508,20 +1083,17 @@ def get_true_value(inval):
             if inval.day:
                 realval += u'-%02d' % (inval.day)
     elif isinstance(inval, mutagen.id3.APIC):
-        realval = None
-        logthis("Data object handling not implemented. Ignoring APIC object.", loglevel=LL.WARNING)
-        #realval = {
-        #            'mime': inval.mime,
-        #            'desc': inval.desc,
-        #            'data': inval.data,
-        #            'type': inval.type
-        #          }
+        # image data is stored by extract_artwork(); only record its hash
+        realval = unicode(hashlib.sha1(inval.data).hexdigest())
     else:
         try:
             if 'text' in inval.__dict__.keys():
                 realval = unicode(inval.text, errors='ignore')
             elif 'value' in inval.__dict__.keys():
-                realval = unicode(inval.value, errors='ignore')
+                if isinstance(inval.value, (int, long, float, unicode)):
+                    realval = inval.value
+                else:
+                    realval = unicode(inval.value, errors='ignore')
             else:
                 logthis("Not sure what to do with this one... <%s> [%s]" % (type(inval), ','.join(inval.__dict__.keys())),
                         suffix=inval, loglevel=LL.WARNING)
@@ -531,29 +1103,6 @@ def get_true_value(inval):
             realval = None
     return realval
 
-def get_all_tags_once(tagdata):
-    """return a dict of all tags containing their first value"""
-    tout = {}
-    for ttag, tval in dict(tagdata).items():
-        try:
-            dtag = ttag.decode('utf8')
-        except Exception as e:
-            logthis("Encountered bad tag; ignoring:", suffix=str(e), loglevel=LL.WARNING)
-            continue
-
-        try:
-            if hasattr(tval, '__iter__'):
-                if len(list(tval)) > 0:
-                    tout[dtag] = get_true_value(tval[0])
-                else:
-                    logthis("Encountered null tag data for", suffix=dtag, loglevel=LL.VERBOSE)
-                    tout = None
-            else:
-                tout[dtag] = get_true_value(tval)
-        except Exception as e:
-            logexc(e, "Failed to convert %s tag for serialization [type=%s]" % (dtag, type(tval)))
-    return tout
-
 def get_single_tag(tagdata, tagname):
     """return first tag in tagdata matching name; else, return None"""
     tg = tagdata.get(tagname)
@@ -570,63 +1119,138 @@ def get_single_tag(tagdata, tagname):
             logthis("Encountered null tag data for", suffix=tagname, loglevel=LL.WARNING)
             return None
 
-def get_best_tag(tagdata, taglist, cast=None, strict=True):
+def compile_tagmap(tagkeys):
+    """
+    compile candidate tag table @tagkeys into a dict of tag format => {tag key: (field, preference)}
+    """
+    tmap = {}
+    for tfield, tformats in tagkeys.items():
+        for tfmt, tkeys in tformats.items():
+            for tpref, tkey in enumerate(tkeys):
+                tmap.setdefault(tfmt, {})[tkey] = (tfield, tpref)
+    tmap['ape'] = tmap['vorbis']
+    return tmap
+
+# Compiled TAGKEYS
+TAGMAP = compile_tagmap(TAGKEYS)
+
+def get_tag_format(tagdata):
+    """return tag format of @tagdata (a key of TAGMAP)"""
+    if isinstance(tagdata, mutagen.id3.ID3):
+        return 'id3'
+    elif isinstance(tagdata, mutagen._vorbis.VComment):
+        return 'vorbis'
+    elif isinstance(tagdata, mutagen.mp4.MP4Tags):
+        return 'mp4'
+    elif isinstance(tagdata, mutagen.asf.ASFTags):
+        return 'asf'
+    elif isinstance(tagdata, mutagen.apev2.APEv2):
+        return 'ape'
+    return 'generic'
+
+def normalize_tags(tagdata):
     """
-    return a single value from a list of candidate tags, @taglist
-    @cast should be a type, such as str, int, float, etc. or None
-    if @strict is True, then None will be returned if the type conversion fails
-    otherwise the raw, unconverted value is returned
+    walk @tagdata once, and return tuple (normalized tags, all tags)
+    all tags is a dict of every tag and its first value; normalized tags uses the
+    most preferred candidate tag of each field in TAGKEYS
     """
-    ctag = None
-    rawval = None
-    for ttag in tuple(taglist):
-        if ttag in tagdata:
+    tfmt = get_tag_format(tagdata)
+    tmap = TAGMAP[tfmt]
+    tlower = tfmt in ('vorbis', 'ape')
+    # MP4 atom names are Latin-1 (eg. '\xa9ART')
+    tenc = 'latin-1' if tfmt == 'mp4' else 'utf8'
+
+    # Vorbis comments & ASF tags are lists of (key, value) pairs, which can be walked directly;
+    # other formats are dicts of key => list of values (or a single frame)
+    if isinstance(tagdata, list):
+        titems = tagdata
+    else:
+        titems = tagdata.items()
+
+    alltags = {}
+    tfound = {}
+    for ttag, tval in titems:
+        if isinstance(ttag, str):
             try:
-                rawval = get_true_value(tagdata.get(ttag)[0])
-                ctag = ttag
-                break
-            except:
-                logthis("Encountered null tag data for", suffix=ttag, loglevel=LL.WARNING)
+                ttag = ttag.decode(tenc)
+            except Exception as e:
+                logthis("Encountered bad tag; ignoring:", suffix=str(e), loglevel=LL.WARNING)
                 continue
+        tkey = ttag.lower() if tlower else ttag
+        if tfmt == 'vorbis':
+            ttag = tkey
+        if ttag in alltags:
+            continue
 
-    if cast is not None:
         try:
-            outval = cast(rawval)
-        except:
-            if strict is True:
-                outval = None
+            if hasattr(tval, '__iter__'):
+                tval = list(tval)
+                if len(tval) == 0:
+                    logthis("Encountered null tag data for", suffix=ttag, loglevel=LL.VERBOSE)
+                    continue
+                tval = tval[0]
+            if isinstance(tval, unicode):
+                pass
+            elif isinstance(tval, tuple):
+                # MP4 track & disc numbers (num, total)
+                tval = u'/'.join([unicode(x) for x in tval if x])
             else:
-                outval = rawval
-    else:
-        outval = rawval
+                tval = get_true_value(tval)
+        except Exception as e:
+            logexc(e, "Failed to convert %s tag for serialization [type=%s]" % (ttag, type(tval)))
+            continue
+        alltags[ttag] = tval
 
-    if ctag is not None:
-        logthis("%s => " % (ctag), suffix=outval, loglevel=LL.DEBUG2)
-    else:
-        logthis("No match for (%s)" % ("/".join(tuple(taglist))), loglevel=LL.DEBUG)
+        if tkey in tmap:
+            tfield, tpref = tmap[tkey]
+            tfound.setdefault(tfield, []).append((tpref, tval))
 
-    return outval
+    for tfield in tfound:
+        tfound[tfield] = [x[1] for x in sorted(tfound[tfield], key=lambda x: x[0])]
 
-def parse_album_date(tagdata):
-    """parse various datetime formats and return an Arrow date object"""
-    ad = None
-    for dt in ('TDRC', 'TDAT', 'TYER', 'TRDA', 'DATE', 'YEAR', 'WM/Year'):
-        if dt in tagdata:
-            try:
-                tstr = get_true_value(tagdata[dt][0])
-                ad = arrow.get(tstr, ["YYYY-MM-DD", "YYYY-MM", "YYYY"])
-                break
-            except Exception as e:
-                logthis("Failed to parse tag:", prefix=dt, suffix=str(e), loglevel=LL.WARNING)
-    return ad
+    tdate = parse_album_date(tfound.get('date', []))
+    if tdate is not None:
+        tyear = tdate.format("YYYY")
+        tstamp = tdate.timestamp
+    else:
+        tyear = None
+        tstamp = None
+
+    traw = tfound.get('track', [None])[0]
+    ntags = {
+                'artist': tfound.get('artist', [None])[0],
+                'album': tfound.get('album', [None])[0],
+                'title': tfound.get('title', [None])[0],
+                'year': tyear,
+                'timestamp': tstamp,
+                'genre': tfound.get('genre', [None])[0],
+                'tracknum': parse_tracknum(traw, forceInt=True),
+                'trackstr': parse_tracknum(traw, forceInt=False),
+                'disc': tfound.get('disc', [None])[0],
+                'album_artist': tfound.get('album_artist', [None])[0]
+            }
+    return (ntags, alltags)
+
+def parse_album_date(dlist):
+    """parse the first valid date in @dlist (in various formats) and return an Arrow date object"""
+    for tstr in dlist:
+        try:
+            tmatch = re_tagdate.match(tstr)
+            if tmatch:
+                return arrow.Arrow(*[int(x or 1) for x in tmatch.groups()])
+            return arrow.get(tstr, ["YYYY-MM-DD", "YYYY-MM", "YYYY"])
+        except Exception as e:
+            logthis("Failed to parse date tag:", prefix=tstr, suffix=str(e), loglevel=LL.WARNING)
+    return None
 
-def parse_tracknum(tagdata, forceInt=False):
-    """parse track number from tag data and output a normalized value"""
-    traw = get_best_tag(tagdata, ('TRACKNUMBER', 'TRCK', 'WM/TrackNumber', 'Track'))
+def parse_tracknum(traw, forceInt=False):
+    """parse track number from raw tag value @traw and output a normalized value"""
+    if isinstance(traw, (int, long)):
+        return traw
     ttxt = None
     tnum = None
     try:
-        ttxt = re.match(r'^([0-9]+)', traw).group(1)
+        ttxt = re_tracknum.match(traw).group(1)
         tnum = int(ttxt)
     except:
         if forceInt is False:
@@ -634,25 +1258,83 @@ def parse_tracknum(tagdata, forceInt=False):
                 tnum = ttxt
     return tnum
 
+def index_cues(tdir, flist):
+    """
+    parse all CUE sheets in directory @tdir (containing files @flist)
+    returns dict of audio file name => (CUE file name, CUE data)
+    A CUE sheet applies to the file with the same base name, or if there is none,
+    to the file it references, when it references only a single file (a disc image)
+    """
+    cidx = {}
+    crefs = {}
+    fbase = {}
+    for tf in flist:
+        fbase.setdefault(os.path.splitext(tf)[0], []).append(tf)
+
+    for tcf in flist:
+        if not tcf.lower().endswith('.cue'):
+            continue
+        cue = parse_cue_file(tdir + '/' + tcf)
+        if not cue:
+            continue
+        for tf in fbase.get(os.path.splitext(tcf)[0], []):
+            if tf != tcf:
+                cidx[tf] = (tcf, cue)
+        if len(cue['files']) == 1:
+            crefs[os.path.basename(cue['files'][0].replace('\\', '/'))] = (tcf, cue)
+
+    for tf, tcue in crefs.items():
+        cidx.setdefault(tf, tcue)
+    return cidx
+
+def get_embedded_cue(mf):
+    """
+    return (file name, CUE data) for a CUE sheet embedded in FLAC file @mf, either as
+    a CUESHEET Vorbis comment or a CUESHEET metadata block; otherwise None
+    """
+    if not isinstance(mf, mutagen.flac.FLAC):
+        return None
+    fname = os.path.basename(mf.filename)
+    if mf.tags and mf.tags.get('cuesheet'):
+        cue = parse_cue_text(mf.tags['cuesheet'][0], mf.filename)
+        if cue['tracks']:
+            return (fname, cue)
+    if mf.cuesheet and mf.info.sample_rate:
+        cue = {'tracks': {}, 'files': [fname]}
+        for trk in mf.cuesheet.tracks:
+            # skip lead-out track
+            if trk.track_number in (170, 255):
+                continue
+            tindex = {}
+            for tidx in trk.indexes:
+                fstamp = float(trk.start_offset + tidx.index_offset) / mf.info.sample_rate
+                tindex[tidx.index_number] = (fstamp, "%02d:%02d:%02d" % (int(fstamp // 60), int(fstamp % 60), int((fstamp % 1) * 75)))
+            cue['tracks'][trk.track_number] = {'type': "AUDIO" if trk.type == 0 else "DATA", 'index': tindex}
+        if cue['tracks']:
+            return (fname, cue)
+    return None
+
 def parse_cue_file(rpath):
     """parse CUE sheet"""
     try:
         with codecs.open(rpath, 'r', 'utf8', errors='ignore') as f:
-            clines = f.readlines()
+            ctext = f.read()
     except Exception as e:
         logexc(e, "Failed to read CUE file %s" % (rpath))
         return None
+    return parse_cue_text(ctext, rpath)
 
-    cuedata = {'tracks': {}}
+def parse_cue_text(ctext, rpath):
+    """parse CUE sheet text @ctext (from file @rpath)"""
+    cuedata = {'tracks': {}, 'files': []}
     tcontext = cuedata
-    for linenum, tline in enumerate(clines):
-        tline = tline.strip()
-        ttok = tuple(unicode(t, 'utf8', errors='ignore') for t in shlex.split(tline))
+    for linenum, tline in enumerate(ctext.splitlines()):
+        ttok = [x[0] or x[1] for x in re_cuetok.findall(tline)]
         if len(ttok) < 2:
             continue
 
         try:
-            tcmd = ttok[0].strip().upper()
+            tcmd = ttok[0].upper()
             targs = ttok[1:]
             if tcmd == "TRACK":
                 trknum = int(targs[0])
@@ -662,20 +1344,21 @@ def parse_cue_file(rpath):
                 tpath = targs[0]
                 ttype = targs[1].upper()
                 tcontext['FILE'] = {'path': tpath, 'type': ttype}
+                cuedata['files'].append(tpath)
             elif tcmd == "INDEX":
                 idex = int(targs[0])
                 istamp = targs[1]
                 fstamp = parse_cue_tstamp(istamp)
                 tcontext['index'][idex] = (fstamp, istamp)
             elif tcmd == "REM":
-                trem = targs[1].upper()
-                tval = targs[2]
+                trem = targs[0].upper()
+                tval = targs[1]
                 tcontext['REM:'+trem] = tval
             else:
                 if len(targs) == 1:
-                    tcontext[tcmd.upper()] = targs[0]
+                    tcontext[tcmd] = targs[0]
                 else:
-                    tcontext[tcmd.upper()] = targs
+                    tcontext[tcmd] = targs
         except Exception as e:
             logexc(e, "Failed to parse line %d in CUE sheet %s" % (linenum + 1, rpath))
             continue
@@ -23,10 +23,11 @@ import optparse
 from xbake import __version__, __date__, defaults
 from xbake.common.logthis import *
 from xbake.common import rcfile
-from xbake.xcode import ffmpeg, xcode, ssonly
-from xbake.mscan import mscan, scrapers
-from xbake.srv import daemon
-from xbake import ascan
+from xbake.xcode import ffmpeg
+
+# Modes that use external tools (ffmpeg, mkvextract, etc.)
+# Other modes skip locating them; each mode's module is only imported when it runs
+tool_modes = ('xcode', 'ssonly', 'srv')
 
 oparser = None
 
@@ -65,10 +66,13 @@ def parse_cli():
     opg_mode.add_option('--ssonly', action="store_const", dest="run.mode", const="ssonly", default=False, help="Capture screenshot only")
     opg_mode.add_option('-d', '--server', action="store_const", dest="run.mode", const="srv", default=False, help="Run as a daemon (API server)")
     opg_mode.add_option('--set', action="store_const", dest="run.mode", const="set", default=False, help="Set overrides")
+    opg_mode.add_option('--xcache', action="store_const", dest="run.mode", const="xcache", default=False, help="Show encode cache report (and evict expired entries)")
+    opg_mode.add_option('--tune', action="store_const", dest="run.mode", const="tune", default=False, help="Benchmark encoder presets & thread counts on this machine, and save the tuning file")
 
     # Scanning options
     opg_scan = optparse.OptionGroup(oparser, "Scanning", "Options for media scanner")
     opg_scan.add_option('-S', '--single', action="store_true", dest="run.single", default=False, help="Single-file Mode")
+    opg_scan.add_option('--scan-root', action="store", dest="scan.root", default=False, metavar="DIR", help="Single-file Mode: inherit directory overrides from DIR down to the file [default: only the file's own directory]")
     opg_scan.add_option('-X', '--nosend', action="store_true", dest="scan.nosend", default=False, help="Disable sending data to remote server")
     opg_scan.add_option('--scraper', action="store", dest="scan.scraper", default=False, metavar="ID", help="Choose scraper to use (use 'help' to list available scrapers)")
     opg_scan.add_option('--procs', action="store", dest="scan.procs", default=False, metavar="PROCS", help="Number of processes to spawn (default is number of CPU threads)")
@@ -76,6 +80,9 @@ def parse_cli():
     opg_scan.add_option('-Z', '--nochecksum', action="store_true", dest="scan.nochecksum", default=False, help="Disable checksum calculation during file scanning")
     opg_scan.add_option('--nosave', action="store_false", dest="scan.savechecksum", default=False, help="Do not save checksum results in file extended attributes")
     opg_scan.add_option('--mforce', action="store_true", dest="scan.mforce", default=False, help="Force rescan all files, even if no changes detected")
+    opg_scan.add_option('--mkstore', action="store", dest="scan.mkey_store", default=False, metavar="PATH", help="Incremental audio scan: skip files unchanged since the last scan, per the mkey store at PATH")
+    opg_scan.add_option('--achecksum', action="store", dest="scan.audio_checksum", default=False, metavar="MODE", help="Audio scan: calculate checksums of the whole file, the audio payload only, or both [file,payload,both]")
+    opg_scan.add_option('--fingerprint', action="store_true", dest="scan.fingerprint", default=False, help="Audio scan: calculate acoustic fingerprints and report duplicate tracks")
 
     # Transcoding options
     opg_xcode = optparse.OptionGroup(oparser, "Transcoding", "Options for transcoding video")
@@ -90,6 +97,8 @@ def parse_cli():
     opg_xcode.add_option('--abr', action="store", dest="xcode.abr", default=False, metavar="KBPS", help="Audio bitrate in kbps (default=128)")
     opg_xcode.add_option('--acopy', action="store_true", dest="xcode.acopy", default=False, help="Audio track, direct stream copy (default if stream is AAC Stereo)")
     opg_xcode.add_option('--downmix', action="store_true", dest="xcode.downmix", default=False, help="Downmix audio from 5.1 to Stereo")
+    opg_xcode.add_option('--threads', action="store", dest="xcode.threads", default=False, metavar="NUM", help="Number of encoder threads (default=0, auto)")
+    opg_xcode.add_option('--segments', action="store", dest="xcode.segments", default=False, metavar="NUM", help="Segmented encode: split video into NUM segments and encode them in parallel (default=0, off)")
     opg_xcode.add_option('--flv', action="store_true", dest="xcode.flv", default=False, help="Output in FLV container")
     opg_xcode.add_option('--daignore', action="store_true", dest="xcode.daignore", default=False, help="Ignore errors when dumping attachments")
     opg_xcode.add_option('-x', '--noupdate', action="store_true", dest="run.noupdate", default=False, help="Do not commit updates to database")
@@ -128,6 +137,8 @@ def parse_cli():
     opg_srv.add_option('--port', action="store", dest="srv.port", default=False, metavar="PORT", help="Port to listen on [default: 7037]")
     opg_srv.add_option('--nofork', action="store_true", dest="srv.nofork", default=False, help="Don't fork (stay loaded in the foreground)")
     opg_srv.add_option('--debug', action="store_true", dest="srv.debug", default=False, help="Enable debug mode (Flask)")
+    opg_srv.add_option('--cluster', action="store_true", dest="srv.cluster", default=False, help="Join the cluster of daemons sharing the same Redis server")
+    opg_srv.add_option('--node-id', action="store", dest="srv.node_id", default=False, metavar="NODE", help="Cluster node ID; also the files.location key of this host [default: FQDN]")
 
     # add groups to parser
     oparser.add_option_group(opg_mode)
@@ -175,9 +186,15 @@ def _main():
     configure_logging(config)
 
     # Get ffmpeg version
-    ffmpeg.locateAll(config)
-    ffver = ffmpeg.version()
-    logthis("FFmpeg Version:", suffix="%s (%s)" % (ffver['version'], ffver['date']), loglevel=LL.VERBOSE)
+    if config.run['mode'] in tool_modes:
+        ffmpeg.locateAll(config)
+        # if ffmpeg path auto-detection is set to auto (ffmpeg.path = None), set the path in the ffmpeg option block
+        if config.ffmpeg['path'] is None:
+            config = config._clone({'ffmpeg': {'path': ffmpeg.bpath.ffpath}})
+        ffver = ffmpeg.version()
+        logthis("FFmpeg Version:", suffix="%s (%s)" % (ffver['version'], ffver['date']), loglevel=LL.VERBOSE)
+    else:
+        ffver = None
     tstatus('version', xbake_version=__version__, xbake_date=__date__, ffmpeg=ffver, path=os.environ['PATH'])
 
     # Ready
@@ -190,6 +207,7 @@ def _main():
     # Set default return code to 1
     rcode = 1
     if config.scan['scraper'] == "help":
+        from xbake.mscan import scrapers
         scrapers.loadModules()
         modlist = scrapers.getModuleList()
         print("** Available scraper modules:\n")
@@ -198,16 +216,28 @@ def _main():
         print("")
         rcode = 250
     elif config.run['mode'] == "xcode":
+        from xbake.xcode import xcode
         rcode = xcode.run(config)
+    elif config.run['mode'] == "xcache":
+        from xbake.xcode import xcache
+        rcode = xcache.run(config)
+    elif config.run['mode'] == "tune":
+        from xbake.xcode import tune
+        rcode = tune.run(config)
     elif config.run['mode'] == "ssonly":
+        from xbake.xcode import ssonly
         rcode = ssonly.run(config)
     elif config.run['mode'] == "scan":
+        from xbake.mscan import mscan
         rcode = mscan.run(config)
     elif config.run['mode'] == "ascan":
+        from xbake import ascan
         rcode = ascan.run(config)
     elif config.run['mode'] == "srv":
+        from xbake.srv import daemon
         daemon.start(config)
     elif config.run['mode'] == "set":
+        from xbake.mscan import mscan
         if config.run['ovr_clear'] is True:
             rcode = mscan.unsetter(config)
         else:
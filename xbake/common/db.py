@@ -15,15 +15,96 @@ https://ycnrg.org/
 """
 # pylint: disable=old-style-class,missing-docstring
 
+import os
+import threading
 from urlparse import urlparse
 
-from pymongo import MongoClient
+from pymongo import MongoClient, ReplaceOne, DeleteOne
 from pymongo.errors import *
 import redis as xredis
 
 from xbake import defaults
 from xbake.common.rcfile import XConfig
 
+# Process-wide client registry
+# Clients are shared by all db.mongo/db.redis objects in a process, keyed by URI
+# (or connection parameters for Redis). The registry is tied to the PID that
+# created it, so a forked child will never re-use sockets inherited from its parent
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+
+def _registry():
+    """
+    return client registry for the current process; drops inherited clients after fork
+    """
+    global _clients, _clients_pid
+    if _clients_pid != os.getpid():
+        _clients = {}
+        _clients_pid = os.getpid()
+    return _clients
+
+def get_mongo_client(uri, pool_size=None, timeout=None):
+    """
+    return a pooled MongoClient for @uri; created on first use
+    @pool_size sets maxPoolSize, @timeout sets the connect & server selection timeouts (seconds)
+    """
+    if pool_size is None: pool_size = defaults['mongo']['pool_size']
+    if timeout is None: timeout = defaults['mongo']['timeout']
+
+    ckey = ('mongo', uri, int(pool_size), int(timeout))
+    with _clients_lock:
+        reg = _registry()
+        if ckey not in reg:
+            reg[ckey] = MongoClient(uri, maxPoolSize=int(pool_size), connectTimeoutMS=int(timeout) * 1000,
+                                    serverSelectionTimeoutMS=int(timeout) * 1000)
+        return reg[ckey]
+
+def get_redis_client(host='localhost', port=6379, db=0, pool_size=None, timeout=None, **kwargs):
+    """
+    return a redis.StrictRedis client backed by a shared connection pool for @host:@port/@db
+    @pool_size sets max_connections, @timeout sets the socket connect timeout (seconds)
+    """
+    if pool_size is None: pool_size = defaults['redis']['pool_size']
+    if timeout is None: timeout = defaults['redis']['timeout']
+
+    ckey = ('redis', host, int(port), int(db), int(pool_size), int(timeout))
+    with _clients_lock:
+        reg = _registry()
+        if ckey not in reg:
+            rpool = xredis.ConnectionPool(host=host, port=int(port), db=int(db), max_connections=int(pool_size),
+                                          socket_connect_timeout=int(timeout), encoding='utf-8',
+                                          decode_responses=True, **kwargs)
+            # StrictRedis keeps the same argument order (eg. for lrem) across redis-py releases
+            reg[ckey] = xredis.StrictRedis(connection_pool=rpool)
+        return reg[ckey]
+
+def reset_clients():
+    """
+    discard all clients in the registry without closing them;
+    should be called in a child process immediately after os.fork()
+    """
+    global _clients, _clients_pid
+    with _clients_lock:
+        _clients = {}
+        _clients_pid = os.getpid()
+
+def close_all():
+    """
+    close all clients created by this process
+    """
+    with _clients_lock:
+        for ckey, tcli in _registry().items():
+            try:
+                if ckey[0] == 'mongo':
+                    tcli.close()
+                else:
+                    tcli.connection_pool.disconnect()
+            except Exception:
+                pass
+        _registry().clear()
+
 
 class mongo:
     """Hotamod class for handling Mongo stuffs"""
@@ -45,7 +126,7 @@ class mongo:
 
         self.silence = silence
         try:
-            self.xcon = MongoClient(uri)
+            self.xcon = get_mongo_client(uri, condata.get('pool_size'), condata.get('timeout'))
         except InvalidURI as e:
             logexc(e, "Invalid mongodb URI (%s)" % (uri))
             failwith(ER.CONF_BAD, "Invalid MongoDB configuration")
@@ -65,13 +146,9 @@ class mongo:
                     loglevel=LL.ERROR)
             failwith(ER.CONF_BAD, "Invalid MongoDB configuration")
 
-    def find(self, collection, query):
-        xresult = {}
-        xri = 0
-        for tresult in self.xcur[collection].find(query):
-            xresult[xri] = tresult
-            xri += 1
-        return xresult
+    def find(self, collection, query, projection=None):
+        """return a cursor over documents in @collection matching @query"""
+        return self.xcur[collection].find(query, projection)
 
     def update_set(self, collection, monid, setter):
         try:
@@ -85,6 +162,11 @@ class mongo:
         except:
             return None
 
+    def upsert_many(self, collection, docs, deletes=None):
+        """replace or insert each document in @docs (by _id), and delete documents with _ids in @deletes, with a single bulk write"""
+        xops = [ReplaceOne({'_id': x['_id']}, x, upsert=True) for x in docs] + [DeleteOne({'_id': x}) for x in (deletes or [])]
+        return self.xcur[collection].bulk_write(xops, ordered=False)
+
     def findOne(self, collection, query):
         return self.xcur[collection].find_one(query)
 
@@ -111,18 +193,13 @@ class mongo:
         return self.xcur.create_collection(collection, **kwargs)
 
     def close(self):
-        if self.xcon:
-            self.xcon.close()
+        """release this object's reference to the pooled client; use db.close_all() to disconnect"""
+        self.xcon = None
+        self.xcur = None
 
-    def __del__(self):
-        """Disconnect from MongoDB"""
-        if self.xcon:
-            self.xcon.close()
-
-class redis:
+class redis(object):
     """Hotamod class for Redis stuffs"""
     rcon = None
-    rpipe = None
     conndata = {}
     rprefix = 'hota'
     silence = False
@@ -131,14 +208,15 @@ class redis:
         """Initialize Redis"""
         from xbake.common.logthis import LL, ER, C, logthis, logexc, failwith
         self.silence = silence
+        self.tlocal = threading.local()
         if cdata is None:
             self.conndata = {'host': "localhost"}
         else:
-            self.conndata = cdata
+            self.conndata = dict(cdata)
         if prefix:
             self.rprefix = prefix
         try:
-            self.rcon = xredis.Redis(encoding='utf-8', decode_responses=True, **self.conndata)
+            self.rcon = get_redis_client(**self.conndata)
         except Exception as e:
             logthis("Error connecting to Redis", loglevel=LL.ERROR, suffix=e)
             return
@@ -147,20 +225,28 @@ class redis:
             logthis("Connected to Redis OK", loglevel=LL.INFO, ccode=C.GRN)
 
 
-    def set(self, xkey, xval, usepipe=False, noprefix=False):
+    @property
+    def rpipe(self):
+        """open pipeline; each thread has its own"""
+        return getattr(self.tlocal, 'rpipe', None)
+
+    @rpipe.setter
+    def rpipe(self, xpipe):
+        self.tlocal.rpipe = xpipe
+
+    def set(self, xkey, xval, usepipe=False, noprefix=False, ttl=None, nx=False):
         if noprefix: zkey = xkey
         else: zkey = '%s:%s' % (self.rprefix, xkey)
-        if usepipe:
-            xrez = self.rpipe.set(zkey, xval)
-        else:
-            xrez = self.rcon.set(zkey, xval)
-        return xrez
+        return self._xcon(usepipe).set(zkey, xval, ex=ttl, nx=nx)
+
+    def expire(self, xkey, ttl, usepipe=False):
+        return self._xcon(usepipe).expire('%s:%s' % (self.rprefix, xkey), ttl)
 
     def get(self, xkey, usepipe=False, noprefix=False):
         if noprefix: zkey = xkey
         else: zkey = '%s:%s' % (self.rprefix, xkey)
         if usepipe:
-            xrez = self.rpipe.set(zkey)
+            xrez = self.rpipe.get(zkey)
         else:
             xrez = self.rcon.get(zkey)
         return xrez
@@ -183,16 +269,31 @@ class redis:
         else: zkey = '%s:%s' % (self.rprefix, xkey)
         return self.rcon.keys(zkey)
 
-    def makepipe(self):
+    def _xcon(self, usepipe):
+        """return the open pipeline if @usepipe is set, otherwise the client"""
+        if usepipe:
+            return self.rpipe
+        else:
+            return self.rcon
+
+    def makepipe(self, transaction=True):
+        """
+        open a pipeline; with @transaction, queued commands are wrapped in MULTI/EXEC
+        so that they are applied atomically in a single round-trip
+        """
         try:
-            self.rpipe = self.rcon.pipeline()
+            self.rpipe = self.rcon.pipeline(transaction=transaction)
         except:
             self.rpipe = None
+        return self.rpipe
 
     def execpipe(self):
+        """execute and close the open pipeline; returns list of results, or None on failure"""
         if self.rpipe:
+            tpipe = self.rpipe
+            self.rpipe = None
             try:
-                return self.rpipe.execute()
+                return tpipe.execute()
             except:
                 return None
 
@@ -202,17 +303,38 @@ class redis:
     def llen(self, qname):
         return self.rcon.llen(self.rprefix+":"+qname)
 
-    def lpop(self, qname):
-        return self.rcon.lpop(self.rprefix+":"+qname)
+    def lpop(self, qname, usepipe=False):
+        return self._xcon(usepipe).lpop(self.rprefix+":"+qname)
+
+    def lpush(self, qname, xval, usepipe=False):
+        return self._xcon(usepipe).lpush(self.rprefix+":"+qname, xval)
+
+    def rpop(self, qname, usepipe=False):
+        return self._xcon(usepipe).rpop(self.rprefix+":"+qname)
+
+    def rpush(self, qname, xval, usepipe=False):
+        return self._xcon(usepipe).rpush(self.rprefix+":"+qname, xval)
+
+    def lrem(self, qname, xval, count=1, usepipe=False):
+        return self._xcon(usepipe).lrem(self.rprefix+":"+qname, count, xval)
 
-    def lpush(self, qname, xval):
-        return self.rcon.lpush(self.rprefix+":"+qname, xval)
+    def lrange(self, qname, start=0, end=-1):
+        return self.rcon.lrange(self.rprefix+":"+qname, start, end)
 
-    def rpop(self, qname):
-        return self.rcon.rpop(self.rprefix+":"+qname)
+    def hset(self, hname, hkey, xval, usepipe=False):
+        return self._xcon(usepipe).hset(self.rprefix+":"+hname, hkey, xval)
 
-    def rpush(self, qname, xval):
-        return self.rcon.rpush(self.rprefix+":"+qname, xval)
+    def hget(self, hname, hkey):
+        return self.rcon.hget(self.rprefix+":"+hname, hkey)
+
+    def hgetall(self, hname):
+        return self.rcon.hgetall(self.rprefix+":"+hname)
+
+    def hdel(self, hname, hkey, usepipe=False):
+        return self._xcon(usepipe).hdel(self.rprefix+":"+hname, hkey)
+
+    def delete(self, xkey, usepipe=False):
+        return self._xcon(usepipe).delete(self.rprefix+":"+xkey)
 
     def blpop(self, qname, timeout=0):
         return self.rcon.blpop(self.rprefix+":"+qname, timeout)
@@ -220,5 +342,25 @@ class redis:
     def brpop(self, qname, timeout=0):
         return self.rcon.brpop(self.rprefix+":"+qname, timeout)
 
+    def lmove_exact(self, qsname, qdname, xval):
+        """
+        atomically remove @xval from list @qsname and RPUSH it on to @qdname;
+        returns False if @xval is no longer in @qsname, or the list changed underneath us
+        """
+        qsrc = self.rprefix+":"+qsname
+        with self.rcon.pipeline() as tpipe:
+            try:
+                tpipe.watch(qsrc)
+                if xval not in tpipe.lrange(qsrc, 0, -1):
+                    tpipe.unwatch()
+                    return False
+                tpipe.multi()
+                tpipe.lrem(qsrc, 1, xval)
+                tpipe.rpush(self.rprefix+":"+qdname, xval)
+                tpipe.execute()
+            except xredis.WatchError:
+                return False
+        return True
+
     def brpoplpush(self, qsname, qdname, timeout=0):
         return self.rcon.brpoplpush(self.rprefix+":"+qsname, self.rprefix+":"+qdname, timeout)
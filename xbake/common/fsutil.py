@@ -14,26 +14,70 @@ https://ycnrg.org/
 
 """
 
+import multiprocessing
 import xattr
 
 # Logging & Error handling
 from xbake.common.logthis import *
 
+# Counters of xattr syscalls issued (and writes skipped, cache hits & failures); shared
+# with forked scan workers, so that the scan master can report totals for the whole scan
+XS_FIELDS = ('list', 'get', 'set', 'remove', 'unchanged', 'cached', 'errors')
+xcounts = multiprocessing.Array('L', len(XS_FIELDS))
 
-def xattr_get(xfile):
+# Attributes of paths read with cache=True (eg. directories); path => dict
+xcache = {}
+
+# Attributes of the last path read without the cache; (path, dict)
+xlast = (None, None)
+
+
+def count(tfield, num=1):
+    """increment xattr counter @tfield by @num"""
+    with xcounts.get_lock():
+        xcounts[XS_FIELDS.index(tfield)] += num
+
+def xattr_stats():
+    """return dict of xattr counters"""
+    return dict(zip(XS_FIELDS, xcounts[:]))
+
+def xattr_reset():
+    """reset xattr counters and the attribute cache; called at the start of each scan"""
+    global xlast
+    with xcounts.get_lock():
+        for i in range(len(XS_FIELDS)):
+            xcounts[i] = 0
+    xcache.clear()
+    xlast = (None, None)
+
+def xattr_get(xfile, cache=False):
     """
     Get extended file attributes
-    Returns a dict with the 'user.' portion stripped from keys
+    Returns a dict with the 'user.' portion stripped from keys, or None on failure
+    Only attributes in the 'user.' namespace are read (one listxattr call, then one
+    getxattr call per attribute). If @cache is True, the result is kept for the rest of the scan
     """
+    global xlast
+    if cache and xfile in xcache:
+        count('cached')
+        return dict(xcache[xfile])
+
     xout = {}
     try:
-        for k, v in xattr.xattr(xfile).iteritems():
-            xout[k.replace('user.', '')] = v
+        tkeys = [k for k in xattr.listxattr(xfile) if k.startswith('user.')]
+        count('list')
+        for k in tkeys:
+            count('get')
+            xout[k[5:]] = xattr.getxattr(xfile, k)
     except Exception as e:
-        logthis("Failed to get extended file attributes for", suffix=xfile, loglevel=LL.WARNING)
-        logthis("xattr:", suffix=e, loglevel=LL.WARNING)
+        count('errors')
+        logthis("Failed to get extended file attributes for %s:" % (xfile), suffix=e, loglevel=LL.WARNING)
         return None
 
+    if cache:
+        xcache[xfile] = dict(xout)
+    else:
+        xlast = (xfile, dict(xout))
     return xout
 
 
@@ -41,14 +85,27 @@ def xattr_set(xfile, xsetter):
     """
     Set extended file attributes
     Accepts a dict with attrib names that are not prefixed with the 'user.' namespace
+    Attributes are only written if they differ from the values last read by xattr_get()
     """
+    if xfile in xcache:
+        xcur = xcache[xfile]
+    elif xlast[0] == xfile:
+        xcur = xlast[1]
+    else:
+        xcur = {}
+
     for k, v in xsetter.iteritems():
+        if xcur.get(str(k)) == str(v):
+            count('unchanged')
+            continue
         try:
+            count('set')
             xattr.setxattr(xfile, 'user.'+str(k), str(v))
         except Exception as e:
-            logthis("Failed to set extended file attributes for", suffix=xfile, loglevel=LL.WARNING)
-            logthis("xattr:", suffix=e, loglevel=LL.WARNING)
+            count('errors')
+            logthis("Failed to set extended file attributes for %s:" % (xfile), suffix=e, loglevel=LL.WARNING)
             return False
+        xcur[str(k)] = str(v)
 
     return True
 
@@ -58,12 +115,14 @@ def xattr_del(xfile, xsetter):
     Remove extended file attributes
     Accepts a list/array with attrib names that are not prefixed with the 'user.' namespace
     """
+    xcache.pop(xfile, None)
     for k in xsetter:
         try:
+            count('remove')
             xattr.removexattr(xfile, 'user.'+str(k))
         except Exception as e:
-            logthis("Failed to remove extended file attributes for", suffix=xfile, loglevel=LL.WARNING)
-            logthis("xattr:", suffix=e, loglevel=LL.WARNING)
+            count('errors')
+            logthis("Failed to remove extended file attributes for %s:" % (xfile), suffix=e, loglevel=LL.WARNING)
             return False
 
     return True
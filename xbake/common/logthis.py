@@ -125,6 +125,10 @@ def logthis(logline, loglevel=LL.DEBUG, prefix=None, suffix=None, ccode=None, st
     # pylint: disable=redefined-outer-name
     global g_loglevel
 
+    # nothing to print or report; skip the (expensive) traceback lookup
+    if loglevel > g_loglevel and loglevel > LL.ERROR:
+        return
+
     zline = ''
     if not ccode:
         if loglevel == LL.ERROR: ccode = C.RED
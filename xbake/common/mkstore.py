@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+xbake.common.mkstore
+Persistent mkey store for incremental scans
+
+@author   Jacob Hipps <jacob@ycnrg.org>
+@repo     https://git.ycnrg.org/projects/YXB/repos/yc_xbake
+
+Copyright (c) 2013-2017 J. Hipps / Neo-Retro Group, Inc.
+https://ycnrg.org/
+
+"""
+
+import os
+import json
+import time
+import sqlite3
+
+# Logging & Error handling
+from xbake.common.logthis import *
+
+
+class MKS:
+    """mkey store file status"""
+    NEW = 'new'
+    CHANGED = 'changed'
+    RENAMED = 'renamed'
+    UNCHANGED = 'unchanged'
+    REMOVED = 'removed'
+
+
+class MKStore(object):
+    """
+    SQLite store of the last scan result for each file, by real path & mkey
+    Only used from a single process (the scan master)
+    """
+    def __init__(self, dbpath):
+        self.dbpath = os.path.realpath(os.path.expanduser(dbpath))
+        if not os.path.isdir(os.path.dirname(self.dbpath)):
+            os.makedirs(os.path.dirname(self.dbpath))
+        try:
+            self.conn = sqlite3.connect(self.dbpath)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mkey TEXT NOT NULL, "
+                              "record TEXT NOT NULL, updated REAL NOT NULL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS files_mkey ON files (mkey)")
+        except sqlite3.Error as e:
+            failwith(ER.CONF_BAD, "Failed to open mkey store %s: %s" % (self.dbpath, e))
+        logthis("Opened mkey store:", suffix=self.dbpath, loglevel=LL.VERBOSE)
+
+    def check(self, path, mkey):
+        """
+        determine status of file @path with mkey @mkey
+        returns tuple (status, previous path, previous record); there is no previous
+        path or record for new files
+        A file is renamed if another path with the same mkey is stored and that path no longer exists
+        """
+        trow = self.conn.execute("SELECT mkey, record FROM files WHERE path = ?", (path,)).fetchone()
+        if trow is not None:
+            if trow[0] == mkey:
+                return (MKS.UNCHANGED, path, json.loads(trow[1]))
+            return (MKS.CHANGED, path, json.loads(trow[1]))
+
+        for opath, orec in self.conn.execute("SELECT path, record FROM files WHERE mkey = ?", (mkey,)):
+            if not os.path.exists(opath):
+                return (MKS.RENAMED, opath, json.loads(orec))
+        return (MKS.NEW, None, None)
+
+    def put(self, path, mkey, record):
+        """store scan result @record for file @path"""
+        self.conn.execute("INSERT OR REPLACE INTO files (path, mkey, record, updated) VALUES (?, ?, ?, ?)",
+                          (path, mkey, json.dumps(record), time.time()))
+
+    def move(self, opath, path, record):
+        """move entry for @opath to @path, replacing its record with @record"""
+        self.conn.execute("UPDATE files SET path = ?, record = ?, updated = ? WHERE path = ?",
+                          (path, json.dumps(record), time.time(), opath))
+
+    def prune(self, root, seen):
+        """
+        remove entries for files below directory @root that are not in set @seen
+        returns dict of removed path => record
+        """
+        root = root.rstrip('/')
+        removed = dict((x[0], json.loads(x[1])) for x in self.conn.execute("SELECT path, record FROM files WHERE path > ? AND path < ?",
+                                                                        (root + u'/', root + u'0')) if x[0] not in seen)
+        self.conn.executemany("DELETE FROM files WHERE path = ?", [(x,) for x in removed])
+        return removed
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
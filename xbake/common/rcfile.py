@@ -16,54 +16,107 @@ https://ycnrg.org/
 
 import os
 import re
+import copy
 import json
+import time
 import codecs
+import hashlib
 import ConfigParser
 
 from xbake import defaults
 from xbake.common.logthis import *
 
+# Config files, highest priority first
 rcfiles = ['./xbake.conf', '~/.xbake/xbake.conf', '~/.xbake', '/etc/xbake.conf']
 rcpar = None
 
+# Info about the most recently loaded config, for reload()
+# generation is incremented each time a config with different values is loaded
+loadinfo = {'generation': 0, 'hash': None, 'files': [], 'mtimes': {}, 'loaded': None, 'xtra': None, 'cliopts': None}
 
-class XConfig(object):
+
+class XConfig(dict):
     """
     Config management object; allow access via attributes or items
+    Sections (nested dicts) are wrapped once, when the config is built, and are also set
+    as instance attributes, so that config.scan['tempdir'] is two plain lookups. A frozen
+    config (as returned by loadConfig()) cannot be modified; use _clone() to override values
     """
-    __data = {}
-
-    def __init__(self, idata):
-        self.__data = idata
+    _frozen = False
+
+    def __init__(self, idata, frozen=False):
+        dict.__init__(self)
+        for tkey, tval in idata.items():
+            if isinstance(tval, dict) and not isinstance(tval, XConfig):
+                tval = XConfig(tval, frozen)
+            self._set(tkey, tval)
+        self._frozen = frozen
+
+    def _set(self, aname, aval):
+        dict.__setitem__(self, aname, aval)
+        if isinstance(aval, XConfig) and isinstance(aname, basestring) and not hasattr(dict, aname):
+            self.__dict__[aname] = aval
+        else:
+            self.__dict__.pop(aname, None)
 
     def _dump(self):
-        return json.dumps(self.__data)
+        return json.dumps(self)
 
     def _todict(self):
-        return json.loads(json.dumps(self.__data))
-
-    def _clone(self):
-        return XConfig(json.loads(json.dumps(self.__data)))
+        return dict([(k, v._todict() if isinstance(v, XConfig) else copy.deepcopy(v)) for k, v in self.items()])
+
+    def _clone(self, overrides=None):
+        """
+        return a copy of this config, with values from @overrides ({section: {key: value}})
+        sections are copied, but the values themselves are shared with this config
+        """
+        overrides = overrides or {}
+        xnew = XConfig({}, self._frozen)
+        for tkey, tval in self.items():
+            if isinstance(tval, XConfig):
+                tsec = XConfig({}, self._frozen)
+                dict.update(tsec, tval)
+                dict.update(tsec, overrides.get(tkey, {}))
+                tval = tsec
+            xnew._set(tkey, tval)
+        for tkey in overrides:
+            if tkey not in self:
+                xnew._set(tkey, XConfig(overrides[tkey], self._frozen))
+        return xnew
+
+    def __copy__(self):
+        return self._clone()
+
+    def __deepcopy__(self, memo):
+        return XConfig(self._todict(), self._frozen)
 
     def __getattr__(self, aname):
-        if aname in self.__data:
-            if isinstance(self.__data[aname], dict):
-                return XConfig(self.__data[aname])
-            else:
-                return self.__data[aname]
-        elif isinstance(aname, int):
-            return self.__data.keys()[aname]
-        else:
-            raise KeyError(aname)
-
-    def __getitem__(self, aname):
-        return self.__getattr__(aname)
+        try:
+            return self[aname]
+        except KeyError:
+            if aname.startswith('__'):
+                raise AttributeError(aname)
+            raise
 
     def __setitem__(self, aname, aval):
-        self.__data[aname] = aval
+        if self._frozen:
+            raise TypeError("config is read-only; use _clone() to override '%s'" % (aname))
+        self._set(aname, aval)
+
+    def __delitem__(self, aname):
+        if self._frozen:
+            raise TypeError("config is read-only; unable to delete '%s'" % (aname))
+        dict.__delitem__(self, aname)
+        self.__dict__.pop(aname, None)
+
+    def update(self, *args, **kwargs):
+        if self._frozen:
+            raise TypeError("config is read-only; use _clone() to override values")
+        for tkey, tval in dict(*args, **kwargs).items():
+            self._set(tkey, tval)
 
     def __str__(self):
-        return print_r(self.__data)
+        return print_r(self)
 
     def __repr__(self):
         return "<XConfig>"
@@ -78,7 +131,7 @@ def rcList(xtraConf=None):
 
     if xtraConf:
         xcf = os.path.expanduser(xtraConf)
-        if os.path.exists(xcf):
+        if os.path.isfile(xcf):
             rcc.append(xcf)
             logthis("Added rcfile candidate (from command line):", suffix=xcf, loglevel=LL.DEBUG)
         else:
@@ -87,7 +140,7 @@ def rcList(xtraConf=None):
     for tf in rcfiles:
         ttf = os.path.expanduser(tf)
         logthis("Checking for rcfile candidate", suffix=ttf, loglevel=LL.DEBUG2)
-        if os.path.exists(ttf):
+        if os.path.isfile(ttf):
             rcc.append(ttf)
             logthis("Got rcfile candidate", suffix=ttf, loglevel=LL.DEBUG2)
 
@@ -96,20 +149,21 @@ def rcList(xtraConf=None):
 
 def parse(xtraConf=None):
     """
-    Parse rcfile (xbake.conf)
-    Output: (rcfile, rcdata)
+    Parse rcfiles (xbake.conf)
+    All files found are parsed in order of priority (system, then user, then local, then
+    @xtraConf), with values in each file overriding those from the previous files
+    Output: (rcfiles, rcdata), or False if a file could not be parsed
     """
     global rcpar
     # get rcfile list
     rcl = rcList(xtraConf)
     logthis("Parsing any local, user, or system RC files...", loglevel=LL.DEBUG)
 
-    # use ConfigParser to parse the rcfiles
-    # only first file is parsed for now, implement override system eventually
+    # use ConfigParser to parse the rcfiles, lowest priority first
     rcpar = ConfigParser.SafeConfigParser()
-    rcfile = None
-    if len(rcl):
-        rcfile = os.path.realpath(rcl[0])
+    rcparsed = []
+    for rcfile in reversed(rcl):
+        rcfile = os.path.realpath(rcfile)
         logthis("Parsing config file:", suffix=rcfile, loglevel=LL.VERBOSE)
         try:
             # use ConfigParser.readfp() so that we can correctly parse UTF-8 stuffs
@@ -119,6 +173,7 @@ def parse(xtraConf=None):
         except ConfigParser.ParsingError as e:
             logthis("Error parsing config file: %s" % e, loglevel=LL.ERROR)
             return False
+        rcparsed.append(rcfile)
 
     # build a dict
     rcdict = {}
@@ -131,8 +186,8 @@ def parse(xtraConf=None):
             logthis(">> %s" % ii[0], suffix=ii[1], loglevel=LL.DEBUG2)
             rcdict[ss][ii[0]] = ii[1]
 
-    # return loaded filename and rcdata
-    return (rcfile, rcdict)
+    # return loaded filenames and rcdata
+    return (rcparsed, rcdict)
 
 
 def merge(inrc, cops):
@@ -241,7 +296,59 @@ def loadConfig(xtraConf=None, cliopts=None):
     """
     Top-level class for loading configuration from xbake.conf
     """
-    rcfile, rci = parse(xtraConf)  #pylint: disable=unused-variable
-    cxopt = optexpand(cliopts)
+    rcparsed = parse(xtraConf)
+    if rcparsed is False:
+        failwith(ER.CONF_BAD, "Unable to parse config file. Aborting.")
+    rcl, rci = rcparsed
+    cxopt = optexpand(cliopts or {})
     optrc = merge(rci, cxopt)
-    return XConfig(optrc)
+    xconfig = XConfig(optrc, frozen=True)
+
+    xhash = config_hash(xconfig)
+    if xhash != loadinfo['hash']:
+        loadinfo['generation'] += 1
+    loadinfo.update(hash=xhash, files=rcl, mtimes=get_mtimes(xtraConf), loaded=time.time(), xtra=xtraConf, cliopts=cliopts)
+    return xconfig
+
+def config_hash(xconfig):
+    """return hash of the values in @xconfig"""
+    return hashlib.sha1(json.dumps(xconfig, sort_keys=True)).hexdigest()
+
+def get_mtimes(xtraConf=None):
+    """
+    return dict of modification times of all config file candidates (None if the file does not exist)
+    """
+    mtimes = {}
+    for tf in ([xtraConf] if xtraConf else []) + rcfiles:
+        ttf = os.path.expanduser(tf)
+        try:
+            mtimes[ttf] = os.stat(ttf).st_mtime
+        except OSError:
+            mtimes[ttf] = None
+    return mtimes
+
+def changed():
+    """
+    return True if any config file has been created, modified, or removed since the config was loaded
+    """
+    return get_mtimes(loadinfo['xtra']) != loadinfo['mtimes']
+
+def reload():
+    """
+    Reload configuration, using the same rcfile & CLI options as the last call to loadConfig()
+    returns the new config, or None if the values have not changed or the config could not be loaded
+    (in which case the current config remains in use)
+    """
+    lastgen = loadinfo['generation']
+    try:
+        xconfig = loadConfig(loadinfo['xtra'], loadinfo['cliopts'])
+    except Exception as e:
+        logexc(e, "Failed to reload config; keeping current config")
+        loadinfo['mtimes'] = get_mtimes(loadinfo['xtra'])
+        return None
+
+    if loadinfo['generation'] == lastgen:
+        logthis("Config reloaded; no changes", loglevel=LL.VERBOSE)
+        return None
+    logthis("Config reloaded. Generation:", suffix=loadinfo['generation'], loglevel=LL.INFO)
+    return xconfig
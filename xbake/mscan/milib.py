@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+xbake.mscan.milib
+Native libmediainfo interface
+
+@author   Jacob Hipps <jacob@ycnrg.org>
+@repo     https://git.ycnrg.org/projects/YXB/repos/yc_xbake
+
+Copyright (c) 2013-2017 J. Hipps / Neo-Retro Group, Inc.
+https://ycnrg.org/
+
+"""
+
+import os
+import sys
+import threading
+import ctypes
+import ctypes.util
+from ctypes import c_void_p, c_size_t, c_wchar_p, c_int
+
+from xbake.common.logthis import *
+
+
+class MIS:
+    """libmediainfo stream kinds"""
+    GENERAL = 0
+    VIDEO = 1
+    AUDIO = 2
+    TEXT = 3
+    OTHER = 4
+    IMAGE = 5
+    MENU = 6
+
+class MII:
+    """libmediainfo info kinds"""
+    NAME = 0
+    TEXT = 1
+
+# Stream kinds to probe, and their track type (as named by pymediainfo)
+streams = ((MIS.GENERAL, 'General'), (MIS.VIDEO, 'Video'), (MIS.AUDIO, 'Audio'), (MIS.TEXT, 'Text'), (MIS.MENU, 'Menu'))
+
+# pymediainfo attribute name => libmediainfo parameter
+params = {
+            'id': u"ID",
+            'unique_id': u"UniqueID",
+            'format': u"Format",
+            'format_profile': u"Format_Profile",
+            'codec_id': u"CodecID",
+            'duration': u"Duration",
+            'overall_bit_rate': u"OverallBitRate",
+            'encoded_date': u"Encoded_Date",
+            'writing_application': u"Encoded_Application",
+            'writing_library': u"Encoded_Library",
+            'encoding_settings': u"Encoded_Library_Settings",
+            'width': u"Width",
+            'height': u"Height",
+            'display_aspect_ratio': u"DisplayAspectRatio",
+            'original_display_aspect_ratio': u"DisplayAspectRatio_Original",
+            'frame_rate': u"FrameRate",
+            'color_space': u"ColorSpace",
+            'chroma_subsampling': u"ChromaSubsampling",
+            'bit_depth': u"BitDepth",
+            'scan_type': u"ScanType",
+            'title': u"Title",
+            'language': u"Language",
+            'channel_s': u"Channel(s)",
+            'sampling_rate': u"SamplingRate",
+            'default': u"Default",
+            'forced': u"Forced"
+         }
+
+# libmediainfo CDLL; False if it could not be loaded
+lib = None
+
+# libmediainfo handle for each thread
+tlocal = threading.local()
+
+
+def load():
+    """
+    load libmediainfo; returns True if it is available
+    """
+    global lib
+    if lib is None:
+        try:
+            tlib = ctypes.CDLL(ctypes.util.find_library('mediainfo') or 'libmediainfo.so.0')
+            tlib.MediaInfo_New.argtypes = []
+            tlib.MediaInfo_New.restype = c_void_p
+            tlib.MediaInfo_Open.argtypes = [c_void_p, c_wchar_p]
+            tlib.MediaInfo_Open.restype = c_size_t
+            tlib.MediaInfo_Close.argtypes = [c_void_p]
+            tlib.MediaInfo_Close.restype = None
+            tlib.MediaInfo_Count_Get.argtypes = [c_void_p, c_int, c_size_t]
+            tlib.MediaInfo_Count_Get.restype = c_size_t
+            tlib.MediaInfo_Get.argtypes = [c_void_p, c_int, c_size_t, c_wchar_p, c_int, c_int]
+            tlib.MediaInfo_Get.restype = c_wchar_p
+            tlib.MediaInfo_GetI.argtypes = [c_void_p, c_int, c_size_t, c_size_t, c_int]
+            tlib.MediaInfo_GetI.restype = c_wchar_p
+        except (OSError, AttributeError) as e:
+            logthis("libmediainfo not available; using pymediainfo:", suffix=e, loglevel=LL.VERBOSE)
+            lib = False
+        else:
+            lib = tlib
+    return bool(lib)
+
+def get_handle():
+    """
+    return libmediainfo handle for the current thread (and process), creating it if needed
+    """
+    if getattr(tlocal, 'pid', None) != os.getpid():
+        tlocal.handle = lib.MediaInfo_New()
+        tlocal.pid = os.getpid()
+    return tlocal.handle
+
+def get_chapters(handle):
+    """
+    return chapters from the menu stream as a dict, in the same format as pymediainfo
+    (eg. {'00_06_11950': "en:Chapter 2"})
+    """
+    chaps = {}
+    try:
+        cbegin = int(lib.MediaInfo_Get(handle, MIS.MENU, 0, u"Chapters_Pos_Begin", MII.TEXT, MII.NAME) or 0)
+        cend = int(lib.MediaInfo_Get(handle, MIS.MENU, 0, u"Chapters_Pos_End", MII.TEXT, MII.NAME) or 0)
+    except ValueError:
+        return chaps
+    for i in range(cbegin, cend):
+        cname = lib.MediaInfo_GetI(handle, MIS.MENU, 0, i, MII.NAME)
+        if cname:
+            chaps[cname.replace(':', '_', 2).replace('.', '')] = lib.MediaInfo_GetI(handle, MIS.MENU, 0, i, MII.TEXT)
+    return chaps
+
+def probe(fname, fields):
+    """
+    retrieve attributes in @fields for each track of @fname
+    returns a list of track dicts, as from pymediainfo's to_data()['tracks'],
+    or None if the file could not be opened
+    """
+    if not isinstance(fname, unicode):
+        try:
+            fname = fname.decode(sys.getfilesystemencoding() or 'utf-8')
+        except UnicodeDecodeError:
+            return None
+
+    handle = get_handle()
+    if not lib.MediaInfo_Open(handle, fname):
+        return None
+
+    tplist = [(tkey, params[tkey]) for tkey in fields if tkey in params]
+    tracks = []
+    try:
+        for skind, stype in streams:
+            for snum in range(lib.MediaInfo_Count_Get(handle, skind, -1)):
+                tdata = {'track_type': stype}
+                if skind == MIS.MENU:
+                    tdata.update(get_chapters(handle))
+                else:
+                    for tkey, tparam in tplist:
+                        tval = lib.MediaInfo_Get(handle, skind, snum, tparam, MII.TEXT, MII.NAME)
+                        if tval:
+                            # integer values are converted, as pymediainfo does
+                            tdata[tkey] = int(tval) if tval.isdigit() else tval
+                tracks.append(tdata)
+    finally:
+        lib.MediaInfo_Close(handle)
+
+    return tracks
@@ -62,6 +62,12 @@ fext = re.compile(r'\.(avi|mkv|mpg|mpeg|wmv|vp8|ogm|mp4|mpv)', re.I)
 
 config = None
 
+# Override index for the current scan (OverrideIndex)
+ovindex = None
+
+# Parsed .xbake files, kept across scans; path => (mtime, overrides)
+xbake_memo = {}
+
 def run(xconfig):
     """
     Implements --scan mode
@@ -87,6 +93,7 @@ def run(xconfig):
         pass
 
     # Examine and enumerate files
+    fsutil.xattr_reset()
     if config.run['single']:
         new_files, flist = scan_single(config.run['infile'], config.scan['mforce'], config.scan['nochecksum'], config.scan['savechecksum'])
     else:
@@ -105,8 +112,12 @@ def run(xconfig):
                 'duration': 0, # FIXME
                 'topmost': os.path.realpath(config.run['infile']),
                 'command': ' '.join(sys.argv),
-                'version': __version__
+                'version': __version__,
+                'xattr': fsutil.xattr_stats(),
+                'overrides': ovindex.stats()
             }
+    logthis("xattr calls:", suffix=hdata['xattr'], loglevel=LL.VERBOSE)
+    logthis("Override resolution: {dirs} directories ({overrides} with overrides) in {time:.3f}s".format(**hdata['overrides']), loglevel=LL.INFO)
 
     # Build main output structure
     odata = {
@@ -116,12 +127,11 @@ def run(xconfig):
             }
 
     # Parse outfile
-    if not config.run['outfile']:
-        config.run['outfile'] = config.scan['output']
-
     # If no file defined, or '-', write to stdout
-    if not config.run['outfile'] or config.run['outfile'] == '-':
-        config.run['outfile'] = '/dev/stdout'
+    outfile = config.run['outfile'] or config.scan['output']
+    if not outfile or outfile == '-':
+        outfile = '/dev/stdout'
+    config = config._clone({'run': {'outfile': outfile}})
 
     # Parse URLs
     ofp = urlparse(config.run['outfile'])
@@ -194,7 +204,7 @@ def unsetter(xconfig):
     Remove overrides for a file or directory
     """
     infile = xconfig.run['infile']
-    dlist = list(fsutil.xattr_get(infile))
+    dlist = list(fsutil.xattr_get(infile) or {})
     logthis("Removing overrides:\n", suffix=print_r(dlist), loglevel=LL.VERBOSE)
     fsutil.xattr_del(infile, dlist)
     logthis("Overrides cleared.", ccode=C.GRN, loglevel=LL.INFO)
@@ -211,8 +221,10 @@ def scan_dir(dpath, dreflinks=True, mforce=False, nochecksum=False, savechecksum
     """
     Scan a directory recursively; follows symlinks by default
     """
+    global ovindex
     ddex = {}
     new_files = 0
+    ovindex = OverrideIndex()
 
     if dryrun is False:
         ## Set up workers and IPC
@@ -234,19 +246,16 @@ def scan_dir(dpath, dreflinks=True, mforce=False, nochecksum=False, savechecksum
         # get base & parent dir names
         tdir_base = os.path.split(tdir)[1]  # pylint: disable=unused-variable
         tdir_parent = os.path.split(os.path.split(tdir)[0])[1]  # pylint: disable=unused-variable
-        ovrx = {}
 
-        # Get xattribs
-        ovrx = parse_xattr_overrides(tdir)
+        # Get overrides (xattribs & .xbake), inherited from the parent directory
+        ovrx = ovindex.resolve(tdir, flist)
 
-        # Check if ignore flag is set for this directory (xattribs only)
-        if ovrx.has_key('ignore'):
+        # Check if ignore flag is set for this directory (xattribs only); skip its subdirectories, too
+        if ovrx is None:
             logthis("Skipping directory, has 'ignore' flag set in xattribs:", suffix=tdir, loglevel=LL.INFO)
+            del dlist[:]
             continue
 
-        # Parse overrides for this directory
-        ovrx.update(parse_overrides(tdir))
-
         if dryrun is False:
             logthis("*** Scanning files in directory:", suffix=tdir, loglevel=LL.INFO)
 
@@ -329,13 +338,20 @@ def scan_single(dfile, mforce=False, nochecksum=False, savechecksum=True):
     """
     Scan a single media file
     """
+    global ovindex
     ddex = {}
     new_files = 0
+    ovindex = OverrideIndex()
 
-    # Parse overrides for directory the file is in
+    # Resolve overrides from the scan root down to the directory the file is in
     tdir = os.path.dirname(os.path.realpath(dfile))
-    ovrx = parse_xattr_overrides(tdir)
-    ovrx.update(parse_overrides(tdir))
+    ovrx = ovindex.resolve_path(tdir, config.scan['root'])
+    if ovrx is None:
+        logthis("Skipping file, directory has 'ignore' flag set in xattribs:", suffix=tdir, loglevel=LL.INFO)
+        return (new_files, ddex)
+    if check_overrides(ovrx, os.path.basename(dfile)):
+        logthis("Skipping file. Matched rule in override ignore list:", suffix=dfile, loglevel=LL.INFO)
+        return (new_files, ddex)
     ovrx = clean_overrides(ovrx)
 
     dasc = scanfile(dfile, ovrx=ovrx, mforce=mforce, nochecksum=nochecksum, savechecksum=savechecksum)
@@ -594,16 +610,19 @@ xaov_map = {
                 'checksum.ed2k': "ed2k",
                 'checksum.crc32': "crc32",
                 'checksum.sha1': "sha1",
+                'checksum.payload_md5': "payload_md5",
+                'checksum.mkey': "checksum_mkey",
                 'xbake.ignore': "ignore",
                 'xbake.tdex': "tdex"
             }
 
-def parse_xattr_overrides(xpath):
+def parse_xattr_overrides(xpath, cache=False):
     """
     Parse overrides from extended file attributes
+    if @cache is True, attributes are only read once per scan (used for directories)
     """
     xrides = {}
-    xatr = fsutil.xattr_get(xpath)
+    xatr = fsutil.xattr_get(xpath, cache=cache) or {}
 
     for xk, xv in xatr.iteritems():
         if xaov_map.has_key(xk):
@@ -645,7 +664,7 @@ def check_overrides(ovx, cfile):
     Return: True if match (file should be skipped/ignored)
             False if no match (file should be processed as usual)
     """
-    if isinstance(ovx, list):
+    if isinstance(ovx, dict):
         if 'ignore' in ovx:
             for ii in ovx['ignore']:
                 if unicode(ii) == unicode(cfile):
@@ -653,6 +672,93 @@ def check_overrides(ovx, cfile):
     return False
 
 
+class OverrideIndex(object):
+    """
+    Directory overrides (xattribs & .xbake files) for a single scan root
+    Overrides are inherited from the parent directory, so directories must be resolved
+    top-down (as walked by os.walk, or with resolve_path()). A directory is only checked for
+    a .xbake file if it appears in its file listing, and parsed .xbake files are memoized by mtime
+    """
+    def __init__(self):
+        # directory => (mtime, inheritable overrides); overrides are None if the directory is ignored
+        # mtime is that of the .xbake file, or of the directory if it only has xattrib overrides;
+        # it is None for directories without overrides, which are not stat'd
+        self.dirs = {}
+        self.rtime = 0.0
+        self.found = 0
+
+    def resolve(self, tdir, flist=None):
+        """
+        return overrides for directory @tdir, or None if it has the 'ignore' flag set in xattribs
+        @flist is the list of files in @tdir; if None, the directory is checked for a .xbake file
+        """
+        t_start = time.time()
+        ovrx = dict(self.dirs.get(os.path.dirname(tdir), (None, None))[1] or {})
+        xatr = parse_xattr_overrides(tdir, cache=True)
+        if 'ignore' in xatr:
+            self.dirs[tdir] = (None, None)
+            self.rtime += time.time() - t_start
+            return None
+        ovrx.update(xatr)
+
+        xfile = tdir + '/.xbake'
+        xfound = (flist is None and os.path.exists(xfile)) or (flist is not None and '.xbake' in flist)
+        tmtime = None
+        if xfound:
+            ovrx.update(self.parse(xfile))
+            tmtime = xbake_memo.get(xfile, (None, None))[0]
+        elif xatr:
+            try:
+                tmtime = os.stat(tdir).st_mtime
+            except OSError:
+                pass
+        if xatr or xfound:
+            self.found += 1
+
+        self.dirs[tdir] = (tmtime, clean_overrides(ovrx))
+        self.rtime += time.time() - t_start
+        return ovrx
+
+    def resolve_path(self, tdir, root=None, flist=None):
+        """
+        resolve overrides for each directory from @root down to @tdir, so that @tdir gets the
+        same overrides as in a scan of @root. If @root is not set, or @tdir is not below it,
+        only @tdir itself is resolved
+        returns overrides for @tdir, or None if it (or a directory above it) is ignored
+        @flist is the list of files in @tdir, if already known
+        """
+        tdir = os.path.realpath(tdir)
+        tpath = [tdir]
+        if root:
+            root = os.path.realpath(root)
+            if tdir == root or tdir.startswith(root.rstrip('/') + '/'):
+                while tpath[-1] != root:
+                    tpath.append(os.path.dirname(tpath[-1]))
+            else:
+                logthis("Directory is not below scan root %s; only its own overrides are used:" % (root), suffix=tdir, loglevel=LL.VERBOSE)
+
+        for pdir in reversed(tpath[1:]):
+            if self.resolve(pdir) is None:
+                logthis("Directory has 'ignore' flag set in xattribs:", suffix=pdir, loglevel=LL.VERBOSE)
+                return None
+        return self.resolve(tdir, flist)
+
+    def parse(self, xfile):
+        """return parsed .xbake file @xfile, from xbake_memo if unchanged"""
+        try:
+            tmtime = os.stat(xfile).st_mtime
+        except OSError as e:
+            logthis("Failed to stat overrides file:", suffix=e, loglevel=LL.WARNING)
+            return {}
+        if xfile not in xbake_memo or xbake_memo[xfile][0] != tmtime:
+            xbake_memo[xfile] = (tmtime, parse_overrides(os.path.dirname(xfile)))
+        return xbake_memo[xfile][1]
+
+    def stats(self):
+        """return dict of override resolution stats"""
+        return {'dirs': len(self.dirs), 'overrides': self.found, 'time': round(self.rtime, 6)}
+
+
 def clean_overrides(ovrx):
     """
     Remove unnecessary keys from overrides structure; return new cleaned copy
@@ -39,7 +39,7 @@ def to_mongo(indata, moncon):
 
     slist = []
     eplist = []
-    for sname, sdata in indata['series'].iteritems():
+    for sname, sdata in indata.get('series', {}).iteritems():
         thisx = {}
 
         # if ctitle not set, skip this series
@@ -82,7 +82,8 @@ def to_mongo(indata, moncon):
     up2dater = {
                 'series': {'new': 0, 'updated': 0, 'nc': 0, 'total': 0, 'upserted': 0, 'errors': 0},
                 'episodes': {'new': 0, 'updated': 0, 'nc': 0, 'total': 0, 'upserted': 0, 'errors': 0},
-                'files': {'new': 0, 'updated': 0, 'nc': 0, 'total': 0, 'upserted': 0, 'errors': 0}
+                'files': {'new': 0, 'updated': 0, 'nc': 0, 'total': 0, 'upserted': 0, 'errors': 0},
+                'albums': {'new': 0, 'updated': 0, 'total': 0, 'upserted': 0, 'deleted': 0, 'errors': 0}
                }
 
     # Series Data
@@ -170,6 +171,13 @@ def to_mongo(indata, moncon):
         if fdata is False:
             logthis("!! Skipping file", suffix=fname, loglevel=LL.VERBOSE)
             continue
+        if 'checksum' not in fdata:
+            logthis("!! Skipping file without checksum", suffix=fname, loglevel=LL.VERBOSE)
+            continue
+        if 'mediainfo' not in fdata:
+            # audio tracks are only written as part of their album
+            logthis("!! Skipping audio track", suffix=fname, loglevel=LL.VERBOSE)
+            continue
         thisf = {}
         md5 = fdata['checksum']['md5']
         up2dater['files']['total'] += 1
@@ -235,6 +243,24 @@ def to_mongo(indata, moncon):
         up2dater['files']['upserted'] += 1
 
 
+    ## Album data (audio scans); all albums are written with a single bulk write
+    ## Albums left with no tracks (all moved or removed) are deleted in the same write
+    albums = indata.get('albums') or {}
+    if albums:
+        alive = [x for x in albums.values() if x['track_count'] > 0]
+        empty = [x['_id'] for x in albums.values() if x['track_count'] == 0]
+        logthis("Upserting %d albums into Mongo, deleting %d empty albums..." % (len(alive), len(empty)), loglevel=LL.VERBOSE)
+        up2dater['albums']['total'] = len(albums)
+        try:
+            bres = monjer.upsert_many("albums", alive, deletes=empty)
+            up2dater['albums']['new'] = bres.upserted_count
+            up2dater['albums']['updated'] = bres.matched_count
+            up2dater['albums']['upserted'] = bres.upserted_count + bres.matched_count
+            up2dater['albums']['deleted'] = bres.deleted_count
+        except Exception as e:
+            logthis("!! Album upsert failed.", suffix=e, loglevel=LL.ERROR)
+            up2dater['albums']['errors'] = len(albums)
+
     # Build status information
     status_out = {
                     'ok': True,
@@ -243,7 +269,7 @@ def to_mongo(indata, moncon):
                     'stats': up2dater
                  }
 
-    if up2dater['files']['upserted'] < 1:
+    if up2dater['files']['upserted'] + up2dater['albums']['upserted'] + up2dater['albums']['deleted'] < 1:
         status_out['http_status'] = "216 Nothing Added"
         status_out['status'] = "warning"
         status_out['message'] = "No files were added"
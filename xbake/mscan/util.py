@@ -22,15 +22,11 @@ import grp
 import hashlib
 import errno
 
-from pymediainfo import MediaInfo
-
 from xbake.common.logthis import *
+from xbake.mscan import milib
 
-try:
-    from xbake import rhash as librhash
-except Exception as e:
-    logexc(e, "Failed to import RHash bindings")
-    failwith(ER.DEPMISSING, "Please install librhash shared libraries from Git or your package manager")
+# RHash bindings; loaded on first use (see get_librhash())
+librhash = None
 
 RHSLUT = {
             0x01: "CRC32",
@@ -61,17 +57,35 @@ RHSLUT = {
             0x2000000: "SHA3_512"
         }
 
+# Read size for rhash_ranges()
+RH_BLOCK = 1048576
+
+def get_librhash():
+    """
+    return RHash bindings module, loading librhash if needed
+    """
+    global librhash
+    if librhash is None:
+        try:
+            from xbake import rhash as xrhash
+        except Exception as e:
+            logexc(e, "Failed to import RHash bindings")
+            failwith(ER.DEPMISSING, "Please install librhash shared libraries from Git or your package manager")
+        librhash = xrhash
+    return librhash
+
 def md5sum(fname):
     """
     Use rhash to calculate the MD5 checksum of @fname, then return MD5 as a string
     """
-    return rhash(fname, librhash.MD5)['md5']
+    return rhash(fname, get_librhash().MD5)['md5']
 
 def checksum(fname):
     """
     Use rhash to calculate checksums of @fname, then return as a dict {md5, crc32, ed2k}
     """
-    hout = rhash(fname, [librhash.MD5, librhash.CRC32, librhash.ED2K])
+    rhx = get_librhash()
+    hout = rhash(fname, [rhx.MD5, rhx.CRC32, rhx.ED2K])
     hout['crc32'] = hout['crc32'].upper()
     return hout
 
@@ -86,7 +100,7 @@ def rhash(infile, hlist):
 
     # run RHash for chosen hashes against infile
     t_start = time.time()
-    rh = librhash.RHash(sum(hxlist))
+    rh = get_librhash().RHash(sum(hxlist))
     rh.update_file(infile)
     rh.finish()
     t_duration = time.time() - t_start
@@ -97,6 +111,54 @@ def rhash(infile, hlist):
         hout[RHSLUT[thash].lower()] = rh.hex(thash)
     return hout
 
+def rhash_ranges(infile, hlist, ranges, whole=None):
+    """
+    Use librhash to calculate hashes @hlist over byte @ranges (sorted list of (start, end)
+    offsets) of @infile; if @whole is a list of hashes, they are calculated over the entire
+    file in the same read. Otherwise, only the ranges are read
+    returns tuple (whole file hashes or None, range hashes)
+    """
+    rhx = get_librhash()
+    t_start = time.time()
+    rh = rhx.RHash(sum(hlist))
+    rw = rhx.RHash(sum(whole)) if whole else None
+
+    with open(infile, 'rb') as f:
+        if rw is None:
+            for rstart, rend in ranges:
+                f.seek(rstart)
+                tleft = rend - rstart
+                while tleft > 0:
+                    buf = f.read(min(RH_BLOCK, tleft))
+                    if not buf:
+                        break
+                    rh.update(buf)
+                    tleft -= len(buf)
+        else:
+            tpos = 0
+            ridx = 0
+            buf = f.read(RH_BLOCK)
+            while buf:
+                tend = tpos + len(buf)
+                rw.update(buf)
+                while ridx < len(ranges) and ranges[ridx][0] < tend:
+                    rstart, rend = ranges[ridx]
+                    rh.update(buf[max(rstart - tpos, 0):min(rend, tend) - tpos])
+                    if rend > tend:
+                        break
+                    ridx += 1
+                tpos = tend
+                buf = f.read(RH_BLOCK)
+
+    rh.finish()
+    hout = dict([(RHSLUT[x].lower(), rh.hex(x)) for x in hlist])
+    wout = None
+    if rw is not None:
+        rw.finish()
+        wout = dict([(RHSLUT[x].lower(), rw.hex(x)) for x in whole])
+    logthis("librhash runtime:", suffix=str(time.time() - t_start), loglevel=LL.DEBUG)
+    return (wout, hout)
+
 def dstat(infile):
     """
     Wrapper around os.stat(), which returns the output as a dict instead of an object
@@ -255,31 +317,104 @@ MILUT = {
             'forced': MIP.BOOL
          }
 
-def mediainfo(fpath, xconfig, format_lower=True):
+def mi_transform(tcmd):
     """
-    Use PyMediainfo to retrieve info about @fname, then parse and filter this
-    into a more usable format, which is returned as a dict
+    return a function that applies opcode @tcmd to a mediainfo value
+    raises an exception if the value can't be converted
     """
-    global MILUT
-
-    if format_lower is True:
-        MILUT['format'] = MIP.COPY|MIP.LOWER
+    if tcmd & MIP.COPY:
+        tconv = None
+    elif tcmd & MIP.STRCOPY:
+        tconv = str
+    elif tcmd & MIP.INT:
+        tconv = int
+    elif tcmd & MIP.FLOAT:
+        tconv = float
+    elif tcmd & MIP.BOOL:
+        tconv = bool
+    elif tcmd & MIP.DATE:
+        tconv = lambda x: int(time.mktime(time.strptime(x, '%Z %Y-%m-%d %H:%M:%S')))
     else:
-        MILUT['format'] = MIP.COPY
+        failwith(ER.NOTIMPL, "Specified tcmd opcode not implemented.")
+
+    tlower = bool(tcmd & MIP.LOWER)
+    tdiv = bool(tcmd & MIP.DIV1000)
+    tfallback = bool(tcmd & MIP.TSTAMP_FB)
+
+    if tconv is None and not tlower:
+        return lambda x: x
+    elif tconv is None:
+        return lambda x: x.lower()
+
+    def xform(tval):
+        try:
+            tout = tconv(tval)
+        except Exception:
+            if not tfallback:
+                raise
+            tout = mts_parse(tval, mbase=1000)
+        if tlower:
+            tout = tout.lower()
+        if tdiv:
+            tout = tout / 1000.0
+        return tout
+    return xform
+
+def mi_compile(milut, format_lower):
+    """
+    compile lookup table @milut into a dict of key => (output name, transform function)
+    if @format_lower is True, 'format' values are lowercased
+    """
+    ctable = {}
+    for tkey, tent in milut.items():
+        if isinstance(tent, dict):
+            tcmd = tent['do']
+            tname = tent.get('name', tkey)
+        else:
+            tcmd = tent
+            tname = tkey
+        if tkey == 'format' and format_lower:
+            tcmd |= MIP.LOWER
+        ctable[tkey] = (tname, mi_transform(tcmd))
+    return ctable
 
-    logthis("Parsing mediainfo from file:", suffix=fpath, loglevel=LL.VERBOSE)
+# Compiled MILUT, by format_lower
+MITABLE = {True: mi_compile(MILUT, True), False: mi_compile(MILUT, False)}
 
-    if xconfig.scan['workaround_mediainfo_bugs'] and re.search(r'[\*\?]', fpath):
-        mi_symlink = True
-        fname = templink(fpath, xconfig.scan['tempdir'])
-        logthis("Creating symlink to workaround MediaInfo limitations:", suffix=fname, loglevel=LL.VERBOSE)
-    else:
-        mi_symlink = False
-        fname = fpath
+# Menu chapter key (eg. '00_06_11950') and value (eg. 'en:Chapter 2')
+re_chapkey = re.compile(r'^([0-9]{2})_([0-9]{2})_([0-9]{5})$')
+re_chapval = re.compile(r'^([a-z]{2})?:?(.+)$')
 
-    # parse output of mediainfo and convert raw XML with pymediainfo
-    miobj = MediaInfo.parse(fname)
-    miraw = miobj.to_data()['tracks']
+# Paths that need the templink() workaround
+re_mibugs = re.compile(r'[\*\?]')
+
+def mi_chapters(tt):
+    """
+    parse chapters/markers from mediainfo menu track @tt
+    returns a list of chapters, ordered by offset
+    """
+    chaps = []
+    for tkey, tval in tt.items():
+        tss = re_chapkey.match(tkey)
+        if not tss:
+            continue
+        thour, tmin, tmsec = [int(x) for x in tss.groups()]
+        tlang, ttitle = re_chapval.match(tval).groups()
+        chaps.append({
+                       'offset': (thour * 3600.0) + (tmin * 60.0) + (tmsec / 1000.0),
+                       'title': ttitle,
+                       'lang': tlang,
+                       'tstamp': "%02d:%02d:%06.3f" % (thour, tmin, tmsec / 1000.0)
+                     })
+    chaps.sort(key=lambda x: x['offset'])
+    return chaps
+
+def mi_parse(miraw, format_lower=True):
+    """
+    parse and filter list of raw mediainfo tracks @miraw (as from pymediainfo's to_data()['tracks'])
+    using the compiled MILUT; returns a dict
+    """
+    mitable = MITABLE[bool(format_lower)]
 
     # create outdata for the important stuff
     outdata = {'general': {}, 'video': [], 'audio': [], 'text': [], 'menu': []}
@@ -287,84 +422,61 @@ def mediainfo(fpath, xconfig, format_lower=True):
     # interate over data and build nicely pruned output array
     for tt in miraw:
         ttype = tt['track_type'].lower()
+
+        # We only care about the actual chapters/markers with timestamps
+        if ttype == 'menu':
+            outdata['menu'] += mi_chapters(tt)
+            continue
+        elif ttype not in outdata:
+            continue
+
+        # only look up the keys we care about; raw tracks have many more
         tblock = {}
-        for tkey, tval in tt.items():
-            # Check all menu items (chapters)
-            if ttype == 'menu':
-                # We only care about the actual chapters/markers with timestamps
-                tss = re.match('^(?P<hour>[0-9]{2})_(?P<min>[0-9]{2})_(?P<msec>[0-9]{5})$', tkey)
-                if tss:
-                    mts = tss.groupdict()
-                    mtt = re.match('^(?P<lang>[a-z]{2})?:?(?P<title>.+)$', tval).groupdict()
-                    mti = {
-                            'offset': (float(mts['hour']) * 3600.0) + (float(mts['min']) * 60.0) + (float(mts['msec']) / 1000.0),
-                            'title': mtt.get('title', ""),
-                            'lang': mtt.get('lang', "en"),
-                            'tstamp': "%02d:%02d:%06.3f" % (int(mts['hour']), int(mts['min']), (float(mts['msec']) / 1000.0))
-                          }
-                    outdata['menu'].append(mti)
-
-            # Make sure it's a key we care about
-            elif tkey in MILUT:
-                tname = tkey
-
-                # check for dupes
-                if tname in tblock:
-                    logthis("Ignoring duplicate attribute:", suffix=tname, loglevel=LL.VERBOSE)
-                    continue
-
-                # If the object in the LUT is a dict, it has extended info
-                if isinstance(MILUT[tkey], dict):
-                    tcmd = MILUT[tkey]['do']
-                    if 'opt' in MILUT[tkey]:
-                        topt = MILUT[tkey]['opt']  # pylint: disable=unused-variable
-                    else:
-                        topt = None
-                    if MILUT[tkey].has_key('name'):
-                        tname = MILUT[tkey]['name']
-                else:
-                    tcmd = MILUT[tkey]
-                    topt = None
-
-                # exec opcode
-                try:
-                    if tcmd & MIP.COPY:
-                        tblock[tname] = tval
-                    elif tcmd & MIP.STRCOPY:
-                        tblock[tname] = str(tval)
-                    elif tcmd & MIP.INT:
-                        tblock[tname] = int(tval)
-                    elif tcmd & MIP.FLOAT:
-                        tblock[tname] = float(tval)
-                    elif tcmd & MIP.BOOL:
-                        tblock[tname] = bool(tval)
-                    elif tcmd & MIP.DATE:
-                        tblock[tname] = int(time.mktime(time.strptime(tval, '%Z %Y-%m-%d %H:%M:%S')))
-                    else:
-                        failwith(ER.NOTIMPL, "Specified tcmd opcode not implemented.")
-                except Exception as e:
-                    if tcmd & MIP.TSTAMP_FB:
-                        try:
-                            tblock[tname] = mts_parse(tval, mbase=1000)
-                        except Exception as e:
-                            logthis("Failed to parse mediainfo output (TSTAMP_FB also failed):", prefix=tname, suffix=e, loglevel=LL.WARNING)
-                            continue
-                    else:
-                        logthis("Failed to parse mediainfo output:", prefix=tname, suffix=e, loglevel=LL.WARNING)
-                        continue
-
-                # post-filters
-                if tcmd & MIP.LOWER:
-                    tblock[tname] = tblock[tname].lower()
-                if tcmd & MIP.DIV1000:
-                    tblock[tname] = tblock[tname] / 1000.0
+        for tkey, (tname, xform) in mitable.iteritems():
+            tval = tt.get(tkey)
+            if tval is None:
+                continue
+            try:
+                tblock[tname] = xform(tval)
+            except Exception as e:
+                logthis("Failed to parse mediainfo output:", prefix=tname, suffix=e, loglevel=LL.WARNING)
 
         # add track block to output data
         if ttype == 'general':
             outdata['general'] = tblock
-        elif ttype != 'menu':
+        else:
             outdata[ttype].append(tblock)
 
+    return outdata
+
+def mediainfo(fpath, xconfig, format_lower=True):
+    """
+    Use libmediainfo (or PyMediainfo, if unavailable or scan.mediainfo_engine is 'pymediainfo')
+    to retrieve info about @fname, then parse and filter this into a more usable format,
+    which is returned as a dict
+    """
+    logthis("Parsing mediainfo from file:", suffix=fpath, loglevel=LL.VERBOSE)
+
+    if xconfig.scan['workaround_mediainfo_bugs'] and re_mibugs.search(fpath):
+        mi_symlink = True
+        fname = templink(fpath, xconfig.scan['tempdir'])
+        logthis("Creating symlink to workaround MediaInfo limitations:", suffix=fname, loglevel=LL.VERBOSE)
+    else:
+        mi_symlink = False
+        fname = fpath
+
+    # query only the attributes in MILUT from libmediainfo directly; otherwise,
+    # parse output of mediainfo and convert raw XML with pymediainfo
+    miraw = None
+    if xconfig.scan['mediainfo_engine'] != 'pymediainfo' and milib.load():
+        miraw = milib.probe(fname, MILUT)
+    if miraw is None:
+        from pymediainfo import MediaInfo
+        miobj = MediaInfo.parse(fname)
+        miraw = miobj.to_data()['tracks']
+
+    outdata = mi_parse(miraw, format_lower)
+
     if mi_symlink is True:
         os.unlink(fname)
 
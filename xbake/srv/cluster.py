@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+xbake.srv.cluster
+Cluster node registry & job dispatcher
+
+@author   Jacob Hipps <jacob@ycnrg.org>
+@repo     https://git.ycnrg.org/projects/YXB/repos/yc_xbake
+
+Copyright (c) 2013-2017 J. Hipps / Neo-Retro Group, Inc.
+https://ycnrg.org/
+
+"""
+
+import os
+import json
+import time
+import socket
+import threading
+import multiprocessing
+
+from xbake import __version__
+from xbake.common.logthis import *
+from xbake.common import db
+from xbake.xcode import ffmpeg
+
+# Redis hash of registered nodes; node ID => JSON node info
+NODES_KEY = "cluster_nodes"
+
+# Queues that are dispatched to individual nodes
+node_queues = ('xfer', 'xcode')
+
+# Node heartbeat thread (master process only)
+beacon = None
+
+
+def enabled(xconfig):
+    """return True if cluster mode is enabled"""
+    return bool(xconfig.srv['cluster'])
+
+def get_node_id(xconfig):
+    """
+    return the ID of this node; defaults to the FQDN, which is also the key used
+    for this host in files.location
+    """
+    return xconfig.srv['node_id'] or socket.getfqdn()
+
+def node_queue(qname, nid):
+    """return name of node @nid's private queue for @qname"""
+    return "%s@%s" % (qname, nid)
+
+def host_key(nid):
+    """return the files.location key for node @nid"""
+    return nid.replace('.', '_')
+
+def get_caps():
+    """
+    determine which node queues this host is able to service
+    """
+    return {
+             'xfer': bool(ffmpeg.locate('scp', isFatal=False)),
+             'xcode': bool(ffmpeg.locate('ffmpeg', isFatal=False) and ffmpeg.locate('mkvextract', isFatal=False))
+           }
+
+def node_pending(rdx, nid):
+    """return number of jobs queued on, or being run by, node @nid"""
+    pending = 0
+    for tq in node_queues:
+        tqn = node_queue(tq, nid)
+        pending += rdx.llen("queue_"+tqn) + rdx.llen("work_"+tqn)
+    return pending
+
+def get_nodes(rdx, node_ttl):
+    """
+    return dict of live nodes (node ID => info)
+    nodes that have not checked in within @node_ttl seconds are dropped from the registry
+    """
+    nodes = {}
+    tnow = time.time()
+    for nid, nraw in (rdx.hgetall(NODES_KEY) or {}).items():
+        try:
+            ninfo = json.loads(nraw)
+        except Exception:
+            ninfo = None
+        if not ninfo or tnow - ninfo.get('tstamp', 0) > node_ttl:
+            logthis("Removing stale node from cluster registry:", suffix=nid, loglevel=LL.VERBOSE)
+            rdx.hdel(NODES_KEY, nid)
+            continue
+        nodes[nid] = ninfo
+    return nodes
+
+def choose_node(nodes, qname, locations, hmetrics, rdx):
+    """
+    choose a node from @nodes to run a job from queue @qname
+    Nodes that already have the file (a key in @locations) are preferred, ordered by their
+    host metric in @hmetrics; otherwise (or on a tie) the node with the fewest pending jobs per core wins
+    returns node ID, or None if no live node can service @qname
+    """
+    best = (None, None)
+    for nid, ninfo in nodes.items():
+        if not ninfo.get('caps', {}).get(qname, False):
+            continue
+        hkey = host_key(nid)
+        if hkey in locations:
+            locrank = (0, hmetrics.get(hkey, 100))
+        else:
+            locrank = (1, 0)
+        nload = float(node_pending(rdx, nid)) / max(int(ninfo.get('cores', 1)), 1)
+        nrank = locrank + (nload, ninfo.get('loadavg', 0.0))
+        if best[1] is None or nrank < best[1]:
+            best = (nid, nrank)
+    return best[0]
+
+def cb_dispatch(jdata, qname):
+    """
+    Job processor for the shared queues in cluster mode
+    Looks up the file to pick the best node (see choose_node()), then hands off
+    the job, unchanged, to that node's private queue
+    """
+    from xbake.srv import queue
+
+    fid = jdata['fid']
+    fvid = queue.mdx.findOne('files', {"_id": fid}) if fid else None
+    locations = (fvid or {}).get('location', {})
+
+    xconf, hmetrics, xprofiles = queue.jobconf  #pylint: disable=unused-variable
+    nodes = get_nodes(queue.rdx, int(xconf.srv['node_ttl']))
+    nid = choose_node(nodes, qname, locations, hmetrics, queue.rdx)
+    if nid is None:
+        logthis("dispatch: No live node available to service queue", suffix=qname, loglevel=LL.ERROR)
+        return 131
+
+    logthis("dispatch: Job %s (%s) => node" % (jdata['id'], qname), suffix=nid, loglevel=LL.VERBOSE)
+    queue.enqueue(node_queue(qname, nid), jdata['id'], fid, jdata['opts'])
+    return 0
+
+def get_dispatcher(qname):
+    """return queue callback that dispatches jobs in shared queue @qname"""
+    return lambda jdata: cb_dispatch(jdata, qname)
+
+def register(xconfig):
+    """
+    register this node in the cluster, and start the heartbeat thread
+    """
+    global beacon
+    rdx = db.redis({'host': xconfig.redis['host'], 'port': xconfig.redis['port'], 'db': xconfig.redis['db'],
+                    'pool_size': 2, 'timeout': xconfig.redis['timeout']},
+                   prefix=xconfig.redis['prefix'])
+    beacon = NodeBeacon(rdx, get_node_id(xconfig), int(xconfig.srv['node_ttl']))
+    beacon.beat()
+    beacon.start()
+    logthis("Registered cluster node:", suffix=beacon.nid, loglevel=LL.INFO)
+
+def unregister():
+    """stop the heartbeat thread and remove this node from the registry"""
+    if beacon is not None:
+        beacon.stop()
+        beacon.rdx.hdel(NODES_KEY, beacon.nid)
+
+
+class NodeBeacon(threading.Thread):
+    """
+    Heartbeat thread; publishes this node's capabilities and load to the registry
+    every @ttl/3 seconds
+    """
+    def __init__(self, rdx, nid, ttl):
+        threading.Thread.__init__(self, name="node-beacon")
+        self.daemon = True
+        self.rdx = rdx
+        self.nid = nid
+        self.ttl = ttl
+        self.caps = get_caps()
+        self.cores = multiprocessing.cpu_count()
+        self.halt = threading.Event()
+
+    def beat(self):
+        ninfo = {
+                  'node': self.nid,
+                  'host': socket.getfqdn(),
+                  'pid': os.getpid(),
+                  'version': __version__,
+                  'caps': self.caps,
+                  'cores': self.cores,
+                  'loadavg': os.getloadavg()[0],
+                  'pending': node_pending(self.rdx, self.nid),
+                  'tstamp': time.time()
+                }
+        self.rdx.hset(NODES_KEY, self.nid, json.dumps(ninfo))
+
+    def run(self):
+        while not self.halt.wait(max(self.ttl / 3.0, 1.0)):
+            try:
+                self.beat()
+            except Exception as e:
+                logexc(e, "Failed to update cluster node registry")
+
+    def stop(self):
+        self.halt.set()
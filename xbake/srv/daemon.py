@@ -18,23 +18,41 @@ import sys
 import os
 import re
 import time
+import signal
+import threading
 
 from setproctitle import setproctitle
 from flask import Flask, json, make_response, request
 
 from xbake import __version__, __date__
 from xbake.common.logthis import *
+from xbake.common import db, rcfile
 from xbake.mscan import out
 from xbake.srv import queue
+from xbake.srv import cluster
 
 # XBake server Flask object
 xsrv = None
 config = None
 
+# Redis object; queue runner PIDs
+rdx = None
+runners = []
+
+# Set by SIGHUP; the config is reloaded by the watcher thread
+reload_pending = False
+
+# Options that only take effect when the daemon is restarted; section => keys (None for all)
+restart_opts = {
+                 'redis': None,
+                 'mongo': None,
+                 'srv': ('pidfile', 'iface', 'port', 'nofork', 'debug', 'cluster', 'node_id', 'node_ttl', 'lease_ttl', 'xcode_workers')
+               }
+
 # def start(bind_ip="0.0.0.0",bind_port=7037,fdebug=False):
 def start(xconfig):
     """Start XBake Daemon"""
-    global config, xsrv
+    global config, xsrv, rdx
     config = xconfig
 
     # first, fork
@@ -45,8 +63,22 @@ def start(xconfig):
     pidfile_set()
 
     # spawn queue runners
-    queue.start(xconfig, 'xfer')
-    queue.start(xconfig, 'xcode')
+    runners.append(queue.start(xconfig, 'xfer'))
+    runners.append(queue.start(xconfig, 'xcode'))
+
+    # in cluster mode, the runners above dispatch jobs to nodes; spawn runners for
+    # this node's own queues, then register with the cluster
+    if cluster.enabled(config):
+        for tq in cluster.node_queues:
+            runners.append(queue.start(xconfig, cluster.node_queue(tq, cluster.get_node_id(config))))
+        cluster.register(xconfig)
+
+    # reload config on SIGHUP, or when a config file changes
+    rdx = db.redis({'host': config.redis['host'], 'port': config.redis['port'], 'db': config.redis['db'],
+                    'pool_size': 2, 'timeout': config.redis['timeout']},
+                   prefix=config.redis['prefix'])
+    signal.signal(signal.SIGHUP, sighup)
+    ConfigWatcher().start()
 
     # create flask object, and map API routes
     xsrv = Flask('xbake')
@@ -54,11 +86,42 @@ def start(xconfig):
     xsrv.add_url_rule('/api/auth', 'auth', view_func=route_auth, methods=['GET', 'POST'])
     xsrv.add_url_rule('/api/mscan/add', 'mscan_add', view_func=route_mscan_add, methods=['GET', 'POST', 'PUT'])
     xsrv.add_url_rule('/api/mscan/getlast', 'mscan_last', view_func=route_mscan_last, methods=['GET', 'POST'])
+    xsrv.add_url_rule('/api/cluster', 'cluster', view_func=route_cluster, methods=['GET'])
+    xsrv.add_url_rule('/api/config', 'config', view_func=route_config, methods=['GET'])
 
     # start flask listener
     logthis("Starting Flask...", loglevel=LL.VERBOSE)
     xsrv.run(config.srv['iface'], config.srv['port'], config.srv['debug'], use_evalex=False)
 
+def sighup(signum, frame):
+    """SIGHUP handler; flag the config for reload"""
+    global reload_pending
+    reload_pending = True
+
+def reload_config():
+    """
+    Reload config in the master, then signal the queue runners to do the same;
+    runners swap in the new config between jobs, so no jobs are interrupted
+    """
+    global config
+    newconf = rcfile.reload()
+    if newconf is None:
+        return False
+
+    for tsec, tkeys in restart_opts.items():
+        for tkey in (tkeys or set(config.get(tsec, {}).keys() + newconf.get(tsec, {}).keys())):
+            if config.get(tsec, {}).get(tkey) != newconf.get(tsec, {}).get(tkey):
+                logthis("Config option %s.%s changed; restart the daemon to apply" % (tsec, tkey), loglevel=LL.WARNING)
+
+    config = newconf
+    configure_logging(config)
+    for tpid in runners:
+        try:
+            os.kill(tpid, signal.SIGHUP)
+        except OSError as e:
+            logthis("Failed to signal queue runner %d:" % (tpid), suffix=e, loglevel=LL.WARNING)
+    return True
+
 def dfork():
     """Fork into the background"""
     logthis("Forking...", loglevel=LL.DEBUG)
@@ -191,6 +254,43 @@ def route_mscan_last():
     """
     return dresponse(None, '501 Not Implemented')
 
+def route_cluster():
+    """
+    /api/cluster [GET]
+    Retrieve live cluster nodes and recent job results
+    """
+    if not precheck(require_ctype=False):
+        return dresponse(*precheck(rheaders=True, require_ctype=False))
+    if not cluster.enabled(config):
+        return dresponse({'status': "error", 'error': "cluster_disabled", 'message': "Cluster mode is not enabled"}, "404 Not Found")
+
+    rdx = cluster.beacon.rdx
+    jobs = {}
+    for jid, jraw in (rdx.hgetall("jobstatus") or {}).items():
+        try:
+            jobs[jid] = json.loads(jraw)
+        except Exception:
+            pass
+    return dresponse({'status': "ok", 'node': cluster.beacon.nid,
+                      'nodes': cluster.get_nodes(rdx, int(config.srv['node_ttl'])), 'jobs': jobs})
+
+def route_config():
+    """
+    /api/config [GET]
+    Retrieve the active config generation, and the generation loaded by each queue runner
+    """
+    if not precheck(require_ctype=False):
+        return dresponse(*precheck(rheaders=True, require_ctype=False))
+
+    runinfo = {}
+    for rid, rraw in (rdx.hgetall(queue.RUNNERS_KEY) or {}).items():
+        try:
+            runinfo[rid] = json.loads(rraw)
+        except Exception:
+            pass
+    return dresponse({'status': "ok", 'generation': rcfile.loadinfo['generation'], 'hash': rcfile.loadinfo['hash'],
+                      'files': rcfile.loadinfo['files'], 'loaded': rcfile.loadinfo['loaded'], 'runners': runinfo})
+
 def pjson(oin):
     """prettify json"""
     return json.dumps(oin, indent=4, separators=(',', ': '))
@@ -207,3 +307,28 @@ def pidfile_set():
     except Exception as e:
         logexc(e, "Failed to write data to PID file (%s)" % (pfname))
         failwith(ER.PROCFAIL, "Ensure write permission at the PID file location.")
+
+
+class ConfigWatcher(threading.Thread):
+    """
+    Config reload thread; reloads the config after a SIGHUP, or when a config file
+    is created, modified, or removed (checked every @interval seconds)
+    """
+    def __init__(self, interval=5.0):
+        threading.Thread.__init__(self, name="config-watcher")
+        self.daemon = True
+        self.interval = interval
+        self.halt = threading.Event()
+
+    def run(self):
+        global reload_pending
+        while not self.halt.wait(self.interval):
+            if reload_pending or rcfile.changed():
+                reload_pending = False
+                try:
+                    reload_config()
+                except Exception as e:
+                    logexc(e, "Failed to reload config")
+
+    def stop(self):
+        self.halt.set()
@@ -18,22 +18,29 @@ import sys
 import os
 import re
 import json
+import time
+import socket
+import hashlib
+import threading
+import signal
+import uuid
 import subprocess
 import pipes
 
 from setproctitle import setproctitle
 
 from xbake.common.logthis import *
-from xbake.common import db
+from xbake.common import db, rcfile
 from xbake.mscan.util import md5sum, dstat
-from xbake.xcode import xcode
+from xbake.xcode import xcode, tune, profiles
+from xbake.srv import cluster
 
 # Queue handler callbacks
 handlers = None
 
-# Host metrics and encode profiles
-hmetrics = None
-xprofiles = None
+# Config, host metrics, and encode profiles used by jobs; replaced as a single tuple by
+# reload_config(), so a job that takes it once at the start uses one config generation throughout
+jobconf = (None, {}, {})
 
 # Redis & Mongo objects; Parent PID
 rdx = None
@@ -41,11 +48,25 @@ mdx = None
 dadpid = None
 config = None
 
+# Job leases: unique ID of this runner, and the heartbeat thread
+runner_id = None
+leaser = None
+
+# Work queue items seen without a lease on the last reaper pass, by queue
+reap_suspects = {}
+
+# Set by SIGHUP; the config is reloaded between jobs
+reload_pending = False
+
+# Redis hash of the config generation loaded by each runner; runner ID => JSON info
+RUNNERS_KEY = "config_runners"
+
 def start(xconfig, qname="xcode"):
     """
     fork queue runner for queue @qname
+    returns pid of the runner (in the parent)
     """
-    global rdx, mdx, dadpid, handlers, hmetrics, xprofiles, config
+    global rdx, mdx, dadpid, handlers, jobconf, config, runner_id, leaser
 
     # Fork into its own process
     logthis("Forking...", loglevel=LL.DEBUG)
@@ -58,7 +79,7 @@ def start(xconfig, qname="xcode"):
 
     # Return if we are the parent process
     if pid:
-        return 0
+        return pid
 
     # Otherwise, we are the child
     logthis("Forked queue runner. pid =", prefix=qname, suffix=os.getpid(), loglevel=LL.INFO)
@@ -67,8 +88,13 @@ def start(xconfig, qname="xcode"):
 
     config = xconfig
 
+    # Drop any DB clients inherited from the master; each runner gets its own pools
+    db.reset_clients()
+
     # Connect to Redis
-    rdx = db.redis({'host': config.redis['host'], 'port': config.redis['port'], 'db': config.redis['db']}, prefix=config.redis['prefix'])
+    rdx = db.redis({'host': config.redis['host'], 'port': config.redis['port'], 'db': config.redis['db'],
+                    'pool_size': config.redis['pool_size'], 'timeout': config.redis['timeout']},
+                   prefix=config.redis['prefix'])
 
     # Connect to Mongo
     mdx = db.mongo(config.mongo)
@@ -79,14 +105,28 @@ def start(xconfig, qname="xcode"):
                  'xcode': cb_xcode
                }
 
-    # Get host metrics
-    hmetrics = load_metrics()
+    # In cluster mode, jobs in the shared queues are dispatched to a node, and
+    # each node runs the jobs from its own private queues
+    if cluster.enabled(config):
+        for tq in cluster.node_queues:
+            handlers[cluster.node_queue(tq, cluster.get_node_id(config))] = handlers[tq]
+            handlers[tq] = cluster.get_dispatcher(tq)
+
+    # Get host metrics and xcode profiles
+    jobconf = (config, load_metrics(config), profiles.load(config))
 
-    # Get xcode profiles
-    xprofiles = load_profiles()
+    # Start lease heartbeat
+    runner_id = "%s:%d" % (socket.getfqdn(), os.getpid())
+    leaser = LeaseKeeper(rdx, int(config.srv['lease_ttl']))
+    leaser.start()
+
+    # Reload config on SIGHUP (sent by the master)
+    signal.signal(signal.SIGHUP, sighup)
+    set_runner_info(qname)
 
     # Start listener loop
     qrunner(qname)
+    rdx.hdel(RUNNERS_KEY, runner_id)
 
     # And exit once we're done
     logthis("*** Queue runner terminating", prefix=qname, loglevel=LL.INFO)
@@ -95,71 +135,259 @@ def start(xconfig, qname="xcode"):
 def qrunner(qname="xcode"):
     """
     Queue runner main loop
+    Starts the worker thread(s), then periodically reaps abandoned jobs and checks on the master
     """
     global rdx, mdx, handlers
 
     qq = "queue_"+qname
     wq = "work_"+qname
+    lease_ttl = int(config.srv['lease_ttl'])
 
     # Crash recovery
-    # Check work queue (work_*) and re-queue any unhandled items
+    # Jobs in the work queue (work_*) whose lease has expired are requeued by the reaper.
+    # Jobs still leased belong to another live runner, and are left alone
     logthis("-- QRunner crash recovery: checking for abandoned jobs...", loglevel=LL.VERBOSE)
-    requeued = 0
-    while(rdx.llen(wq) != 0):
-        crraw = rdx.lpop(wq)
-        try:
-            critem = json.loads(crraw)
-        except Exception as e:
-            logthis("!! QRunner crash recovery: Bad JSON data from queue item. Job discarded. raw data:", prefix=qname, suffix=crraw, loglevel=LL.ERROR)
-            logexc(e, "Error loading JSON data")
-            continue
-        cr_jid = critem.get("id", "??")
-        logthis("** Requeued abandoned job:", prefix=qname, suffix=cr_jid, loglevel=LL.WARNING)
-        rdx.rpush(qq, crraw)
-        requeued += 1
-
-    if requeued:
-        logthis("-- QRunner crash recovery OK! Jobs requeued:", prefix=qname, suffix=requeued, loglevel=LL.VERBOSE)
+    reap_jobs(qname)
+    t_reap = time.time()
 
     logthis("pre-run queue sizes: %s = %d / %s = %d" % (qq, rdx.llen(qq), wq, rdx.llen(wq)), prefix=qname, loglevel=LL.DEBUG)
+
+    # Start workers
+    if qname.split('@')[0] == 'xcode':
+        nworkers = max(int(config.srv['xcode_workers']), 1)
+    else:
+        nworkers = 1
+    halt = threading.Event()
+    workers = []
+    for i in range(nworkers):
+        tworker = threading.Thread(target=qworker, args=(qname, halt), name="qworker-%d" % (i))
+        tworker.daemon = True
+        tworker.start()
+        workers.append(tworker)
+    logthis("-- QRunner workers started:", prefix=qname, suffix=nworkers, loglevel=LL.VERBOSE)
+
+    while not halt.wait(5):
+        # Requeue jobs with expired leases
+        if time.time() - t_reap >= lease_ttl:
+            reap_jobs(qname)
+            t_reap = time.time()
+
+        # Swap in the new config; running jobs keep the config they started with
+        if reload_pending:
+            reload_config(qname)
+
+        # Check if daddy is still alive; prevents this process from becoming a bastard child
+        if not master_alive():
+            logthis("QRunner: Master has terminated. Waiting for running jobs to finish.", prefix=qname, loglevel=LL.WARNING)
+            halt.set()
+
+    for tworker in workers:
+        tworker.join()
+
+def sighup(signum, frame):
+    """SIGHUP handler; flag the config for reload"""
+    global reload_pending
+    reload_pending = True
+
+def reload_config(qname):
+    """
+    Reload the config, then the host metrics and encode profiles
+    """
+    global config, jobconf, reload_pending
+    reload_pending = False
+    newconf = rcfile.reload()
+    if newconf is None:
+        return False
+
+    # jobs already running keep the tuple they started with
+    jobconf = (newconf, load_metrics(newconf), profiles.load(newconf))
+    config = newconf
+    configure_logging(config)
+    set_runner_info(qname)
+    logthis("QRunner: Loaded config generation", prefix=qname, suffix=rcfile.loadinfo['generation'], loglevel=LL.INFO)
+    return True
+
+def set_runner_info(qname):
+    """record the config generation loaded by this runner"""
+    rdx.hset(RUNNERS_KEY, runner_id, json.dumps({'queue': qname, 'pid': os.getpid(), 'generation': rcfile.loadinfo['generation'],
+                                                 'hash': rcfile.loadinfo['hash'], 'tstamp': time.time()}))
+
+def qworker(qname, halt):
+    """
+    Queue worker loop; runs jobs from queue @qname until @halt is set
+    """
+    global rdx
+
+    qq = "queue_"+qname
+    wq = "work_"+qname
+
     logthis("-- QRunner waiting; queue:", prefix=qname, suffix=qname, loglevel=LL.VERBOSE)
-    while(True):
+    while not halt.is_set():
         # RPOP from main queue and LPUSH on to the work queue
         # block for 5 seconds, check that the master hasn't term'd, then
         # check again until we get something
-        qitem = None
         qiraw = rdx.brpoplpush(qq, wq, 5)
         if qiraw:
             logthis(">> QRunner: discovered a new job in queue", prefix=qname, suffix=qname, loglevel=LL.VERBOSE)
+            run_job(qname, qiraw)
 
-            try:
-                qitem = json.loads(qiraw)
-            except Exception as e:
-                logthis("!! QRunner: Bad JSON data from queue item. Job discarded. raw data:", prefix=qname, suffix=qiraw, loglevel=LL.ERROR)
+            # Show wait message again
+            logthis("-- QRunner: waiting; queue:", prefix=qname, suffix=qname, loglevel=LL.VERBOSE)
 
-            # If we've got a valid job item, let's run it!
-            if qitem:
-                logthis(">> QRunner: job data:\n", prefix=qname, suffix=json.dumps(qitem), loglevel=LL.DEBUG)
+def run_job(qname, qiraw, handler=None):
+    """
+    Run job @qiraw (raw JSON, as popped into the work queue) from queue @qname
+    The job is leased to this runner for as long as the handler runs. Any follow-up jobs
+    enqueued by the handler, the final job status, removal of this exact item from the
+    work queue, and release of the lease are committed together in one MULTI/EXEC round-trip,
+    so a job is never lost or run twice if the runner dies part way through the transition
+    File status updates (update_status) are not part of the transaction; they are written
+    to Mongo by the handler as the file moves through each state, so that progress is visible
+    while the job runs, and a Mongo write cannot be made atomic with a Redis transaction
+    Returns the handler's return value, or None if the job was discarded
+    """
+    global rdx, handlers, leaser, runner_id
 
-                # Execute callback
-                rval = handlers[qname](qitem)
-                if (rval == 0):
-                    logthis("QRunner: Completed job successfully.", prefix=qname, loglevel=LL.VERBOSE)
-                elif (rval == 1):
-                    logthis("QRunner: Job complete, but with warnings.", prefix=qname, loglevel=LL.WARNING)
-                else:
-                    logthis("QRunner: Job failed. rval =", prefix=qname, suffix=rval, loglevel=LL.ERROR)
+    wq = "work_"+qname
+    if handler is None:
+        handler = handlers[qname]
 
-                # Remove from work queue
-                rdx.rpop(wq)
+    qitem = None
+    rval = None
+    lkey = None
+    try:
+        qitem = json.loads(qiraw)
+    except Exception as e:
+        logthis("!! QRunner: Bad JSON data from queue item. Job discarded. raw data:", prefix=qname, suffix=qiraw, loglevel=LL.ERROR)
 
-            # Show wait message again
-            logthis("-- QRunner: waiting; queue:", prefix=qname, suffix=qname, loglevel=LL.VERBOSE)
+    # If we've got a valid job item, let's run it!
+    if qitem:
+        logthis(">> QRunner: job data:\n", prefix=qname, suffix=json.dumps(qitem), loglevel=LL.DEBUG)
 
-        # Check if daddy is still alive; prevents this process from becoming a bastard child
-        if not master_alive():
-            logthis("QRunner: Master has terminated.", prefix=qname, loglevel=LL.WARNING)
-            return
+        # Take the lease
+        lkey = lease_key(qname, job_uid(qitem, qiraw))
+        rdx.set(lkey, runner_id, ttl=int(config.srv['lease_ttl']))
+        leaser.add(lkey)
+
+        # Open a transaction; enqueue() will add to it rather than pushing immediately
+        rdx.makepipe()
+
+        # Execute callback
+        try:
+            rval = handler(qitem)
+        except Exception as e:
+            logexc(e, "QRunner: Unhandled exception in job handler", prefix=qname)
+            rval = -1
+        finally:
+            leaser.remove(lkey)
+
+        if (rval == 0):
+            logthis("QRunner: Completed job successfully.", prefix=qname, loglevel=LL.VERBOSE)
+        elif (rval == 1):
+            logthis("QRunner: Job complete, but with warnings.", prefix=qname, loglevel=LL.WARNING)
+        else:
+            logthis("QRunner: Job failed. rval =", prefix=qname, suffix=rval, loglevel=LL.ERROR)
+
+        set_jobstatus(qname, qitem.get('id'), rval)
+    else:
+        rdx.makepipe()
+
+    # Acknowledge: remove from work queue, release lease, and commit
+    rdx.lrem(wq, qiraw, usepipe=True)
+    if lkey:
+        rdx.delete(lkey, usepipe=True)
+    if rdx.execpipe() is None:
+        logthis("!! QRunner: Failed to commit job transition for job:", prefix=qname, suffix=qiraw, loglevel=LL.ERROR)
+
+    return rval
+
+def job_uid(qitem, qiraw):
+    """
+    return unique ID of a job; jobs created by enqueue() carry a 'uid', otherwise
+    it is derived from the raw queue item
+    """
+    juid = qitem.get('uid') if isinstance(qitem, dict) else None
+    if not juid:
+        if isinstance(qiraw, unicode):
+            qiraw = qiraw.encode('utf-8')
+        juid = hashlib.sha1(qiraw).hexdigest()
+    return juid
+
+def lease_key(qname, juid):
+    """return Redis key (sans prefix) for the lease on job @juid in queue @qname"""
+    return "lease_%s:%s" % (qname, juid)
+
+def reap_jobs(qname):
+    """
+    Requeue jobs from the work queue of @qname whose lease has expired
+    A job must be seen without a lease on two consecutive passes before it is requeued; this
+    gives a runner that has just popped a job (but not yet taken the lease) time to do so
+    Returns number of jobs requeued
+    """
+    global rdx, reap_suspects
+
+    qq = "queue_"+qname
+    wq = "work_"+qname
+    lastseen = reap_suspects.get(qname, set())
+    suspects = set()
+    requeued = 0
+
+    for wraw in rdx.lrange(wq):
+        try:
+            witem = json.loads(wraw)
+        except Exception:
+            witem = None
+        if rdx.exists(lease_key(qname, job_uid(witem, wraw))):
+            continue
+        if wraw in lastseen:
+            if rdx.lmove_exact(wq, qq, wraw):
+                logthis("** Requeued abandoned job (lease expired):", prefix=qname, suffix=(witem or {}).get('id', "??"), loglevel=LL.WARNING)
+                requeued += 1
+        else:
+            suspects.add(wraw)
+
+    reap_suspects[qname] = suspects
+    if requeued:
+        logthis("-- QRunner reaper: Jobs requeued:", prefix=qname, suffix=requeued, loglevel=LL.VERBOSE)
+    return requeued
+
+class LeaseKeeper(threading.Thread):
+    """
+    Heartbeat thread; refreshes the TTL of all leases held by this runner
+    every @ttl/3 seconds, as long as the lease is still owned by this runner
+    """
+    def __init__(self, rdx, ttl):
+        threading.Thread.__init__(self, name="lease-keeper")
+        self.daemon = True
+        self.rdx = rdx
+        self.ttl = ttl
+        self.leases = set()
+        self.lock = threading.Lock()
+        self.halt = threading.Event()
+
+    def add(self, lkey):
+        with self.lock:
+            self.leases.add(lkey)
+
+    def remove(self, lkey):
+        with self.lock:
+            self.leases.discard(lkey)
+
+    def run(self):
+        while not self.halt.wait(max(self.ttl / 3.0, 1.0)):
+            with self.lock:
+                tleases = list(self.leases)
+            for lkey in tleases:
+                try:
+                    if self.rdx.get(lkey) == runner_id:
+                        self.rdx.expire(lkey, self.ttl)
+                    else:
+                        logthis("Lost lease; job may have been requeued:", suffix=lkey, loglevel=LL.WARNING)
+                except Exception as e:
+                    logexc(e, "Failed to refresh lease %s" % (lkey))
+
+    def stop(self):
+        self.halt.set()
 
 def cb_xfer(jdata):
     """
@@ -168,8 +396,9 @@ def cb_xfer(jdata):
     scp to copy the file to the new host
     @jdata {jid, fid, opts: {infile, realpath, basefile, location, ...}}
     """
-    global mdx, hmetrics, config
-    xfer_loc = config.srv['xfer_path'].rstrip('/')
+    global mdx
+    xconf, hmetrics, xprofiles = jobconf  #pylint: disable=unused-variable
+    xfer_loc = xconf.srv['xfer_path'].rstrip('/')
 
     # get options from job request
     jid = jdata['id']
@@ -198,6 +427,18 @@ def cb_xfer(jdata):
         enqueue('xcode', jid, fid, opts)
         return 0
 
+    # check if the file is already present on this host
+    hkey = cluster.host_key(cluster.get_node_id(xconf))
+    if hkey in fvid['location'] and check_file_xfer(fvid['location'][hkey]['fpath']['real'], fvid['location'][hkey]['stat']['size']):
+        logthis("xfer: File is available locally; no transfer required.", loglevel=LL.VERBOSE)
+        update_status(fid, "queued-xcode")
+        opts['infile'] = fvid['location'][hkey]['fpath']['file']
+        opts['basefile'] = fvid['location'][hkey]['fpath']['base']
+        opts['location'] = hkey
+        opts['realpath'] = fvid['location'][hkey]['fpath']['real']
+        enqueue('xcode', jid, fid, opts)
+        return 0
+
     # determine location with lowest metric (if multiple locations present)
     lbest = (None, None)
     for ttl in fvid['location'].keys():
@@ -214,7 +455,7 @@ def cb_xfer(jdata):
 
     # connect using only the host portion of the FQDN
     # if srv.xfer_hostonly option is enabled
-    if config.srv['xfer_hostonly']:
+    if xconf.srv['xfer_hostonly']:
         try:
             r_host = re.match(r'^([^\.]+)\.', xrem_host).group(1)
             logthis("xfer: Using hostname for ssh connection:", suffix=r_host, loglevel=LL.VERBOSE)
@@ -260,13 +501,14 @@ def cb_xcode(jdata):
     Job processor for xcode queue (callback)
     Uses information from the request, as well as current settings and defaults to determine
     transcoding parameters. Then xcode.run() is called to handle transcoding via FFmpeg
-    @jdata {jid, fid, opts: {profile, version, realpath, basefile, location, no_subs, vscap, fansub, ...}}
+    @jdata {jid, fid, opts: {profile, version, renditions, realpath, basefile, location, no_subs, vscap, fansub, ...}}
     """
-    global mdx, xprofiles, config
+    global mdx
+    xconf, hmetrics, xprofiles = jobconf  #pylint: disable=unused-variable
 
     # get global options
-    outpath = os.path.expanduser(config.srv['xcode_outpath']).rstrip("/")
-    s_allow = int(config.srv['xcode_scale_allowance'])
+    outpath = os.path.expanduser(xconf.srv['xcode_outpath']).rstrip("/")
+    s_allow = int(xconf.srv['xcode_scale_allowance'])
 
     # get options from job request
     jid = jdata['id']
@@ -274,7 +516,7 @@ def cb_xcode(jdata):
     opts = jdata['opts']
 
     # set profile & version
-    xprof = opts.get('profile', config.srv['xcode_default_profile']).lower()
+    xprof = opts.get('profile', xconf.srv['xcode_default_profile']).lower()
     vname = opts.get('version', xprof)
     profdata = xprofiles.get(xprof, {})
 
@@ -298,39 +540,39 @@ def cb_xcode(jdata):
     logthis("xcode: Profile:", suffix=xprof, loglevel=LL.VERBOSE)
     logthis("xcode: Profile data:", suffix=json.dumps(profdata), loglevel=LL.DEBUG)
 
-    # Create new XConfig instance
-    newconf = config._clone()
+    # Per-job option overrides; applied to a clone of the config
+    xover = {'run': {}, 'vid': {}, 'xcode': {}}
 
     ## Set encoding options
-    if newconf.core['loglevel'] > LL.VERBOSE:
-        newconf.xcode['show_ffmpeg'] = True
+    if xconf.core['loglevel'] > LL.VERBOSE:
+        xover['xcode']['show_ffmpeg'] = True
     else:
-        newconf.xcode['show_ffmpeg'] = newconf.srv['xcode_show_ffmpeg']
+        xover['xcode']['show_ffmpeg'] = xconf.srv['xcode_show_ffmpeg']
 
     # Set File, ID, and Version info
-    newconf.run['infile'] = f_in
-    newconf.run['outfile'] = f_out
-    newconf.run['id'] = fid
-    newconf.vid['location'] = opts['location']
-    newconf.vid['vername'] = vname
+    xover['run']['infile'] = f_in
+    xover['run']['outfile'] = f_out
+    xover['run']['id'] = fid
+    xover['vid']['location'] = opts['location']
+    xover['vid']['vername'] = vname
 
     # Audio options
-    newconf.xcode['acopy'] = 'auto'
-    newconf.xcode['downmix'] = 'auto'
-    newconf.xcode['abr'] = int(profdata.get('abr', 128))
+    xover['xcode']['acopy'] = 'auto'
+    xover['xcode']['downmix'] = 'auto'
+    xover['xcode']['abr'] = int(profdata.get('abr', 128))
 
     # Subtitle options
     if not opts.get('no_subs', False):
-        newconf.run['bake'] = True
-        newconf.xcode['subid'] = 'auto'
+        xover['run']['bake'] = True
+        xover['xcode']['subid'] = 'auto'
     else:
-        newconf.run['bake'] = False
+        xover['run']['bake'] = False
 
     # Screenshot options
     if opts.get('vscap', 0):
-        newconf.run['vscap'] = opts['vscap']
+        xover['run']['vscap'] = opts['vscap']
     elif int(opts.get('vscap', 0)) == -1:
-        newconf.run['vscap'] = False
+        xover['run']['vscap'] = False
     else:
         # If no vscap offset is set, then take the 3rd chapter offset and add 5 seconds
         # If no 3rd chapter, 440 seconds? go!
@@ -338,24 +580,94 @@ def cb_xcode(jdata):
             zoff = int(fvid['mediainfo']['menu'][2]['offset']) + 5
         except:
             zoff = 440
-        newconf.run['vscap'] = zoff
+        xover['run']['vscap'] = zoff
 
     # Metadata options
     if opts.get('fansub', False):
-        newconf.run['fansub'] = opts['fansub']
+        xover['run']['fansub'] = opts['fansub']
     else:
-        newconf.run['fansub'] = None
+        xover['run']['fansub'] = None
 
     ## Video options
-    newconf.xcode['crf'] = int(profdata.get('crf', config.xcode['crf']))
+    xover['xcode']['crf'] = int(profdata.get('crf', xconf.xcode['crf']))
+    xover['xcode']['segments'] = int(profdata.get('segments', xconf.xcode['segments']) or 0)
+
+    # Preset & thread count recommended for this machine by `xbake --tune`
+    xtune = tune.get_tuning(xconf, xprof)
+    if xtune:
+        xover['xcode']['libx264_preset'] = xtune['preset']
+        xover['xcode']['threads'] = xtune['threads']
+        logthis("xcode: Using tuned preset %s / %d threads" % (xtune['preset'], xtune['threads']), loglevel=LL.VERBOSE)
 
     # Performing scaling to match profile, if necessary
+    xover['xcode']['scale'] = get_profile_scale(profdata, fvid['mediainfo']['video'][0], s_allow)
+
+    # Multiple renditions, encoded from a single decode of the source
+    # Each rendition uses the scale, CRF, and audio bitrate from its own profile
+    if opts.get('renditions'):
+        renditions = []
+        for tprof in opts['renditions']:
+            tprof = tprof.lower()
+            tpdata = xprofiles.get(tprof, {})
+            renditions.append({
+                                'name': tprof,
+                                'outfile': outpath + "/" + tprof + "/" + opts['basefile'] + ".mp4",
+                                'scale': get_profile_scale(tpdata, fvid['mediainfo']['video'][0], s_allow),
+                                'crf': int(tpdata.get('crf', xconf.xcode['crf'])),
+                                'abr': int(tpdata.get('abr', 128))
+                              })
+        xover['xcode']['renditions'] = renditions
+        xover['vid']['vername'] = renditions[0]['name']
+        xtune = tune.get_tuning(xconf, renditions[0]['name'])
+        if xtune:
+            xover['xcode']['libx264_preset'] = xtune['preset']
+            xover['xcode']['threads'] = xtune['threads']
+        logthis("xcode: Renditions:", suffix=json.dumps(renditions), loglevel=LL.VERBOSE)
+
+    # Create new XConfig instance
+    newconf = xconf._clone(xover)
+
+    # print params for debugging
+    logthis("xcode: Set xsetup.xcode newconf:\n", suffix=str(newconf.xcode), loglevel=LL.DEBUG)
+    logthis("xcode: Set xsetup.run newconf:\n", suffix=str(newconf.run), loglevel=LL.DEBUG)
+    logthis("xcode: Set xsetup.vid newconf:\n", suffix=str(newconf.vid), loglevel=LL.DEBUG)
+
+    # Transcode
+    logthis("xcode: Handing off control to xbake.xcode module for transcoding.", loglevel=LL.VERBOSE)
+    update_status(fid, "transcoding")
+    xcode.run(newconf)
+
+    # Check for presence of output file(s)
+    if newconf.xcode['renditions']:
+        f_out = [x['outfile'] for x in newconf.xcode['renditions'] if not os.path.exists(x['outfile'])]
+        if f_out:
+            logthis("xcode: Rendition output files not found:", suffix=f_out, loglevel=LL.ERROR)
+            update_status(fid, "new", lerror="transcoding failed")
+            return 121
+        logthis("xcode: Transcoding completed successfully", loglevel=LL.VERBOSE)
+        update_status(fid, "complete")
+        return 0
+    elif not os.path.exists(f_out):
+        logthis("xcode: Output file not found. Transcoding failed.", loglevel=LL.ERROR)
+        update_status(fid, "new", lerror="transcoding failed")
+        return 121
+    else:
+        logthis("xcode: Transcoding completed successfully", loglevel=LL.VERBOSE)
+        update_status(fid, "complete")
+        return 0
+
+def get_profile_scale(profdata, midata, s_allow):
+    """
+    determine scaling needed to match encoding profile @profdata, for source video
+    with mediainfo video track data @midata, allowing @s_allow pixels of tolerance
+    returns scale string ("width:height"), or None if no scaling is required
+    """
     xscale = False
     if profdata.get('height', False):
         # Get source size and AR
-        v_width = int(fvid['mediainfo']['video'][0].get('width', 0))
-        v_height = int(fvid['mediainfo']['video'][0].get('height', 0))
-        v_ar, v_iar, v_dar = get_aspect(fvid['mediainfo']['video'][0])  #pylint: disable=unused-variable
+        v_width = int(midata.get('width', 0))
+        v_height = int(midata.get('height', 0))
+        v_ar, v_iar, v_dar = get_aspect(midata)  #pylint: disable=unused-variable
 
         # calculate expected/target size
         x_height = int(profdata['height'])
@@ -376,29 +688,9 @@ def cb_xcode(jdata):
             s_width = x_width
         # ensure s_width is always even
         s_width += s_width % 2
-        newconf.xcode['scale'] = "%d:%d" % (s_width, x_height)
+        return "%d:%d" % (s_width, x_height)
     else:
-        newconf.xcode['scale'] = None
-
-    # print params for debugging
-    logthis("xcode: Set xsetup.xcode newconf:\n", suffix=str(newconf.xcode), loglevel=LL.DEBUG)
-    logthis("xcode: Set xsetup.run newconf:\n", suffix=str(newconf.run), loglevel=LL.DEBUG)
-    logthis("xcode: Set xsetup.vid newconf:\n", suffix=str(newconf.vid), loglevel=LL.DEBUG)
-
-    # Transcode
-    logthis("xcode: Handing off control to xbake.xcode module for transcoding.", loglevel=LL.VERBOSE)
-    update_status(fid, "transcoding")
-    xcode.run(newconf)
-
-    # Check for presence of output file
-    if not os.path.exists(f_out):
-        logthis("xcode: Output file not found. Transcoding failed.", loglevel=LL.ERROR)
-        update_status(fid, "new", lerror="transcoding failed")
-        return 121
-    else:
-        logthis("xcode: Transcoding completed successfully", loglevel=LL.VERBOSE)
-        update_status(fid, "complete")
-        return 0
+        return None
 
 def get_aspect(midata):
     """
@@ -431,11 +723,25 @@ def scp(src, dest):
 def enqueue(qname, jid, fid, opts, silent=False):
     """
     create a new job in queue (@qname), with job ID (@jid), file ID (@fid), and options (@opts)
+    if called from a job handler, the push is deferred until the running job is committed
+    in cluster mode, jobs are added to this node's private queue, unless @qname names a node queue
     """
-    global rdx
-    rdx.lpush("queue_"+qname, json.dumps({'id': jid, 'fid': fid, 'opts': opts}))
+    global rdx, config
+    if config is not None and cluster.enabled(config) and '@' not in qname:
+        qname = cluster.node_queue(qname, cluster.get_node_id(config))
+    rdx.lpush("queue_"+qname, json.dumps({'id': jid, 'uid': uuid.uuid4().hex, 'fid': fid, 'opts': opts}),
+              usepipe=(rdx.rpipe is not None))
     if not silent: logthis("Enqueued job# %s in queue:" % (jid), suffix=qname, loglevel=LL.VERBOSE)
 
+def set_jobstatus(qname, jid, rval):
+    """
+    record result @rval of job @jid from queue @qname in the 'jobstatus' hash;
+    added to the open transaction, if there is one
+    """
+    global rdx, config, runner_id
+    jstat = {'queue': qname, 'node': cluster.get_node_id(config), 'runner': runner_id, 'rval': rval, 'status': ('ok' if rval in (0, 1) else 'failed'), 'tstamp': time.time()}
+    rdx.hset("jobstatus", jid, json.dumps(jstat), usepipe=(rdx.rpipe is not None))
+
 def master_alive():
     """
     check if master process is alive
@@ -489,13 +795,12 @@ def check_file_exists(fname, chksum=False):
     else:
         return False
 
-def load_metrics():
+def load_metrics(xconfig):
     """
-    Load metrics from [hosts] section of RC file
+    Load metrics from [hosts] section of RC file @xconfig
     """
-    global config
-    if 'hosts' in config:
-        mets = config.hosts
+    if 'hosts' in xconfig:
+        mets = xconfig.hosts
     else:
         mets = {}
     mets2 = {}
@@ -507,27 +812,3 @@ def load_metrics():
 
     logthis("Host metric list:\n", suffix=print_r(mets2), loglevel=LL.DEBUG)
     return mets2
-
-def load_profiles():
-    """
-    Load encoding profiles from [profiles] section of RC file
-    """
-    global config
-    if 'profiles' in config:
-        profs = config.profiles
-    else:
-        profs = {}
-    oplist = {}
-    for tp in profs:
-        xlist = {}
-        try:
-            for tox in profs[tp].split(','):
-                k, v = tox.split('=')
-                xlist[k.lower()] = v
-            oplist[tp] = xlist
-        except Exception as e:
-            logthis("Failed to parse profile for", suffix=tp, loglevel=LL.ERROR)
-            logthis("Error:", suffix=e, loglevel=LL.ERROR)
-
-    logthis("Parsed xcode profiles:\n", suffix=print_r(oplist), loglevel=LL.DEBUG)
-    return oplist
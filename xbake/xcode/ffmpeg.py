@@ -16,8 +16,14 @@ https://ycnrg.org/
 
 import os
 import re
+import errno
+import json
+import time
+import hashlib
 import subprocess
 import shutil
+import tempfile
+import multiprocessing
 
 from xbake.common.logthis import *
 
@@ -26,10 +32,18 @@ class bpath:
     """container class for external tool paths"""
     ffpath = None
     mepath = None
+    mmpath = None
     impath = None
     wppath = None
     rhash = None
 
+# Binaries found by locateAll(); (bpath attribute, program name)
+# mkvmerge is optional, and only located when attachments are needed (see getAttachments())
+tools = (('ffpath', 'ffmpeg'), ('mepath', 'mkvextract'), ('impath', 'convert'), ('wppath', 'cwebp'))
+
+# ffmpeg version info, by ffmpeg path
+ffvcache = {}
+
 def locate(prog, isFatal=True):
     """
     Locate path to a binary
@@ -51,21 +65,90 @@ def locate(prog, isFatal=True):
 def locateAll(xconfig):
     """
     Locate required binaries (ffmpeg, mkvextract, etc.)
+    Results are kept in the tool cache (core.toolcache), and only located again
+    when PATH, a directory in PATH, or one of the binaries changes
+    """
+    cpath = os.path.expanduser(xconfig.core['toolcache']) if xconfig.core['toolcache'] else None
+    tcache = load_toolcache(cpath) if cpath else None
+
+    if tcache:
+        logthis("Using cached tool paths from", suffix=cpath, loglevel=LL.DEBUG)
+        for tattr, tprog in tools:
+            setattr(bpath, tattr, tcache['tools'][tprog]['path'])
+        ffvcache[bpath.ffpath] = tcache['version']
+    else:
+        for tattr, tprog in tools:
+            setattr(bpath, tattr, locate(tprog))
+        if cpath:
+            save_toolcache(cpath)
+
+def path_key():
+    """
+    return key for the directories in PATH; changes when any of them are modified
+    (eg. a binary is installed or removed)
+    """
+    kdata = []
+    for tdir in os.environ.get('PATH', '').split(os.pathsep):
+        try:
+            kdata.append("%s:%r" % (tdir, os.stat(tdir).st_mtime))
+        except OSError:
+            kdata.append("%s:-" % (tdir))
+    return hashlib.sha1('\n'.join(kdata)).hexdigest()
+
+def load_toolcache(cpath):
+    """
+    return cached tool paths & ffmpeg version for the current PATH from tool cache @cpath,
+    or None if there is no entry, or it is no longer valid
+    """
+    try:
+        with open(cpath) as f:
+            tcache = json.load(f).get(os.environ.get('PATH', ''))
+    except (IOError, ValueError):
+        return None
+
+    if not tcache or tcache.get('key') != path_key():
+        return None
+    for tattr, tprog in tools:
+        tinfo = tcache['tools'].get(tprog)
+        try:
+            if not tinfo or os.stat(tinfo['path']).st_mtime != tinfo['mtime']:
+                return None
+        except OSError:
+            return None
+    return tcache
+
+def save_toolcache(cpath):
+    """
+    save current tool paths & ffmpeg version to tool cache @cpath
+    one entry is kept for each PATH
     """
-    bpath.ffpath = locate('ffmpeg')
-    # check if ffmpeg path auto-detection is set to auto (ffmpeg.path = None)
-    # if so, set the path in the ffmpeg option block
-    if xconfig.ffmpeg['path'] is None:
-        xconfig.ffmpeg['path'] = bpath.ffpath
+    try:
+        with open(cpath) as f:
+            cdata = json.load(f)
+    except (IOError, ValueError):
+        cdata = {}
 
-    bpath.mepath = locate('mkvextract')
-    bpath.impath = locate('convert')
-    bpath.wppath = locate('cwebp')
+    try:
+        cdata[os.environ.get('PATH', '')] = {
+                                              'key': path_key(),
+                                              'tools': dict([(tprog, {'path': getattr(bpath, tattr), 'mtime': os.stat(getattr(bpath, tattr)).st_mtime})
+                                                             for tattr, tprog in tools]),
+                                              'version': version()
+                                            }
+        if not os.path.isdir(os.path.dirname(cpath)):
+            os.makedirs(os.path.dirname(cpath))
+        with open(cpath + ".tmp", 'w') as f:
+            json.dump(cdata, f)
+        os.rename(cpath + ".tmp", cpath)
+    except Exception as e:
+        logthis("Failed to update tool cache:", suffix=e, loglevel=LL.WARNING)
 
 def version():
     """
     Determine ffmpeg version and build information
     """
+    if bpath.ffpath in ffvcache:
+        return ffvcache[bpath.ffpath]
     verdata = subprocess.check_output([bpath.ffpath, '-version'])
     vdx = {
             'version': vmatch(r'^ffmpeg version ([^ ]+).*', verdata),
@@ -80,6 +163,7 @@ def version():
             'libswresample': vmatch(r'.*^libswresample\s*(.+?) \/.*$', verdata),
             'libpostproc': vmatch(r'.*^libpostproc\s*(.+?) \/.*$', verdata)
         }
+    ffvcache[bpath.ffpath] = vdx
     return vdx
 
 def vmatch(regex, instr, wstrip=False):
@@ -95,71 +179,193 @@ def vmatch(regex, instr, wstrip=False):
     else:
         return None
 
-def run(optlist, supout=False):
+def wait_child(proc, nohang=False):
+    """
+    wait for subprocess @proc with wait4(), which also returns the resource usage of that one process
+    (getrusage() only reports all children of this process combined, including those of other threads)
+    sets proc.returncode, and returns CPU time (user + system, in seconds) used by the process;
+    if @nohang is set, returns None if the process is still running
+    """
+    while True:
+        try:
+            tpid, tstat, tusage = os.wait4(proc.pid, os.WNOHANG if nohang else 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    if tpid == 0:
+        return None
+    if os.WIFSIGNALED(tstat):
+        proc.returncode = -os.WTERMSIG(tstat)
+    else:
+        proc.returncode = os.WEXITSTATUS(tstat)
+    return tusage.ru_utime + tusage.ru_stime
+
+def run(optlist, supout=False, stats=None):
     """
     Run ffmpeg; Input a list of options; if @supout is True, then suppress stderr
+    If @stats is a dict, the CPU time used by ffmpeg is added to stats['cpu']
     """
     logthis("Running ffmpeg with options:", suffix=optlist, loglevel=LL.DEBUG)
-    try:
-        if supout:
-            fout = subprocess.check_output([bpath.ffpath] + optlist, stderr=subprocess.STDOUT)
-        else:
-            fout = subprocess.check_output([bpath.ffpath] + optlist)
-    except subprocess.CalledProcessError as e:
-        logthis("ffmpeg failed:", suffix=e, loglevel=LL.ERROR)
+    tproc = subprocess.Popen([bpath.ffpath] + optlist, stdout=subprocess.PIPE, stderr=(subprocess.STDOUT if supout else None))
+    fout = tproc.stdout.read()
+    tproc.stdout.close()
+    tcpu = wait_child(tproc)
+    if tproc.returncode != 0:
+        logthis("ffmpeg failed; returned", suffix=tproc.returncode, loglevel=LL.ERROR)
         failwith(ER.PROCFAIL, "Transcoding failed. Unable to continue. Aborting")
 
     logthis("ffmpeg completed successfully", loglevel=LL.DEBUG)
+    if stats is not None:
+        stats['cpu'] = stats.get('cpu', 0.0) + tcpu
 
     return fout
 
-def dumpFonts(vfile, moveto=None):
+def run_parallel(optlists, maxprocs=None, supout=False, stats=None):
     """
-    Use ffmpeg -dump_attachment to dump font files for baking subs
+    Run multiple ffmpeg processes concurrently, at most @maxprocs (default: number of CPUs) at a time
+    @optlists is a list of option lists, as passed to run()
+    If @stats is a dict, the CPU time used by all of the processes is added to stats['cpu']
+    Returns a list with the wall-clock run time (in seconds) of each process
     """
+    if not maxprocs:
+        maxprocs = multiprocessing.cpu_count()
+    fnull = open(os.devnull, 'w') if supout else None
 
-    prelist = os.listdir(".")
-    try:
-        subprocess.check_output([bpath.ffpath, '-y', '-dump_attachment:t', '', '-i', vfile], stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError:
-        logthis("FFmpeg returned non-zero, but dump_attachment is buggy, so it's OK.", loglevel=LL.VERBOSE)
-
-    # get fonts that were dumped
-    postlist = os.listdir(".")
-    fontlist = list(set(postlist).difference(prelist))
-    if not len(fontlist):
-        logthis("Warning: No (new) fonts were dumped", loglevel=LL.WARNING)
-    else:
-        logthis("New fonts dumped:", suffix=len(fontlist), loglevel=LL.VERBOSE)
-        logthis("Fonts:", suffix=fontlist, loglevel=LL.DEBUG)
+    pending = list(enumerate(optlists))
+    running = {}
+    rtimes = [None] * len(optlists)
+    failed = False
+    while running or (pending and not failed):
+        while pending and not failed and len(running) < maxprocs:
+            tidx, topts = pending.pop(0)
+            logthis("Running ffmpeg [%d] with options:" % (tidx), suffix=topts, loglevel=LL.DEBUG)
+            running[tidx] = (subprocess.Popen([bpath.ffpath] + topts, stdout=fnull, stderr=fnull), time.time())
+
+        time.sleep(0.1)
+        for tidx, (tproc, tstart) in running.items():
+            tcpu = wait_child(tproc, nohang=True)
+            if tcpu is None:
+                continue
+            if stats is not None:
+                stats['cpu'] = stats.get('cpu', 0.0) + tcpu
+            rtimes[tidx] = time.time() - tstart
+            del running[tidx]
+            if tproc.returncode != 0:
+                logthis("ffmpeg [%d] failed; returned" % (tidx), suffix=tproc.returncode, loglevel=LL.ERROR)
+                failed = True
+
+    if fnull:
+        fnull.close()
+    if failed:
+        failwith(ER.PROCFAIL, "Transcoding failed. Unable to continue. Aborting")
+
+    logthis("ffmpeg processes completed successfully:", suffix=len(optlists), loglevel=LL.DEBUG)
+    return rtimes
 
-    # move fonts to another directory, if enabled
-    if moveto:
-        moveto = os.path.expanduser(moveto).rstrip('/')
-        for i in fontlist:
-            shutil.move(os.path.realpath(i), os.path.realpath(moveto + '/' + i))
-        logthis("Moved fonts to new location:", suffix=os.path.realpath(moveto), loglevel=LL.VERBOSE)
+def getAttachments(vfile):
+    """
+    Use mkvmerge -J to get the list of attachments in @vfile
+    returns list of {id, file_name, content_type, size}; empty if mkvmerge is not installed
+    """
+    if bpath.mmpath is None:
+        bpath.mmpath = locate('mkvmerge', isFatal=False)
+        if not bpath.mmpath:
+            logthis("mkvmerge not found; font attachments will not be extracted (install mkvtoolnix)", loglevel=LL.WARNING)
+    if not bpath.mmpath:
+        return []
 
-    return fontlist
+    try:
+        minfo = json.loads(subprocess.check_output([bpath.mmpath, '-J', vfile]))
+    except (subprocess.CalledProcessError, ValueError) as e:
+        logexc(e, "Failed to identify attachments with mkvmerge")
+        return []
+    return minfo.get('attachments', [])
 
+def isFont(attach):
+    """return True if attachment @attach (from getAttachments()) is a font"""
+    return bool(re.search(r'font|truetype|opentype', attach.get('content_type') or '', re.I) or
+                re.search(r'\.(ttf|ttc|otf)$', attach.get('file_name') or '', re.I))
 
-def dumpSub(vfile, trackid, outfile):
+def extractSubsFonts(vfile, workdir, trackid, subfile, fontcache):
     """
-    Use mkvextract to dump subtitle track @trackid from @vfile to @outfile
+    Extract subtitle track @trackid from @vfile to @subfile, and all font attachments, with a single
+    mkvextract run. Fonts are kept in the shared, content-addressed @fontcache (deduplicated by SHA-1),
+    and symlinked into @workdir/fonts under their original names for use with the ass filter's fontsdir
+    Fonts are extracted to a temporary dir inside @fontcache, so that new ones can be renamed into place
+    (@workdir is usually on another filesystem); fonts already in the cache are discarded
+    returns path to the fonts directory
     """
-    # run mkvextract to dump subtitle track
+    fontcache = os.path.realpath(os.path.expanduser(fontcache))
+    fontdir = workdir + "/fonts"
+    for tdir in (fontcache, fontdir):
+        if not os.path.isdir(tdir):
+            os.makedirs(tdir)
+    rawdir = tempfile.mkdtemp(prefix=".new_", dir=fontcache)
     try:
-        subprocess.check_output([bpath.mepath, 'tracks', vfile, "%d:%s" % (trackid, outfile)])
+        nfonts = extract_fonts(vfile, fontdir, rawdir, trackid, subfile, fontcache)
+    finally:
+        shutil.rmtree(rawdir, ignore_errors=True)
+    logthis("Fonts: %d in container, %d newly cached" % nfonts, loglevel=LL.VERBOSE)
+    return fontdir
+
+def extract_fonts(vfile, fontdir, rawdir, trackid, subfile, fontcache):
+    """
+    run mkvextract for extractSubsFonts(), and move new fonts from @rawdir into @fontcache
+    Every font is extracted, since only its contents (not its name or size) identify it
+    returns tuple (fonts in container, fonts newly cached)
+    """
+    fonts = []
+    xspec = []
+    for tatt in getAttachments(vfile):
+        if not isFont(tatt):
+            continue
+        fname = os.path.basename(tatt['file_name'])
+        fonts.append(fname)
+        xspec.append("%d:%s/%s" % (tatt['id'], rawdir, fname))
+
+    mxopts = [bpath.mepath, vfile, 'tracks', "%d:%s" % (trackid, subfile)]
+    if xspec:
+        mxopts += ['attachments'] + xspec
+
+    try:
+        subprocess.check_output(mxopts)
     except subprocess.CalledProcessError as e:
         logexc(e, "mkvextract failed")
         failwith(ER.PROCFAIL, "Sub extraction failed. Unable to continue. Aborting")
 
     # check for output file
-    if not os.path.exists(outfile):
-        logthis("Expected output sub file, but not found:", suffix=outfile, loglevel=LL.ERROR)
+    if not os.path.exists(subfile):
+        logthis("Expected output sub file, but not found:", suffix=subfile, loglevel=LL.ERROR)
         failwith(ER.PROCFAIL, "Sub extraction failed. Unable to continue. Aborting")
+    logthis("Extracted subtitle track successfully:", suffix=subfile, loglevel=LL.VERBOSE)
+
+    # move new fonts into the cache, by SHA-1 of their contents
+    ncached = 0
+    for fname in fonts:
+        tnew = rawdir + "/" + fname
+        if not os.path.exists(tnew):
+            logthis("Font attachment was not extracted:", suffix=fname, loglevel=LL.WARNING)
+            continue
+        with open(tnew, 'rb') as f:
+            fhash = hashlib.sha1(f.read()).hexdigest()
+        cfile = fontcache + "/" + fhash + os.path.splitext(fname)[1].lower()
+        if not os.path.exists(cfile):
+            try:
+                os.rename(tnew, cfile)
+                ncached += 1
+            except OSError as e:
+                logexc(e, "Failed to add font to cache (%s)" % (fname))
+
+        # link into this job's font dir; if the font could not be cached, use the extracted copy
+        tlink = fontdir + "/" + fname
+        if not os.path.lexists(tlink):
+            if os.path.exists(cfile):
+                os.symlink(cfile, tlink)
+            else:
+                shutil.move(tnew, tlink)
 
-    logthis("Extracted subtitle track successfully:", suffix=outfile, loglevel=LL.VERBOSE)
+    return (len(fonts), ncached)
 
 def vscap(vfile, offset, outfile, supout=True):
     """
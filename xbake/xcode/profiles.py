@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+xbake.xcode.profiles
+Encoding profiles
+
+@author   Jacob Hipps <jacob@ycnrg.org>
+@repo     https://git.ycnrg.org/projects/YXB/repos/yc_xbake
+
+Copyright (c) 2013-2017 J. Hipps / Neo-Retro Group, Inc.
+https://ycnrg.org/
+
+"""
+
+from xbake.common.logthis import *
+
+
+def load(xconfig):
+    """
+    Load encoding profiles from [profiles] section of RC file @xconfig
+    returns dict of profile name => {option: value}
+    """
+    if 'profiles' in xconfig:
+        profs = xconfig.profiles
+    else:
+        profs = {}
+    oplist = {}
+    for tp in profs:
+        xlist = {}
+        try:
+            for tox in profs[tp].split(','):
+                k, v = tox.split('=')
+                xlist[k.lower()] = v
+            oplist[tp] = xlist
+        except Exception as e:
+            logthis("Failed to parse profile for", suffix=tp, loglevel=LL.ERROR)
+            logthis("Error:", suffix=e, loglevel=LL.ERROR)
+
+    logthis("Parsed xcode profiles:\n", suffix=print_r(oplist), loglevel=LL.DEBUG)
+    return oplist
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+xbake.xcode.tune
+Encoder auto-tuning
+
+@author   Jacob Hipps <jacob@ycnrg.org>
+@repo     https://git.ycnrg.org/projects/YXB/repos/yc_xbake
+
+Copyright (c) 2013-2017 J. Hipps / Neo-Retro Group, Inc.
+https://ycnrg.org/
+
+"""
+
+from __future__ import print_function
+
+import os
+import json
+import time
+import socket
+import shutil
+import tempfile
+import multiprocessing
+
+from xbake.common.logthis import *
+from xbake.xcode import ffmpeg, profiles
+
+# Test clip frame rate
+TUNE_RATE = 24000.0 / 1001.0
+
+# Cached tuning data; (path, mtime, data)
+tcache = (None, None, None)
+
+
+def tuning_path(xconfig):
+    """return path to the tuning file"""
+    return os.path.realpath(os.path.expanduser(xconfig.xcode['tuning_file']))
+
+def load(xconfig):
+    """
+    load tuning data from the tuning file; returns an empty dict if it does not exist
+    the file is only re-read when it has been modified
+    """
+    global tcache
+    tpath = tuning_path(xconfig)
+    try:
+        tmtime = os.stat(tpath).st_mtime
+    except OSError:
+        return {}
+
+    if tcache[0] != tpath or tcache[1] != tmtime:
+        try:
+            with open(tpath) as f:
+                tcache = (tpath, tmtime, json.load(f))
+        except (IOError, ValueError) as e:
+            logthis("Failed to read tuning file:", suffix=e, loglevel=LL.WARNING)
+            return {}
+    return tcache[2]
+
+def get_tuning(xconfig, profile):
+    """
+    return recommended {preset, threads} for encoding profile @profile on this machine,
+    or None if it has not been tuned
+    """
+    if not xconfig.xcode['tuning_file']:
+        return None
+    return load(xconfig).get('profiles', {}).get(profile)
+
+def get_threads():
+    """return thread counts to test; powers of two up to the number of CPU threads, and the number of CPU threads"""
+    ncpu = multiprocessing.cpu_count()
+    tlist = [1]
+    while tlist[-1] * 2 < ncpu:
+        tlist.append(tlist[-1] * 2)
+    if tlist[-1] != ncpu:
+        tlist.append(ncpu)
+    return tlist
+
+def get_cpu_model():
+    """return CPU model name, if available"""
+    try:
+        with open('/proc/cpuinfo') as f:
+            for tline in f:
+                if tline.startswith('model name'):
+                    return tline.split(':', 1)[1].strip()
+    except IOError:
+        pass
+    return None
+
+def encode_test(tdir, size, clen, crf, preset, threads):
+    """
+    encode a @clen second synthetic test clip of @size (width:height) with the given options
+    returns tuple (frames per second, output size in bytes)
+    """
+    tfile = tdir + "/tune.mp4"
+    t_start = time.time()
+    ffmpeg.run(['-y', '-f', 'lavfi', '-i', "testsrc=size=%s:rate=24000/1001" % (size.replace(':', 'x')), '-t', str(clen),
+                '-c:v', 'libx264', '-crf', str(crf), '-preset:v', preset, '-threads', str(threads), tfile], True)
+    t_total = time.time() - t_start
+    fsize = os.stat(tfile).st_size
+    os.remove(tfile)
+    return ((clen * TUNE_RATE) / t_total, fsize)
+
+def recommend(results, min_fps):
+    """
+    choose the recommended preset & thread count from test @results
+    The slowest preset (best compression) that reaches @min_fps wins, using the fewest threads
+    that reach it, which leaves the remaining cores free for other jobs. If nothing reaches
+    @min_fps, the fastest result is used
+    """
+    passing = [x for x in results if x['fps'] >= min_fps]
+    if passing:
+        best = sorted(passing, key=lambda x: (-x['prank'], x['threads']))[0]
+    else:
+        best = sorted(results, key=lambda x: -x['fps'])[0]
+    return {'preset': best['preset'], 'threads': best['threads'], 'fps': best['fps'], 'size': best['size'],
+            'jobs': max(multiprocessing.cpu_count() // best['threads'], 1)}
+
+def run(xconfig):
+    """
+    Implements --tune mode
+    Encodes a synthetic test clip at each encoding profile's resolution with every
+    preset in xcode.tune_presets and a range of thread counts, then writes the
+    recommended preset & thread count for each profile to the tuning file
+    """
+    if not xconfig.xcode['tuning_file']:
+        failwith(ER.OPT_MISSING, "No tuning file set. Set xcode.tuning_file in the config file.")
+
+    xprofiles = profiles.load(xconfig) or {'default': {}}
+    presets = [x.strip() for x in str(xconfig.xcode['tune_presets']).split(',') if x.strip()]
+    threads = get_threads()
+    clen = int(xconfig.xcode['tune_length'])
+    min_fps = float(xconfig.xcode['tune_min_fps'])
+    ffmpeg.bpath.ffpath = ffmpeg.locate('ffmpeg')
+
+    logthis("Tuning presets %s with thread counts %s (%ds clips)" % (presets, threads, clen), loglevel=LL.INFO)
+
+    tdata = {
+              'host': socket.getfqdn(),
+              'cpu': get_cpu_model(),
+              'cores': multiprocessing.cpu_count(),
+              'ffmpeg': ffmpeg.version()['version'],
+              'min_fps': min_fps,
+              'created': time.time(),
+              'profiles': {}
+            }
+
+    tdir = tempfile.mkdtemp(prefix="xbake_tune_")
+    try:
+        for tprof in sorted(xprofiles):
+            pdata = xprofiles[tprof]
+            size = "%d:%d" % (int(pdata.get('width', 1920)), int(pdata.get('height', 1080)))
+            crf = int(pdata.get('crf', xconfig.xcode['crf']))
+            results = []
+            for prank, tpreset in enumerate(presets):
+                for tthreads in threads:
+                    fps, fsize = encode_test(tdir, size, clen, crf, tpreset, tthreads)
+                    logthis("%s: preset %s / %d threads:" % (tprof, tpreset, tthreads), suffix="%.1f fps, %d bytes" % (fps, fsize), loglevel=LL.VERBOSE)
+                    results.append({'preset': tpreset, 'prank': prank, 'threads': tthreads, 'fps': fps, 'size': fsize})
+            tdata['profiles'][tprof] = recommend(results, min_fps)
+            tdata['profiles'][tprof]['results'] = results
+    finally:
+        shutil.rmtree(tdir, ignore_errors=True)
+
+    tpath = tuning_path(xconfig)
+    if not os.path.isdir(os.path.dirname(tpath)):
+        os.makedirs(os.path.dirname(tpath))
+    with open(tpath + ".tmp", 'w') as f:
+        json.dump(tdata, f, indent=4)
+    os.rename(tpath + ".tmp", tpath)
+    tstatus('tune', tuning=tdata)
+
+    print("")
+    print("** Encoder tuning (%s, %d CPU threads, target %.1f fps):" % (tdata['host'], tdata['cores'], min_fps))
+    for tprof in sorted(tdata['profiles']):
+        trec = tdata['profiles'][tprof]
+        print("   {:16} preset {:10} {:>3} threads {:>8.1f} fps {:>12,} bytes ({} concurrent jobs)".format(
+              tprof, trec['preset'], trec['threads'], trec['fps'], trec['size'], trec['jobs']))
+    print("")
+    print("** Saved to", tpath)
+    print("")
+    return 0
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+xbake.xcode.xcache
+Encode result cache
+
+@author   Jacob Hipps <jacob@ycnrg.org>
+@repo     https://git.ycnrg.org/projects/YXB/repos/yc_xbake
+
+Copyright (c) 2013-2017 J. Hipps / Neo-Retro Group, Inc.
+https://ycnrg.org/
+
+"""
+
+from __future__ import print_function
+
+import os
+import json
+import time
+import errno
+import fcntl
+import shutil
+import hashlib
+
+from xbake.common.logthis import *
+from xbake.xcode import ffmpeg
+
+# ffmpeg version & build config, by ffmpeg path
+ffident = {}
+
+
+def enabled(xconfig):
+    """return True if the encode cache is enabled (xcode.cache_dir is set)"""
+    return bool(xconfig.xcode['cache_dir'])
+
+def cache_root(xconfig):
+    """return path to the cache directory"""
+    return os.path.realpath(os.path.expanduser(xconfig.xcode['cache_dir']))
+
+def get_ffident():
+    """return ffmpeg version & build configuration, as used in the fingerprint"""
+    if ffmpeg.bpath.ffpath not in ffident:
+        ffver = ffmpeg.version()
+        ffident[ffmpeg.bpath.ffpath] = {'version': ffver['version'], 'config': ffver['config']}
+    return ffident[ffmpeg.bpath.ffpath]
+
+def fingerprint(srcmd5, encopts):
+    """
+    calculate encode fingerprint from the MD5 checksum of the source (@srcmd5), the ffmpeg
+    version, and the fully-resolved encoding options (@encopts; must not contain any paths
+    that change between runs, such as the input and output files)
+    """
+    fpdata = json.dumps({'source': srcmd5, 'ffmpeg': get_ffident(), 'options': encopts}, sort_keys=True)
+    return hashlib.sha1(fpdata).hexdigest()
+
+def entry_paths(xconfig, fp):
+    """return (output file, metadata file) paths for fingerprint @fp"""
+    tdir = cache_root(xconfig) + "/" + fp[:2]
+    return (tdir + "/" + fp + ".out", tdir + "/" + fp + ".json")
+
+def link_or_copy(src, dest):
+    """hardlink @src to @dest, or copy it if they are on different filesystems"""
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(src, dest)
+
+def read_meta(mfile):
+    """read cache entry metadata from @mfile; returns None if missing or unreadable"""
+    try:
+        with open(mfile) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def write_meta(mfile, meta):
+    """atomically write cache entry metadata @meta to @mfile"""
+    with open(mfile + ".tmp", 'w') as f:
+        json.dump(meta, f)
+    os.rename(mfile + ".tmp", mfile)
+
+def update_stats(xconfig, **kwargs):
+    """
+    add values in @kwargs to the cache statistics; returns the updated statistics
+    """
+    croot = cache_root(xconfig)
+    if not os.path.isdir(croot):
+        os.makedirs(croot)
+    sfile = croot + "/stats.json"
+    with open(sfile + ".lock", 'a') as lf:
+        fcntl.flock(lf, fcntl.LOCK_EX)
+        xstats = read_meta(sfile) or {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0, 'bytes_saved': 0, 'cpu_saved': 0.0}
+        for tk, tv in kwargs.items():
+            xstats[tk] = xstats.get(tk, 0) + tv
+        write_meta(sfile, xstats)
+    return xstats
+
+def fetch(xconfig, fp, outfile):
+    """
+    if there is a cached result for fingerprint @fp, link it to @outfile
+    returns the entry metadata on a hit, or None on a miss
+    """
+    cfile, mfile = entry_paths(xconfig, fp)
+    meta = read_meta(mfile)
+    if meta is None or not os.path.exists(cfile):
+        update_stats(xconfig, misses=1)
+        logthis("Encode cache miss:", suffix=fp, loglevel=LL.VERBOSE)
+        return None
+
+    link_or_copy(cfile, outfile)
+    meta['hits'] = meta.get('hits', 0) + 1
+    meta['last_hit'] = time.time()
+    write_meta(mfile, meta)
+    update_stats(xconfig, hits=1, bytes_saved=meta['size'], cpu_saved=meta['cpu_time'])
+
+    logthis("Encode cache hit: %s (saved %.1f CPU-minutes)" % (fp, meta['cpu_time'] / 60.0), ccode=C.GRN, loglevel=LL.INFO)
+    return meta
+
+def store(xconfig, fp, outfile, srcmd5, encopts, cpu_time):
+    """
+    add encoded file @outfile to the cache under fingerprint @fp
+    @cpu_time is the CPU time (in seconds) the encode took, for the savings report
+    """
+    cfile, mfile = entry_paths(xconfig, fp)
+    try:
+        if not os.path.exists(os.path.dirname(cfile)):
+            os.makedirs(os.path.dirname(cfile))
+        link_or_copy(outfile, cfile)
+        write_meta(mfile, {
+                            'fingerprint': fp,
+                            'source': srcmd5,
+                            'ffmpeg': get_ffident(),
+                            'options': encopts,
+                            'ext': os.path.splitext(outfile)[1],
+                            'size': os.stat(cfile).st_size,
+                            'cpu_time': cpu_time,
+                            'created': time.time(),
+                            'last_hit': time.time(),
+                            'hits': 0
+                          })
+    except Exception as e:
+        logexc(e, "Failed to add encode result to cache")
+        return False
+
+    update_stats(xconfig, stored=1)
+    logthis("Added encode result to cache:", suffix=fp, loglevel=LL.VERBOSE)
+    evict(xconfig)
+    return True
+
+def entries(xconfig):
+    """return list of (output file, metadata file, metadata) for all cache entries"""
+    croot = cache_root(xconfig)
+    elist = []
+    if not os.path.isdir(croot):
+        return elist
+    for tsub in os.listdir(croot):
+        tdir = croot + "/" + tsub
+        if not os.path.isdir(tdir):
+            continue
+        for tfile in os.listdir(tdir):
+            if not tfile.endswith(".json"):
+                continue
+            mfile = tdir + "/" + tfile
+            meta = read_meta(mfile)
+            if meta:
+                elist.append((mfile[:-5] + ".out", mfile, meta))
+    return elist
+
+def evict(xconfig):
+    """
+    remove cache entries not used within xcode.cache_max_age days, then remove the least
+    recently used entries until the cache is smaller than xcode.cache_max_size GiB
+    returns tuple (entries removed, bytes freed)
+    """
+    max_age = float(xconfig.xcode['cache_max_age'] or 0) * 86400.0
+    max_size = float(xconfig.xcode['cache_max_size'] or 0) * (1024 ** 3)
+    if not max_age and not max_size:
+        return (0, 0)
+
+    elist = sorted(entries(xconfig), key=lambda x: x[2].get('last_hit', 0))
+    csize = sum([x[2]['size'] for x in elist])
+    tnow = time.time()
+    ecount = 0
+    efreed = 0
+    for cfile, mfile, meta in elist:
+        expired = max_age and (tnow - meta.get('last_hit', 0)) > max_age
+        if not expired and not (max_size and csize > max_size):
+            continue
+        for tf in (mfile, cfile):
+            try:
+                os.remove(tf)
+            except OSError:
+                pass
+        csize -= meta['size']
+        ecount += 1
+        efreed += meta['size']
+        logthis("Evicted from encode cache:", suffix=meta['fingerprint'], loglevel=LL.DEBUG)
+
+    if ecount:
+        update_stats(xconfig, evicted=ecount)
+        logthis("Encode cache: evicted %d entries (%d bytes)" % (ecount, efreed), loglevel=LL.VERBOSE)
+    return (ecount, efreed)
+
+def report(xconfig):
+    """
+    return cache usage & savings report
+    """
+    elist = entries(xconfig)
+    xstats = read_meta(cache_root(xconfig) + "/stats.json") or {}
+    return {
+             'path': cache_root(xconfig),
+             'entries': len(elist),
+             'size': sum([x[2]['size'] for x in elist]),
+             'hits': xstats.get('hits', 0),
+             'misses': xstats.get('misses', 0),
+             'stored': xstats.get('stored', 0),
+             'evicted': xstats.get('evicted', 0),
+             'bytes_saved': xstats.get('bytes_saved', 0),
+             'cpu_hours_saved': xstats.get('cpu_saved', 0.0) / 3600.0
+           }
+
+def run(xconfig):
+    """
+    Implements --xcache mode
+    Runs eviction, then displays the cache report
+    """
+    if not enabled(xconfig):
+        failwith(ER.OPT_MISSING, "Encode cache is not enabled. Set xcode.cache_dir in the config file.")
+
+    evict(xconfig)
+    xrep = report(xconfig)
+    tstatus('xcache', report=xrep)
+
+    print("")
+    print("** Encode cache:", xrep['path'])
+    print("   {:24} {:>16,}".format("Entries", xrep['entries']))
+    print("   {:24} {:>16,}".format("Size (bytes)", xrep['size']))
+    print("   {:24} {:>16,}".format("Hits", xrep['hits']))
+    print("   {:24} {:>16,}".format("Misses", xrep['misses']))
+    print("   {:24} {:>16,}".format("Evicted", xrep['evicted']))
+    print("   {:24} {:>16,}".format("Bytes saved", xrep['bytes_saved']))
+    print("   {:24} {:>16.2f}".format("CPU-hours saved", xrep['cpu_hours_saved']))
+    print("")
+    return 0
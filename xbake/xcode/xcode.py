@@ -15,11 +15,15 @@ https://ycnrg.org/
 """
 
 import os
+import time
+import shutil
+import tempfile
+import multiprocessing
 import enzyme
 
 from xbake.common.logthis import *
 from xbake.mscan.util import *
-from xbake.xcode import ffmpeg
+from xbake.xcode import ffmpeg, xcache
 from xbake.mscan import util
 from xbake.common import db
 
@@ -39,71 +43,52 @@ class STYPE:
     SRT = 'S_TEXT/UTF8'
     VOB = 'S_VOBSUB'
 
-class vx:
+class JobData(object):
     """
-    Video working data
+    Attribute container
     """
-    # Video metadata, will be sent directly to Mongo
-    # and inserted into db.videos
-    xvid = {}
-    # Entry data from db.files
-    fdi = {}
-    # Matching entry from db.episodes
-    fdi_epx = {}
-    # Matching entry from db.series
-    fdi_srx = {}
-
-class vinfo:
-    """
-    Video identification info
-    """
-    # pylint: disable=missing-docstring
-    id = None
-    location = None
-    mxmode = None
-    vername = None
-    class sub:
-        track = None
-        type = None
-        tdata = None
-    class aud:
-        track = None
-        type = None
-        channels = None
-    class infile:
-        file = None
-        path = None
-        base = None
-        ext = None
-        full = None
-    class outfile:
-        file = None
-        path = None
-        base = None
-        ext = '.mp4'
-        full = None
-
-class ffo:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class TranscodeJob(object):
     """
-    ffmpeg options
+    Per-job transcoding state
     """
-    scaler = []
-    subs = []
-    audio = []
-    video = []
-    filters = []
-
-# Mongo object
-monjer = None
-config = None
+    def __init__(self, xconfig):
+        self.config = xconfig
+        # Mongo object
+        self.monjer = None
+
+        # Video identification info
+        self.id = None
+        self.location = None
+        self.mxmode = None
+        self.vername = None
+        self.sub = JobData(track=None, type=None, tdata=None)
+        self.aud = JobData(track=None, type=None, tdata=None, channels=None, copy=None, downmix=None)
+        self.infile = JobData(file=None, path=None, base=None, ext=None, full=None)
+        self.outfile = JobData(file=None, path=None, base=None, ext='.mp4', full=None)
+
+        # ffmpeg options
+        # encoder holds the video encoding options, sans filters and container options
+        self.ffo = JobData(scaler=[], subs=[], audio=[], video=[], filters=[], encoder=[])
+
+        # Entry data from db.files
+        self.fdi = {}
+        # Matching entry from db.episodes
+        self.fdi_epx = {}
+        # Matching entry from db.series
+        self.fdi_srx = {}
 
 
 def run(xconfig):
     """
     Implements --xcode mode
+    Each call runs as a separate TranscodeJob, so concurrent calls (eg. from
+    queue runner worker threads) do not share any state
     """
-    global monjer, config
     config = xconfig
+    job = TranscodeJob(xconfig)
 
     # Check input filename
     if not config.run['infile']:
@@ -116,39 +101,42 @@ def run(xconfig):
 
     # Get video ID (MD5 sum by default)
     if config.run['id']:
-        vinfo.id = config.run['id']
+        job.id = config.run['id']
     elif config.vid['autoid']:
-        vinfo.id = util.md5sum(config.run['infile'])
-        logthis("MD5 Checksum:", suffix=vinfo.id, loglevel=LL.INFO)
+        job.id = util.md5sum(config.run['infile'])
+        logthis("MD5 Checksum:", suffix=job.id, loglevel=LL.INFO)
 
     # Connect to Mongo
-    monjer = db.mongo(config.mongo)
+    job.monjer = db.mongo(config.mongo)
 
     # Build pre-transcode data
-    vinfo.vername = config.vid['vername']
-    if monjer and vinfo.id:
-        if not vinfo.vername:
+    job.vername = config.vid['vername']
+    if job.monjer and job.id:
+        if not job.vername:
             failwith(ER.OPT_MISSING, "No version name specified. Use --vername to specify the version name. Aborting.")
-        vdata = vdataBuild()
+        vdata = vdataBuild(job)
     else:
         logthis("Setting update mode to MXM.NONE", loglevel=LL.DEBUG)
-        vinfo.mxmode = MXM.NONE
+        job.mxmode = MXM.NONE
         vdata = False
 
     # Perform transcoding
-    vvdata = transcode(config.run['infile'], config.run['outfile'])
+    vvdata = transcode(job, config.run['infile'], config.run['outfile'])
     if vdata:
-        vdata['versions'][vinfo.vername] = vvdata
+        if config.xcode['renditions']:
+            vdata['versions'].update(vvdata)
+        else:
+            vdata['versions'][job.vername] = vvdata
 
     # Grab an interesting frame for the screenshot
     if config.run['vscap']:
-        vsdata = sscapture(config.run['infile'], config.run['vscap'], vinfo.id)
+        vsdata = sscapture(config, config.run['vscap'], job.id)
         if vdata:
             vdata['vscap'] = vsdata
 
     # Insert data into Mongo
     if vdata:
-        vdataInsert(vdata)
+        vdataInsert(job, vdata)
 
     logthis("*** Transcoding task completed successfully.", loglevel=LL.INFO)
     return 0
@@ -237,20 +225,22 @@ def sscapture(xconfig, offset, src_id=None):
     return vsdata
 
 
-def transcode(infile, outfile=None):
+def transcode(job, infile, outfile=None):
     """
-    Transcode video
+    Transcode video for TranscodeJob @job
     """
-    global monjer, config
+    config = job.config
 
     # Split apart the input file, path, and extension
-    vinfo.infile.full = os.path.realpath(os.path.expanduser(infile))
-    vinfo.infile.path, vinfo.infile.file = os.path.split(vinfo.infile.full)
-    vinfo.infile.base, vinfo.infile.ext = os.path.splitext(vinfo.infile.file)
+    job.infile.full = os.path.realpath(os.path.expanduser(infile))
+    job.infile.path, job.infile.file = os.path.split(job.infile.full)
+    job.infile.base, job.infile.ext = os.path.splitext(job.infile.file)
 
     # Get Matroska data
     logthis("Getting Matroska data", loglevel=LL.DEBUG)
-    mkv = getMatroska(vinfo.infile.full)
+    mkv = getMatroska(job.infile.full)
+    subfile = None
+    workdir = None
 
     ## Set up encoding options ##
 
@@ -280,36 +270,31 @@ def transcode(infile, outfile=None):
         for st in stracks:
             logthis("** Subs: Track %d (%s) - '%s' [%s] %s" % (st['number'] - 1, st['codec_id'], st['name'], st['language'], strifset(st['default'], "***")), loglevel=LL.INFO)
             if st['default']: deftrack = st
-            if subset == (st['number'] - 1): vinfo.sub.tdata = st
+            if subset == (st['number'] - 1): job.sub.tdata = st
         # if no track found, use default
-        if not vinfo.sub.tdata:
+        if not job.sub.tdata:
             # throw a warning if our chosen track doesn't exist
             if subset is not True and subset != (deftrack['number'] - 1):
                 logthis("Using default subtitle track. Track not found with ID", suffix=subset, loglevel=LL.WARNING)
-            vinfo.sub.tdata = deftrack
+            job.sub.tdata = deftrack
 
         # Get important bits of track data
-        vinfo.sub.track = vinfo.sub.tdata['number'] - 1
-        vinfo.sub.type = vinfo.sub.tdata['codec_id']
+        job.sub.track = job.sub.tdata['number'] - 1
+        job.sub.type = job.sub.tdata['codec_id']
 
         # Set ffmpeg options for subs
-        # For ASS subs, dump font attachments
-        if vinfo.sub.type == STYPE.ASS:
-            logthis("Dumping font attachments...", loglevel=LL.INFO)
-            fontlist = ffmpeg.dumpFonts(vinfo.infile.full, config.xcode['fontdir'])
-            subfile = "subtrack.ass"
-            ffo.subs = ['ass=%s' % subfile]
-        elif vinfo.sub.type == STYPE.SRT:
-            subfile = "subtrack.srt"
-            ffo.subs = ["subtitles=%s:force_style='%s'" % (subfile, config.xcode['srt_style'])]
+        # Subs (and fonts, for ASS) are extracted to a per-job scratch dir later, unless the encode cache has a match
+        workdir = tempfile.mkdtemp(prefix="xbake_xcode_")
+        if job.sub.type == STYPE.ASS:
+            subfile = workdir + "/subtrack.ass"
+            job.ffo.subs = ['ass=%s:fontsdir=%s' % (subfile, workdir + "/fonts")]
+        elif job.sub.type == STYPE.SRT:
+            subfile = workdir + "/subtrack.srt"
+            job.ffo.subs = ["subtitles=%s:force_style='%s'" % (subfile, config.xcode['srt_style'])]
         else:
-            logthis("Unsupported subtitle type:", suffix=vinfo.sub.type, loglevel=LL.ERROR)
+            logthis("Unsupported subtitle type:", suffix=job.sub.type, loglevel=LL.ERROR)
             failwith(ER.UNSUPPORTED, "Sub type not supported. Unable to continue. Aborting.")
 
-        # Extract subtitle track
-        logthis("Extracting subtitle track from container...", loglevel=LL.INFO)
-        ffmpeg.dumpSub(vinfo.infile.full, vinfo.sub.track, subfile)
-
     ## Audio
     atracks = mkv['audio_tracks']
 
@@ -321,135 +306,190 @@ def transcode(infile, outfile=None):
     for st in atracks:
         logthis("** Audio: Track %d (%s) - '%s' %dch [%s] %s" % (st['number'] - 1, st['codec_id'], st['name'], st['channels'], st['language'], strifset(st['default'], "***")), loglevel=LL.INFO)
         if st['default']: deftrack = st
-        if subset == (st['number'] - 1): vinfo.aud.tdata = st
+        if subset == (st['number'] - 1): job.aud.tdata = st
     # if no track found, use default
-    if not vinfo.aud.tdata:
+    if not job.aud.tdata:
         # throw a warning if our chosen track doesn't exist
         if subset is not True and subset != (deftrack['number'] - 1):
             logthis("Using default audio track. Track not found with ID", suffix=subset, loglevel=LL.WARNING)
-        vinfo.aud.tdata = deftrack
+        job.aud.tdata = deftrack
 
     # Get important bits of track data
-    vinfo.aud.track = vinfo.aud.tdata['number'] - 1
-    vinfo.aud.type = vinfo.aud.tdata['codec_id']
-    vinfo.aud.channels = vinfo.aud.tdata['channels']
+    job.aud.track = job.aud.tdata['number'] - 1
+    job.aud.type = job.aud.tdata['codec_id']
+    job.aud.channels = job.aud.tdata['channels']
 
     # Determine if we need to transcode the audio
     if str(config.xcode['acopy']).lower() == 'auto':
         # stream copy apparently only works for the default track
-        if vinfo.aud.type == 'A_AAC' and vinfo.aud.tdata['default']:
-            vinfo.aud.copy = True
+        if job.aud.type == 'A_AAC' and job.aud.tdata['default']:
+            job.aud.copy = True
         else:
-            vinfo.aud.copy = False
+            job.aud.copy = False
     elif config.xcode['acopy'] == 1 or config.xcode['acopy'] is True:
-        vinfo.aud.copy = True
+        job.aud.copy = True
     else:
-        vinfo.aud.copy = False
+        job.aud.copy = False
 
     # Determine if we need to downmix/upmix
     if config.xcode['downmix'].lower() == 'auto':
-        if vinfo.aud.channels != 2:
-            vinfo.aud.downmix = True
+        if job.aud.channels != 2:
+            job.aud.downmix = True
             # If stream copy is also set to auto, make sure it's
             # disabled if we need to downmix
             if config.xcode['acopy'].lower() == 'auto':
-                vinfo.aud.copy = False
+                job.aud.copy = False
         else:
-            vinfo.aud.downmix = False
+            job.aud.downmix = False
     elif config.xcode['downmix'] == 1 or config.xcode['downmix'] is True:
-        vinfo.aud.downmix = True
+        job.aud.downmix = True
     else:
-        vinfo.aud.downmix = False
+        job.aud.downmix = False
 
     # Set audio encoding options
-    if vinfo.aud.copy:
+    if job.aud.copy:
         # stream copy
-        ffo.audio += ['-c:a', 'copy']
+        job.ffo.audio += ['-c:a', 'copy']
     else:
         # set codec
-        ffo.audio += ['-c:a:%d' % vinfo.aud.track, 'libfaac']
+        job.ffo.audio += ['-c:a:%d' % job.aud.track, 'libfaac']
         # set audio bitrate
-        ffo.audio += ['-b:a:%d' % vinfo.aud.track, '%dk' % config.xcode['abr']]
+        job.ffo.audio += ['-b:a:%d' % job.aud.track, '%dk' % config.xcode['abr']]
         # set downmix (or possibly upmix if mono), if enabled
-        if vinfo.aud.downmix: ffo.audio += ['-ac', '2']
+        if job.aud.downmix: job.ffo.audio += ['-ac', '2']
 
     ## Filtering
     if config.xcode['scale']:
-        ffo.scaler = ['scale=%s' % config.xcode['scale']]
+        job.ffo.scaler = ['scale=%s' % config.xcode['scale']]
     if config.xcode['anamorphic']:
-        ffo.scaler = ['scale=854:480']
-        ffo.video += ['-aspect', '16:9']
-
-    # prefix filters to ffo.video
-    if ffo.scaler or ffo.subs:
-        ffo.video = ['-vf', ','.join(ffo.scaler + ffo.subs)] + ffo.video
+        job.ffo.scaler = ['scale=854:480']
+        job.ffo.video += ['-aspect', '16:9']
 
     ## Video & Output filename
-    ffo.video += ['-c:v', 'libx264', '-crf', str(config.xcode['crf']), '-preset:v', config.xcode['libx264_preset']]
+    job.ffo.video += ['-c:v', 'libx264', '-crf', str(config.xcode['crf']), '-preset:v', config.xcode['libx264_preset']]
+    job.ffo.encoder = list(job.ffo.video)
+    # segmented encodes set their own thread count per segment
+    if int(config.xcode['threads'] or 0):
+        job.ffo.video += ['-threads', str(int(config.xcode['threads']))]
+
+    # prefix filters to job.ffo.video
+    job.ffo.filters = job.ffo.scaler + job.ffo.subs
+    if job.ffo.filters:
+        job.ffo.video = ['-vf', ','.join(job.ffo.filters)] + job.ffo.video
 
     # Get output path
     if outfile and os.path.isdir(outfile):
-        vinfo.outfile.path = os.path.realpath(os.path.expanduser(outfile))
+        job.outfile.path = os.path.realpath(os.path.expanduser(outfile))
     else:
-        vinfo.outfile.path = os.path.realpath('.')
+        job.outfile.path = os.path.realpath('.')
 
     # Select output container & extension
     if not config.xcode['flv']:
-        ffo.video += ['-movflags', '+faststart']
-        vinfo.outfile.ext = '.mp4'
+        job.ffo.video += ['-movflags', '+faststart']
+        job.outfile.ext = '.mp4'
     else:
-        vinfo.outfile.ext = '.flv'
+        job.outfile.ext = '.flv'
 
     # Get output filename
     if outfile and not os.path.isdir(outfile):
-        vinfo.outfile.path, vinfo.outfile.file = os.path.split(os.path.realpath(os.path.expanduser(outfile)))
-        vinfo.outfile.base, vinfo.outfile.ext = os.path.split(vinfo.outfile.file)
+        job.outfile.path, job.outfile.file = os.path.split(os.path.realpath(os.path.expanduser(outfile)))
+        job.outfile.base, job.outfile.ext = os.path.split(job.outfile.file)
     else:
-        vinfo.outfile.base = vinfo.infile.base
+        job.outfile.base = job.infile.base
 
     # Outfile realpath
-    vinfo.outfile.full = vinfo.outfile.path + '/' + vinfo.outfile.base + vinfo.outfile.ext
-    vinfo.outfile.file = os.path.split(vinfo.outfile.full)[1]
-
-
-    logthis("-- Using Subtitle Track:", suffix=vinfo.sub.track, loglevel=LL.INFO)
-    logthis("-- Using Audio Track:", suffix=vinfo.aud.track, loglevel=LL.INFO)
-    logthis("-- Output filename:", suffix=vinfo.outfile.full, loglevel=LL.INFO)
+    job.outfile.full = job.outfile.path + '/' + job.outfile.base + job.outfile.ext
+    job.outfile.file = os.path.split(job.outfile.full)[1]
+
+
+    logthis("-- Using Subtitle Track:", suffix=job.sub.track, loglevel=LL.INFO)
+    logthis("-- Using Audio Track:", suffix=job.aud.track, loglevel=LL.INFO)
+    logthis("-- Output filename:", suffix=job.outfile.full, loglevel=LL.INFO)
+
+    ## Check encode cache
+    nsegs = int(config.xcode['segments'] or 0)
+    renditions = config.xcode['renditions']
+    xcfp = None
+    xchit = None
+    if xcache.enabled(config) and not renditions:
+        srcmd5 = job.fdi.get('checksum', {}).get('md5') if job.fdi else None
+        if not srcmd5:
+            srcmd5 = job.id if (config.vid['autoid'] and not config.run['id']) else util.md5sum(job.infile.full)
+        # the scratch dir path differs on every run, so it is replaced with a placeholder
+        # the chosen subtitle & audio tracks are included, since the options alone don't always name them
+        # (eg. baked subs only refer to the extracted file, and '-c:a copy' has no track number)
+        encopts = {'video': [x.replace(workdir, "%WORKDIR%") if workdir else x for x in job.ffo.video],
+                   'audio': job.ffo.audio, 'segments': nsegs, 'ext': job.outfile.ext,
+                   'sub_track': job.sub.track, 'audio_track': job.aud.track, 'downmix': bool(job.aud.downmix)}
+        xcfp = xcache.fingerprint(srcmd5, encopts)
+        xchit = xcache.fetch(config, xcfp, job.outfile.full)
+        if xchit is None and os.path.exists(job.outfile.full):
+            # remove any existing output, since it may be hardlinked to a cache entry
+            os.remove(job.outfile.full)
+
+    ## Extract subtitle track (and fonts)
+    if subfile and not xchit:
+        logthis("Extracting subtitle track and fonts from container...", loglevel=LL.INFO)
+        ffmpeg.extractSubsFonts(job.infile.full, workdir, job.sub.track, subfile, config.xcode['fontcache'])
 
     ## Build ffmpeg command
-    ffoptions = ['-y', '-i', vinfo.infile.full] + ffo.video + ffo.audio + [vinfo.outfile.full]
-    ffmpeg.run(ffoptions, (not config.xcode['show_ffmpeg']))
+    # CPU time of this job's own ffmpeg processes, for the encode cache
+    xstats = {'cpu': 0.0}
+    if xchit:
+        xencode = None
+        ffoptions = ['-y', '-i', job.infile.full] + job.ffo.video + job.ffo.audio + [job.outfile.full]
+    elif renditions:
+        # Multiple renditions from a single decode
+        xencode = None
+        for trend in renditions:
+            mkdirp(os.path.dirname(trend['outfile']))
+            logthis("-- Rendition %s:" % (trend['name']), suffix=trend['outfile'], loglevel=LL.INFO)
+        ffoptions = build_renditions(job.infile.full, renditions, job.ffo.subs, config.xcode['libx264_preset'], job.aud.track,
+                                     job.aud.copy, job.aud.downmix, int(config.xcode['threads'] or 0))
+        ffmpeg.run(ffoptions, (not config.xcode['show_ffmpeg']))
+    elif nsegs > 1 and mkv['info'].get('duration'):
+        # Segmented encode
+        bounds = segment_bounds(mkv, nsegs)
+        xencode = encode_segments(job.infile.full, job.outfile.full, bounds, job.ffo.filters, bool(job.ffo.subs), job.ffo.encoder,
+                                  job.ffo.audio, int(config.xcode['segment_procs']), (not config.xcode['show_ffmpeg']), xstats)
+        ffoptions = xencode['final']
+    else:
+        if nsegs > 1:
+            logthis("Unable to determine duration of source; segmented encode disabled", loglevel=LL.WARNING)
+        xencode = None
+        ffoptions = ['-y', '-i', job.infile.full] + job.ffo.video + job.ffo.audio + [job.outfile.full]
+        ffmpeg.run(ffoptions, (not config.xcode['show_ffmpeg']), xstats)
+
+    # Add to encode cache
+    if xcfp and not xchit:
+        xcache.store(config, xcfp, job.outfile.full, srcmd5, encopts, xstats['cpu'])
 
     ## Cleanup
-    if trueifset(config.run['bake'], typematch=True):
-        logthis("Removing font and subtitle files...", loglevel=LL.VERBOSE)
-        try:
-            os.remove(subfile)
-        except Exception as e:
-            logexc(e, "Unable to remove subfile")
-
-        if not config.xcode['fontsave']:
-            for ff in fontlist:
-                if config.xcode['fontdir']:
-                    try:
-                        os.remove(os.path.expanduser(config.xcode['fontdir']).rstrip('/') + "/" + ff)
-                    except Exception as e:
-                        logexc(e, "Unable to remove font from fontdir (%s)" % (ff))
-                else:
-                    try:
-                        os.remove(ff)
-                    except Exception as e:
-                        logexc(e, "Unable to remove font (%s)" % (ff))
+    if workdir:
+        logthis("Removing subtitle scratch dir:", suffix=workdir, loglevel=LL.VERBOSE)
+        shutil.rmtree(workdir, ignore_errors=True)
 
     logthis("Transcoding complete", ccode=C.GRN, loglevel=LL.INFO)
 
-    if vinfo.vername:
+    if renditions:
+        vvdata = {}
+        for trend in renditions:
+            vvdata[trend['name']] = {
+                                      'encoder': {'encode': ' '.join(ffoptions), 'rendition': trend},
+                                      'mediainfo': util.mediainfo(trend['outfile'], config),
+                                      'location': {
+                                          'uri': trend['name'] + '/' + os.path.basename(trend['outfile']),
+                                          'realpath': trend['outfile']
+                                      }
+                                    }
+    elif job.vername:
         vvdata = {
-                    'encoder': {'encode': ' '.join(ffoptions)},
-                    'mediainfo': util.mediainfo(vinfo.outfile.full, config),
+                    'encoder': {'encode': ' '.join(ffoptions), 'segmented': xencode,
+                                'cache': ({'fingerprint': xcfp, 'hit': bool(xchit)} if xcfp else None)},
+                    'mediainfo': util.mediainfo(job.outfile.full, config),
                     'location': {
-                        'uri': vinfo.vername + '/' + vinfo.outfile.file,
-                        'realpath': vinfo.outfile.full
+                        'uri': job.vername + '/' + job.outfile.file,
+                        'realpath': job.outfile.full
                     }
                  }
     else:
@@ -458,78 +498,198 @@ def transcode(infile, outfile=None):
     return vvdata
 
 
-def vdataInsert(xvid):
+def build_renditions(infile, renditions, vfilters, preset, atrack, acopy=False, downmix=False, threads=0):
+    """
+    build ffmpeg options to encode all @renditions from a single decode of @infile
+    @renditions is a list of {name, outfile, scale, crf, abr}
+    @vfilters (eg. subtitle rendering) are applied once, before the video is split and
+    scaled for each rendition; audio track @atrack is mapped to every output
+    if @threads is set, each rendition's encoder uses that many threads
+    """
+    # [0:v] -> vfilters -> split -> [sN] -> scale -> [vN]
+    fgraph = ["[0:v]%ssplit=%d%s" % (''.join([x + ',' for x in vfilters]), len(renditions),
+                                      ''.join(["[s%d]" % i for i in range(len(renditions))]))]
+    for i, trend in enumerate(renditions):
+        if trend.get('scale'):
+            fgraph.append("[s%d]scale=%s[v%d]" % (i, trend['scale'], i))
+        else:
+            fgraph.append("[s%d]null[v%d]" % (i, i))
+
+    ffoptions = ['-y', '-i', infile, '-filter_complex', ';'.join(fgraph)]
+    for i, trend in enumerate(renditions):
+        ffoptions += ['-map', '[v%d]' % i, '-map', '0:%d' % atrack]
+        ffoptions += ['-c:v', 'libx264', '-crf', str(trend['crf']), '-preset:v', preset]
+        if threads: ffoptions += ['-threads', str(threads)]
+        if acopy:
+            ffoptions += ['-c:a', 'copy']
+        else:
+            ffoptions += ['-c:a', 'libfaac', '-b:a', '%dk' % int(trend['abr'])]
+            if downmix: ffoptions += ['-ac', '2']
+        if not trend['outfile'].lower().endswith('.flv'):
+            ffoptions += ['-movflags', '+faststart']
+        ffoptions += [trend['outfile']]
+
+    return ffoptions
+
+def segment_bounds(mkv, nsegs):
+    """
+    determine segments for a segmented encode of @mkv into @nsegs parts of roughly equal length
+    Where there is a chapter start near an ideal cut point, it is used instead, as chapters
+    usually begin on a scene change (and therefore a keyframe in the source)
+    returns list of (start, duration) tuples, in seconds
+    """
+    duration = mkv['info']['duration'].total_seconds()
+    chapters = sorted([tc['start'].total_seconds() for tc in mkv.get('chapters', []) if tc.get('start') is not None])
+    slen = duration / nsegs
+
+    cuts = [0.0]
+    for i in range(1, nsegs):
+        tcut = slen * i
+        near = [tc for tc in chapters if abs(tc - tcut) <= slen / 4.0 and tc > cuts[-1] + 1.0]
+        cuts.append(min(near, key=lambda tc: abs(tc - tcut)) if near else tcut)
+    cuts.append(duration)
+
+    return [(cuts[i], cuts[i + 1] - cuts[i]) for i in range(nsegs)]
+
+def encode_segments(infile, outfile, bounds, vfilters, bakesubs, vencopts, aencopts, maxprocs=0, supout=True, stats=None):
+    """
+    Segmented encode: encodes the video in segments (@bounds, from segment_bounds()) in parallel, and the
+    audio in one pass alongside them, then concatenates the segments and muxes in the audio without re-encoding
+    @vfilters is the video filter chain; if @bakesubs is set, the timestamps are shifted by the segment offset
+    for the subtitle filter, so that the subtitle timing matches the source
+    @vencopts and @aencopts are the ffmpeg video and audio encoding options
+    if @stats is a dict, the CPU time used by all ffmpeg processes is added to stats['cpu']
+    returns dict of encoding info, including the final ffmpeg mux options ('final') and wall-clock times
+    """
+    if not maxprocs:
+        maxprocs = multiprocessing.cpu_count()
+    nthreads = max(1, multiprocessing.cpu_count() // min(maxprocs, len(bounds) + 1))
+
+    opath, ofile = os.path.split(outfile)
+    segdir = tempfile.mkdtemp(prefix=".xbake_seg_", dir=opath)
+    logthis("Segmented encode: %d segments, %d processes; working dir:" % (len(bounds), maxprocs), suffix=segdir, loglevel=LL.INFO)
+
+    try:
+        # Audio is encoded in a single pass, to avoid gaps and priming samples at the joins
+        audfile = segdir + "/audio.m4a"
+        optlists = [['-y', '-i', infile, '-vn', '-sn'] + aencopts + [audfile]]
+
+        segfiles = []
+        for sidx, (sstart, slen) in enumerate(bounds):
+            if vfilters and bakesubs:
+                tfilt = ['setpts=PTS+%.3f/TB' % (sstart)] + vfilters + ['setpts=PTS-STARTPTS']
+            else:
+                tfilt = vfilters
+            segfiles.append(segdir + "/seg%04d.mp4" % (sidx))
+            optlists.append(['-y', '-ss', "%.3f" % (sstart), '-i', infile, '-t', "%.3f" % (slen), '-an', '-sn'] +
+                            (['-vf', ','.join(tfilt)] if tfilt else []) +
+                            vencopts + ['-threads', str(nthreads), segfiles[-1]])
+
+        t_start = time.time()
+        rtimes = ffmpeg.run_parallel(optlists, maxprocs, supout, stats)
+        t_encode = time.time() - t_start
+
+        # Concatenate video segments, and mux in audio
+        seglist = segdir + "/segments.txt"
+        with open(seglist, 'w') as f:
+            for tseg in segfiles:
+                f.write("file '%s'\n" % (tseg.replace("'", "'\\''")))
+
+        ffinal = ['-y', '-f', 'concat', '-safe', '0', '-i', seglist, '-i', audfile, '-map', '0:v', '-map', '1:a', '-c', 'copy']
+        if not ofile.lower().endswith('.flv'):
+            ffinal += ['-movflags', '+faststart']
+        ffinal += [outfile]
+        ffmpeg.run(ffinal, supout, stats)
+        t_total = time.time() - t_start
+    finally:
+        shutil.rmtree(segdir, ignore_errors=True)
+
+    # Sum of the encode times is what the video would have taken in a single process
+    t_serial = sum(rtimes)
+    logthis("Segmented encode complete: %.1fs wall clock; %.1fs total encode time; est. speedup %.2fx" %
+            (t_total, t_serial, t_serial / t_total if t_total else 0.0), ccode=C.GRN, loglevel=LL.INFO)
+
+    return {
+             'segments': [{'start': tstart, 'duration': tlen, 'time': ttime} for (tstart, tlen), ttime in zip(bounds, rtimes[1:])],
+             'audio_time': rtimes[0],
+             'encode_time': t_encode,
+             'total_time': t_total,
+             'final': ffinal
+           }
+
+def vdataInsert(job, xvid):
     """
     Insert data into MongoDB collection
     """
-    global monjer
 
     logthis("Inserting data into Mongo...", loglevel=LL.INFO)
-    if vinfo.mxmode == MXM.INSERT:
-        monjer.insert('videos', xvid)
-    elif vinfo.mxmode == MXM.UPDATE:
-        vsetter = {'versions.'+vinfo.vername : xvid['versions'][vinfo.vername]}
-        monjer.update_set('videos', vinfo.id, vsetter)
+    if job.mxmode == MXM.INSERT:
+        job.monjer.insert('videos', xvid)
+    elif job.mxmode == MXM.UPDATE:
+        vsetter = {}
+        for tver in xvid['versions']:
+            vsetter['versions.' + tver] = xvid['versions'][tver]
+        job.monjer.update_set('videos', job.id, vsetter)
 
 
-def vdataBuild():
+def vdataBuild(job):
     """
-    Query MongoDB and build data structures prior to transcoding
+    Query MongoDB and build data structures prior to transcoding for TranscodeJob @job
     """
-    global monjer, config
+    config = job.config
 
-    vx.fdi = monjer.findOne('files', {'_id': vinfo.id})
-    if vx.fdi:
+    job.fdi = job.monjer.findOne('files', {'_id': job.id})
+    if job.fdi:
         logthis("Found matching entry in database", loglevel=LL.INFO)
         # Get episode information
-        if vx.fdi['episode_id']:
-            vx.fdi_epx = monjer.findOne('episodes', {'_id': vx.fdi['episode_id']})
+        if job.fdi['episode_id']:
+            job.fdi_epx = job.monjer.findOne('episodes', {'_id': job.fdi['episode_id']})
             logthis("Found matching episode entry", loglevel=LL.VERBOSE)
         else:
-            vx.fdi_epx = None
+            job.fdi_epx = None
 
         # Get series information
-        if vx.fdi['series_id']:
-            vx.fdi_srx = monjer.findOne('series', {'_id': vx.fdi['series_id']})
+        if job.fdi['series_id']:
+            job.fdi_srx = job.monjer.findOne('series', {'_id': job.fdi['series_id']})
             logthis("Found matching series entry", loglevel=LL.VERBOSE)
         else:
-            vx.fdi_srx = None
+            job.fdi_srx = None
 
         # Check if matching video already exists
-        if not monjer.findOne('videos', {'_id': vx.fdi['_id']}):
+        if not job.monjer.findOne('videos', {'_id': job.fdi['_id']}):
             logthis("Entry does not already exist. Populating video metadata", loglevel=LL.INFO)
-            vinfo.mxmode = MXM.INSERT
+            job.mxmode = MXM.INSERT
             # Check location
             if config.vid['location']:
                 # Get from running config (--vername option or vid.vername)
-                vinfo.location = config.vid['location']
+                job.location = config.vid['location']
             else:
                 # Otherwise, get first location from list
-                vinfo.location = vx.fdi['location'].keys()[0]
+                job.location = job.fdi['location'].keys()[0]
 
             # Initialize metadata
             xvid = {
-                    '_id': vx.fdi['_id'],
+                    '_id': job.fdi['_id'],
                     'metadata': {
-                            'title': setifset(vx.fdi_epx, 'EpisodeName'),
-                            'series': vx.fdi['fparse']['series'],
-                            'episode': vx.fdi['fparse']['episode'],
-                            'season': vx.fdi['fparse']['season'],
-                            'special': vx.fdi['fparse']['special']
+                            'title': setifset(job.fdi_epx, 'EpisodeName'),
+                            'series': job.fdi['fparse']['series'],
+                            'episode': job.fdi['fparse']['episode'],
+                            'season': job.fdi['fparse']['season'],
+                            'special': job.fdi['fparse']['special']
                         },
-                    'tdex_id': setifset(vx.fdi_srx, 'norm_id'),
-                    'series_id': vx.fdi['series_id'],
-                    'episode_id': vx.fdi['episode_id'],
-                    'tvdb_id': {'series': vx.fdi_srx['xrefs']['tvdb'], 'episode': vx.fdi_epx['tvdb_id']},
+                    'tdex_id': setifset(job.fdi_srx, 'norm_id'),
+                    'series_id': job.fdi['series_id'],
+                    'episode_id': job.fdi['episode_id'],
+                    'tvdb_id': {'series': job.fdi_srx['xrefs']['tvdb'], 'episode': job.fdi_epx['tvdb_id']},
                     'source': {
-                            'filename': vx.fdi['location'][vinfo.location]['fpath']['file'],
+                            'filename': job.fdi['location'][job.location]['fpath']['file'],
                             'location': {
-                                    'hostname': vinfo.location,
-                                    'path': vx.fdi['location'][vinfo.location]['fpath']['real']
+                                    'hostname': job.location,
+                                    'path': job.fdi['location'][job.location]['fpath']['real']
                                 },
-                            'mediainfo': vx.fdi['mediainfo'],
-                            'checksum': vx.fdi['checksum'],
-                            'stat': vx.fdi['location'][vinfo.location]['stat']
+                            'mediainfo': job.fdi['mediainfo'],
+                            'checksum': job.fdi['checksum'],
+                            'stat': job.fdi['location'][job.location]['stat']
                         },
                     'subs': {
                             'enabled': trueifset(config.run['bake'], typematch=True),
@@ -541,10 +701,10 @@ def vdataBuild():
         else:
             # Entry already exists in db.videos
             logthis("Entry already exists. Will update version or vscap information.", loglevel=LL.INFO)
-            vinfo.mxmode = MXM.UPDATE
+            job.mxmode = MXM.UPDATE
             xvid = {'versions': {}}
     else:
-        logthis("No matching entry found in database. ID:", suffix=vinfo.id, loglevel=LL.ERROR)
+        logthis("No matching entry found in database. ID:", suffix=job.id, loglevel=LL.ERROR)
         failwith(ER.NOTFOUND, "No match for VID. Will not contiue. Aborting.")
 
     return xvid